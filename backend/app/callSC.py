@@ -1,84 +1,309 @@
-from web3 import Web3
-from eth_account import Account
 import json
 import os
+import random
+import threading
+import time
+import requests
+from requests.adapters import HTTPAdapter
 from dotenv import load_dotenv
+from .log import get_logger
+from .metrics import RPC_ERRORS
 
 load_dotenv()
-# Connect to an Ethereum node (replace with your node URL)
-# For example, Infura endpoint for Ethereum mainnet or testnet
-w3 = Web3(Web3.HTTPProvider(os.getenv('BASE_SEPOLIA_NODE_URL')))
-
-# Debug: Check connection to Ethereum node
-if not w3.is_connected():
-    print("Error: Not connected to Ethereum node. Check BASE_SEPOLIA_NODE_URL and network connection.")
-    exit(1)
+log = get_logger('callSC')
+# Ethereum node to connect to, e.g. an Infura endpoint for a testnet
+node_url = os.getenv('BASE_SEPOLIA_NODE_URL')
+# Connections kept alive to the node, shared by every thread
+pool_size = int(os.getenv('CHAIN_POOL_SIZE', '8'))
+# Seconds before a single RPC request times out
+request_timeout = float(os.getenv('CHAIN_REQUEST_TIMEOUT', '10'))
+# Attempts per read call, and the base and cap (seconds) of the jittered backoff between them
+retry_attempts = int(os.getenv('CHAIN_RETRY_ATTEMPTS', '4'))
+retry_backoff = float(os.getenv('CHAIN_RETRY_BACKOFF', '0.2'))
+retry_backoff_max = float(os.getenv('CHAIN_RETRY_BACKOFF_MAX', '5'))
 
 # Contract details
 contract_address = '0xE1A5037962a3108bdF6049419b5038b21AE24D85'
-with open('abi.json') as json_file:
-    contract_abi = json.load(json_file)
+# Resolved next to the app package rather than against the working directory
+abi_path = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'abi.json')
 
-# Initialize contract
-contract = w3.eth.contract(address=contract_address, abi=contract_abi)
+# Errors of a node that is unreachable, slow or rate limiting, worth retrying
+TRANSIENT_ERRORS = (requests.ConnectionError, requests.Timeout, requests.HTTPError)
 
-# Your private key (keep this secure and never share it!)
-private_key = os.getenv('PRIVATE_KEY')
-print(private_key)
-account = Account.from_key(private_key)
 
-def add_hash(hash_string: str):
+class ChainClient:
     """
-    Add a hash to the smart contract if it does not already exist
+    Web3 client, contract and signing account, built on first use instead of at import time.
+
+    Constructing it does no network I/O: a node that is down makes chain calls fail (and the getters
+    below return None) instead of stopping the app. All calls go through one `requests` session whose
+    connection pool keeps `pool_size` connections to the node alive.
     """
-    try:
-        # Check if the hash already exists
-        existing_hashes = contract.functions.getAllHashes().call()
-        if hash_string in existing_hashes:
-            print(f"Hash '{hash_string}' already exists in contract. Skipping addition.")
-            return None
 
-        # Build the transaction
-        nonce = w3.eth.get_transaction_count(account.address)
+    def __init__(self, node_url: str, abi_path: str, private_key: str | None):
+        # web3 takes over a second to import, only pay for it once the chain is needed
+        from web3 import Web3
+        from eth_account import Account
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        # Retries are done by with_retries(), with jitter and only for reads
+        provider = Web3.HTTPProvider(node_url, request_kwargs={'timeout': request_timeout},
+                                     session=self.session, exception_retry_configuration=None)
+        self.w3 = Web3(provider)
+
+        with open(abi_path) as json_file:
+            contract_abi = json.load(json_file)
+        self.contract = self.w3.eth.contract(address=contract_address, abi=contract_abi)
+
+        # Your private key (keep this secure and never share it!)
+        self.private_key = private_key
+        self.account = Account.from_key(private_key) if private_key else None
+
+    def require_account(self):
+        if self.account is None:
+            raise ValueError("PRIVATE_KEY is not set, cannot sign transactions")
+        return self.account
 
-        # Estimate gas
-        gas_estimate = contract.functions.addHash(hash_string).estimate_gas({
-            'from': account.address
-        })
 
-        transaction = contract.functions.addHash(hash_string).build_transaction({
-            'from': account.address,
-            'gas': gas_estimate,
-            'gasPrice': w3.eth.gas_price,
-            'nonce': nonce,
-        })
+_client = None
+_client_lock = threading.Lock()
 
-        # Sign the transaction
-        signed_txn = w3.eth.account.sign_transaction(transaction, private_key)
 
-        # Send the transaction (fix: use snake_case attribute for raw transaction bytes)
-        tx_hash = w3.eth.send_raw_transaction(signed_txn.raw_transaction)
+def get_client() -> ChainClient:
+    """Return the process-wide chain client, creating it on first use."""
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                _client = ChainClient(node_url, abi_path, os.getenv('PRIVATE_KEY'))
+    return _client
+
+
+def with_retries(call, description: str, attempts: int = None):
+    """
+    Run a read-only chain call, retrying transient failures with full-jitter exponential backoff
+    (a random delay between 0 and min(retry_backoff_max, retry_backoff * 2**attempt)).
+    Transactions are never retried here: resending is up to the caller, who owns the nonce.
+    Every failed attempt is counted in `pxlproof_rpc_errors_total` under `description`.
+    """
+    if attempts is None:
+        attempts = retry_attempts
+    for attempt in range(attempts):
+        try:
+            return call()
+        except TRANSIENT_ERRORS as e:
+            RPC_ERRORS.inc(call=description)
+            if attempt == attempts - 1:
+                raise
+            delay = random.uniform(0, min(retry_backoff_max, retry_backoff * 2 ** attempt))
+            log.warning("Retrying chain call", extra={"call": description, "delay": round(delay, 3), "error": str(e)})
+            time.sleep(delay)
+        except Exception:
+            RPC_ERRORS.inc(call=description)
+            raise
+
+
+def check_ready() -> bool:
+    """
+    Readiness probe: True if the node answers a block number request right now (a single attempt)
+    """
+    try:
+        with_retries(lambda: get_client().w3.eth.block_number, "block number", attempts=1)
+        return True
+    except Exception as e:
+        log.warning("Chain not ready", extra={"error": str(e)})
+        return False
+
+def add_hash(hash_string: str, check_existing: bool = True):
+    """
+    Add a hash to the smart contract if it does not already exist
+
+    Callers that already keep a local mirror of the contract (see hash_index.py)
+    can pass check_existing=False to skip the full getAllHashes() download.
+    """
+    try:
+        client = get_client()
+        # Check if the hash already exists
+        if check_existing:
+            existing_hashes = with_retries(client.contract.functions.getAllHashes().call, "getAllHashes")
+            if hash_string in existing_hashes:
+                log.info("Hash already exists in contract, skipping addition", extra={"hash": hash_string})
+                return None
+
+        # Build the transaction
+        nonce = with_retries(lambda: client.w3.eth.get_transaction_count(client.require_account().address),
+                             "transaction count")
+        tx_hash = send_add_hash(hash_string, nonce)
 
         # Wait for transaction receipt
-        tx_receipt = w3.eth.wait_for_transaction_receipt(tx_hash)
-        print(f"Transaction successful! Transaction hash: {tx_hash.hex()}")
+        tx_receipt = client.w3.eth.wait_for_transaction_receipt(tx_hash)
+        log.info("Transaction successful", extra={"trx_hash": tx_hash.hex()})
         return tx_hash.hex()
 
     except Exception as e:
-        print(f"Error adding hash: {str(e)}")
+        log.error("Error adding hash", extra={"error": str(e)})
         return None
 
+def _send(function, nonce: int):
+    """
+    Estimate gas for a contract call, then sign and send it with an explicit nonce.
+    The gas estimate and price lookups are retried; sending the signed transaction is not.
+    """
+    client = get_client()
+    account = client.require_account()
+    # Estimate gas
+    gas_estimate = with_retries(lambda: function.estimate_gas({
+        'from': account.address
+    }), "gas estimate")
+
+    transaction = function.build_transaction({
+        'from': account.address,
+        'gas': gas_estimate,
+        'gasPrice': with_retries(lambda: client.w3.eth.gas_price, "gas price"),
+        'nonce': nonce,
+    })
+
+    # Sign the transaction
+    signed_txn = client.w3.eth.account.sign_transaction(transaction, client.private_key)
+
+    # Send the transaction (fix: use snake_case attribute for raw transaction bytes)
+    return client.w3.eth.send_raw_transaction(signed_txn.raw_transaction)
+
+def send_add_hash(hash_entry, nonce: int):
+    """
+    Sign and send an addHash transaction with an explicit nonce, without waiting for the receipt.
+    Binary entries (bytes, see hash_codec.py) go to addPackedHash instead.
+    Raises on failure so the caller can decide whether to retry or resync the nonce.
+    """
+    contract = get_client().contract
+    if isinstance(hash_entry, bytes):
+        return _send(contract.functions.addPackedHash(hash_entry), nonce)
+    return _send(contract.functions.addHash(hash_entry), nonce)
+
+def send_add_hashes(hash_entries: list, nonce: int):
+    """
+    Sign and send a single addHashes (or addPackedHashes for binary entries) transaction registering
+    several hashes, without waiting for the receipt. One nonce, gas estimate and gas price lookup
+    cover the whole batch.
+    """
+    contract = get_client().contract
+    if all(isinstance(entry, bytes) for entry in hash_entries):
+        return _send(contract.functions.addPackedHashes(hash_entries), nonce)
+    return _send(contract.functions.addHashes(hash_entries), nonce)
+
+def send_anchor(data: bytes, nonce: int):
+    """
+    Sign and send a transaction from the publishing account to itself carrying `data`, without
+    waiting for the receipt. The contract has no storage for Merkle roots (see merkle.py), so the
+    calldata of this transaction is the on-chain record of the root.
+    """
+    client = get_client()
+    account = client.require_account()
+    transaction = {
+        'from': account.address,
+        'to': account.address,
+        'value': 0,
+        'data': data,
+    }
+    transaction['gas'] = with_retries(lambda: client.w3.eth.estimate_gas(transaction), "gas estimate")
+    transaction['gasPrice'] = with_retries(lambda: client.w3.eth.gas_price, "gas price")
+    transaction['chainId'] = with_retries(lambda: client.w3.eth.chain_id, "chain id")
+    transaction['nonce'] = nonce
+
+    signed_txn = client.w3.eth.account.sign_transaction(transaction, client.private_key)
+    return client.w3.eth.send_raw_transaction(signed_txn.raw_transaction)
+
+def get_pending_nonce():
+    """
+    Get the next nonce for the publishing account, counting transactions still in the mempool
+    """
+    client = get_client()
+    address = client.require_account().address
+    return with_retries(lambda: client.w3.eth.get_transaction_count(address, 'pending'), "pending nonce")
+
+def get_receipt(tx_hash):
+    """
+    Get the receipt of a sent transaction, or None if it has not been mined yet
+    """
+    from web3.exceptions import TransactionNotFound
+
+    client = get_client()
+
+    def fetch():
+        # Not mined yet is an answer, not an RPC error
+        try:
+            return client.w3.eth.get_transaction_receipt(tx_hash)
+        except TransactionNotFound:
+            return None
+
+    return with_retries(fetch, "transaction receipt")
+
+def wait_for_receipt(tx_hash):
+    """
+    Block until a sent transaction is mined and return its receipt
+    """
+    return get_client().w3.eth.wait_for_transaction_receipt(tx_hash)
+
+def get_block_number():
+    """
+    Get the latest block number
+    """
+    client = get_client()
+    return with_retries(lambda: client.w3.eth.block_number, "block number")
+
 def get_all_hashes():
     """
     Get all the stored hashes from the contract
     """
     try:
-        hashes = contract.functions.getAllHashes().call()
-        # print(f"All hashes: {hashes}")
+        hashes = with_retries(get_client().contract.functions.getAllHashes().call, "getAllHashes")
         assert isinstance(hashes, list)
         return hashes
     except Exception as e:
-        print(f"Error getting all hashes: {str(e)}")
+        log.error("Error getting all hashes", extra={"error": str(e)})
+        return None
+
+def get_total_hashes():
+    """
+    Get the number of hashes stored in the contract
+    """
+    try:
+        return with_retries(get_client().contract.functions.getTotalHashes().call, "getTotalHashes")
+    except Exception as e:
+        log.error("Error getting total hashes", extra={"error": str(e)})
+        return None
+
+def get_hash(index: int):
+    """
+    Get a single stored hash by its position in the contract array
+    """
+    try:
+        return with_retries(get_client().contract.functions.hashes(index).call, "hashes")
+    except Exception as e:
+        log.error("Error getting hash", extra={"index": index, "error": str(e)})
+        return None
+
+def get_total_packed_hashes():
+    """
+    Get the number of binary hashes stored in the contract
+    """
+    try:
+        return with_retries(get_client().contract.functions.getTotalPackedHashes().call, "getTotalPackedHashes")
+    except Exception as e:
+        log.error("Error getting total packed hashes", extra={"error": str(e)})
+        return None
+
+def get_packed_hash(index: int):
+    """
+    Get a single stored binary hash by its position in the contract array
+    """
+    try:
+        return with_retries(get_client().contract.functions.packedHashes(index).call, "packedHashes")
+    except Exception as e:
+        log.error("Error getting packed hash", extra={"index": index, "error": str(e)})
         return None
 
 # Example usage
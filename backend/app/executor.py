@@ -0,0 +1,125 @@
+import asyncio
+import multiprocessing
+import os
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# 'process' runs hashing in worker processes, 'thread' in a thread pool, 'inline' on the event loop
+cpu_executor_kind = os.getenv('CPU_EXECUTOR', 'process')
+# Number of hashing workers
+cpu_workers = int(os.getenv('CPU_WORKERS', str(os.cpu_count() or 1)))
+# Number of threads for registry searches (numpy releases the GIL during the scan)
+search_workers = int(os.getenv('SEARCH_WORKERS', '4'))
+# Number of threads for blocking web3 calls
+chain_workers = int(os.getenv('CHAIN_WORKERS', '4'))
+# Maximum tasks queued or running per pool before requests are rejected
+max_pending = int(os.getenv('EXECUTOR_MAX_PENDING', '64'))
+
+
+class ExecutorOverloaded(Exception):
+    """Raised when a pool already has `max_pending` tasks queued or running."""
+
+    def __init__(self, pool: str):
+        super().__init__(f"Too many pending {pool} tasks")
+        self.pool = pool
+
+
+class _BoundedPool:
+    """An executor plus a cap on the tasks that may be queued or running in it at once."""
+
+    def __init__(self, name: str, executor: Executor | None, limit: int):
+        self.name = name
+        self.executor = executor
+        self.limit = limit
+        self.pending = 0
+
+    async def run(self, fn, *args):
+        if self.pending >= self.limit:
+            raise ExecutorOverloaded(self.name)
+        self.pending += 1
+        try:
+            if self.executor is None:
+                return fn(*args)
+            return await asyncio.get_running_loop().run_in_executor(self.executor, fn, *args)
+        finally:
+            self.pending -= 1
+
+
+class ExecutionLayer:
+    """
+    Moves blocking work off the asyncio event loop.
+
+    Three bounded pools keep the uvicorn worker responsive while uploads are processed:
+
+        - cpu: perceptual hashing (`hashing.composite_hash`), in a process pool by default so
+          concurrent verifies hash in parallel despite the GIL.
+        - search: registry lookups, in threads because the registry lives in this process and the
+          numpy scan releases the GIL.
+        - chain: blocking web3 calls (transaction submission, receipts, registry syncs).
+
+    Each pool accepts at most `max_pending` queued or running tasks. Beyond that, `ExecutorOverloaded`
+    is raised so the API can answer 503 instead of growing an unbounded backlog.
+
+    Parameters:
+        cpu_kind (str): 'process', 'thread' or 'inline' (run on the event loop, for debugging).
+        cpu_workers (int): Size of the hashing pool.
+        search_workers (int): Size of the search thread pool.
+        chain_workers (int): Size of the web3 thread pool.
+        max_pending (int): Per-pool cap on queued plus running tasks.
+    """
+
+    def __init__(self, cpu_kind: str = 'process', cpu_workers: int = 1, search_workers: int = 4,
+                 chain_workers: int = 4, max_pending: int = 64):
+        if cpu_kind not in ('process', 'thread', 'inline'):
+            raise ValueError(f"Unknown CPU executor: {cpu_kind}")
+        self.cpu_kind = cpu_kind
+        self.cpu_workers = cpu_workers
+        self.search_workers = search_workers
+        self.chain_workers = chain_workers
+        self.max_pending = max_pending
+        self.cpu = self.search = self.chain = None
+
+    def start(self):
+        if self.cpu_kind == 'process':
+            # spawn: workers only import the hashing module, not the web3 client or the hash index
+            cpu_executor = ProcessPoolExecutor(self.cpu_workers, mp_context=multiprocessing.get_context('spawn'))
+        elif self.cpu_kind == 'thread':
+            cpu_executor = ThreadPoolExecutor(self.cpu_workers, thread_name_prefix='cpu')
+        else:
+            cpu_executor = None
+        self.cpu = _BoundedPool('cpu', cpu_executor, self.max_pending)
+        self.search = _BoundedPool('search', ThreadPoolExecutor(self.search_workers, thread_name_prefix='search'),
+                                   self.max_pending)
+        self.chain = _BoundedPool('chain', ThreadPoolExecutor(self.chain_workers, thread_name_prefix='chain'),
+                                  self.max_pending)
+
+    def shutdown(self):
+        for pool in (self.cpu, self.search, self.chain):
+            if pool is not None and pool.executor is not None:
+                pool.executor.shutdown(wait=False, cancel_futures=True)
+        self.cpu = self.search = self.chain = None
+
+    def _require_started(self):
+        if self.cpu is None:
+            self.start()
+
+    async def run_cpu(self, fn, *args):
+        """Run a picklable CPU-bound function (hashing) in the CPU pool."""
+        self._require_started()
+        return await self.cpu.run(fn, *args)
+
+    async def run_search(self, fn, *args):
+        """Run a registry lookup in the search thread pool."""
+        self._require_started()
+        return await self.search.run(fn, *args)
+
+    async def run_chain(self, fn, *args):
+        """Run a blocking web3 call in the chain thread pool."""
+        self._require_started()
+        return await self.chain.run(fn, *args)
+
+
+executor = ExecutionLayer(cpu_executor_kind, cpu_workers=cpu_workers, search_workers=search_workers,
+                          chain_workers=chain_workers, max_pending=max_pending)
@@ -0,0 +1,204 @@
+"""
+Second-stage verification of near misses with ORB keypoint descriptors.
+
+The perceptual hashes miss heavy crops and rotations (experiments/ssim.py: a crop of the sample
+image scores 53% against it, as low as an unrelated photo), while a mutual ratio-test match of
+keypoint descriptors still finds hundreds of correspondences. Descriptors are too expensive to
+compare against the whole registry, so they only arbitrate the few "gray zone" candidates the hash
+scan ranks closest without matching (see `HashMatrix.gray_zone()`):
+
+    1. At publish time, the ORB descriptors of the image are stored in a `FeatureStore`, keyed by
+       the binary form of its registry entry.
+    2. When a verify finds no hash match, the query's descriptors are extracted and matched against
+       the stored descriptors of each candidate, best hash similarity first; enough mutual matches
+       make the image a match.
+
+OpenCV (`opencv-python-headless`, the `features` extra) is only imported when FEATURE_VERIFIER=orb.
+"""
+import os
+import sqlite3
+import threading
+import time
+import numpy as np
+from dotenv import load_dotenv
+from PIL import Image
+from .ingest import open_image
+
+load_dotenv()
+
+# 'orb' enables the feature stage for gray zone candidates, 'off' keeps the hash verdict alone
+feature_verifier_kind = os.getenv('FEATURE_VERIFIER', 'off')
+# SQLite file holding the descriptors of published images
+feature_store_path = os.getenv('FEATURE_STORE_PATH', 'features.db')
+# Candidates must have an average hash similarity above this (%) to be verified
+gray_zone_low = float(os.getenv('FEATURE_GRAY_ZONE_LOW', '52'))
+# At most this many candidates, the closest by hash similarity, are verified per query
+max_candidates = int(os.getenv('FEATURE_MAX_CANDIDATES', '8'))
+# Mutual matches that make a candidate the same image
+min_matches = int(os.getenv('FEATURE_MIN_MATCHES', '25'))
+# Lowe ratio of the match test, in both directions
+match_ratio = float(os.getenv('FEATURE_MATCH_RATIO', '0.75'))
+# ORB keypoints per image, detected on a copy whose longest side is at most this many pixels
+feature_count = int(os.getenv('FEATURE_COUNT', '500'))
+feature_image_size = int(os.getenv('FEATURE_IMAGE_SIZE', '512'))
+# Latency budgets (seconds) of the extraction and matching stages of one query; a stage that runs
+# over leaves the hash verdict in place
+extract_budget = float(os.getenv('FEATURE_EXTRACT_BUDGET', '0.25'))
+match_budget = float(os.getenv('FEATURE_MATCH_BUDGET', '0.25'))
+
+
+def _cv2():
+    try:
+        import cv2
+    except ImportError:
+        raise ImportError("FEATURE_VERIFIER=orb needs OpenCV: install the 'features' extra "
+                          "(opencv-python-headless)") from None
+    return cv2
+
+
+def orb_descriptors(image_data: bytes, nfeatures: int = 500, size: int = 512) -> np.ndarray:
+    """
+    Detects ORB keypoints on a grayscale copy of the image and returns their descriptors.
+
+    Kept free of any app state so it can be shipped to worker processes by the execution layer.
+
+    Parameters:
+        image_data (bytes): The raw image bytes.
+        nfeatures (int): The maximum number of keypoints.
+        size (int): The longest side the image is reduced to before detection.
+
+    Returns:
+        np.ndarray: An (n, 32) uint8 array, one 256-bit binary descriptor per keypoint (n may be 0
+                    for flat images).
+    """
+    cv2 = _cv2()
+    image = open_image(image_data, size)
+    gray = image.convert('L')
+    gray.thumbnail((size, size), Image.Resampling.BILINEAR)
+    _, descriptors = cv2.ORB_create(nfeatures=nfeatures).detectAndCompute(np.asarray(gray), None)
+    if descriptors is None:
+        return np.empty((0, 32), dtype=np.uint8)
+    return descriptors
+
+
+def mutual_matches(descriptors_1: np.ndarray, descriptors_2: np.ndarray, ratio: float = 0.75) -> int:
+    """
+    Counts the descriptor pairs that pass the ratio test in both directions and pick each other,
+    like `feature_matching()` in experiments/ssim.py but with the Hamming norm ORB needs.
+    """
+    if len(descriptors_1) < 2 or len(descriptors_2) < 2:
+        return 0
+    cv2 = _cv2()
+    matcher = cv2.BFMatcher(cv2.NORM_HAMMING)
+
+    def good(query, train):
+        pairs = matcher.knnMatch(query, train, k=2)
+        return {m.queryIdx: m.trainIdx for m, n in (pair for pair in pairs if len(pair) == 2)
+                if m.distance < ratio * n.distance}
+
+    forward = good(descriptors_1, descriptors_2)
+    backward = good(descriptors_2, descriptors_1)
+    return sum(1 for query, train in forward.items() if backward.get(train) == query)
+
+
+class FeatureStore:
+    """
+    Descriptors of published images, in a SQLite file shared by the worker processes (WAL mode).
+
+    Each image takes one row: the binary registry entry it was published as (see
+    `hash_codec.encode_hash()`) and its (n, 32) descriptors as a raw blob, about 16KB for 500
+    keypoints.
+
+    Parameters:
+        path (str): Location of the database file.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS features (entry BLOB PRIMARY KEY, count INTEGER NOT NULL, "
+            "descriptors BLOB NOT NULL)")
+        self._conn.commit()
+
+    def __len__(self) -> int:
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM features").fetchone()[0]
+
+    def put(self, entry: bytes, descriptors: np.ndarray):
+        """Store the descriptors of a published entry, replacing earlier ones."""
+        with self._lock:
+            self._conn.execute("INSERT OR REPLACE INTO features (entry, count, descriptors) VALUES (?, ?, ?)",
+                               (entry, len(descriptors), np.ascontiguousarray(descriptors, dtype=np.uint8).tobytes()))
+            self._conn.commit()
+
+    def get_many(self, entries: list) -> dict:
+        """The stored descriptors of the given entries ({entry: array}); entries without any are left out."""
+        if not entries:
+            return {}
+        with self._lock:
+            rows = self._conn.execute(
+                f"SELECT entry, count, descriptors FROM features WHERE entry IN ({','.join('?' * len(entries))})",
+                entries).fetchall()
+        return {bytes(entry): np.frombuffer(blob, dtype=np.uint8).reshape(count, 32) for entry, count, blob in rows}
+
+
+class FeatureVerifier:
+    """
+    Matches a query's descriptors against the stored descriptors of gray zone candidates.
+
+    Parameters:
+        store (FeatureStore): Where the descriptors of published images are kept.
+        min_matches (int): Mutual matches that make a candidate the same image.
+        ratio (float): Lowe ratio of the match test.
+        budget (float): Seconds after which no further candidate is matched.
+    """
+
+    def __init__(self, store: FeatureStore, min_matches: int = 25, ratio: float = 0.75, budget: float = 0.25):
+        _cv2()
+        self.store = store
+        self.min_matches = min_matches
+        self.ratio = ratio
+        self.budget = budget
+
+    def verify(self, descriptors: np.ndarray, entries: list) -> tuple:
+        """
+        Matches the query against each candidate in turn, stopping at the first one with enough
+        mutual matches or once the budget is spent.
+
+        Parameters:
+            descriptors (np.ndarray): The query's descriptors (see `orb_descriptors()`).
+            entries (list[bytes]): The binary registry entries of the candidates, best first.
+
+        Returns:
+            tuple[str, bytes | None]: The outcome ("match", "no_match", "budget_exceeded" or
+                                      "no_descriptors" when none of the candidates has stored
+                                      descriptors) and the matching entry.
+        """
+        stored = self.store.get_many(entries)
+        if not stored:
+            return "no_descriptors", None
+        deadline = time.monotonic() + self.budget
+        for entry in entries:
+            if entry not in stored:
+                continue
+            if time.monotonic() > deadline:
+                return "budget_exceeded", None
+            if mutual_matches(descriptors, stored[entry], self.ratio) >= self.min_matches:
+                return "match", entry
+        return "no_match", None
+
+
+def create_verifier(kind: str) -> FeatureVerifier | None:
+    """Build the verifier selected by `FEATURE_VERIFIER`."""
+    if kind == 'off':
+        return None
+    if kind == 'orb':
+        return FeatureVerifier(FeatureStore(feature_store_path), min_matches=min_matches, ratio=match_ratio,
+                               budget=match_budget)
+    raise ValueError(f"Unknown feature verifier: {kind}")
+
+
+feature_verifier = create_verifier(feature_verifier_kind)
@@ -0,0 +1,183 @@
+"""
+Binary encoding of composite perceptual hashes for on-chain storage.
+
+Legacy entries are ASCII strings "ahash#dhash#phash" (three 64-character hex hashes, 194 bytes).
+The binary format stores the same bits as
+
+    version (1 byte) | ahash (32 bytes) | dhash (32 bytes) | phash (32 bytes)
+
+i.e. a packed bytes96 payload behind a one-byte format version, 97 bytes in total. Bits are packed
+MSB first in the same order as the hex strings, so decoding is a zero-copy `np.frombuffer`.
+
+The version byte names the hash generation (`HashVersion`) the entry was computed with: its hash
+size and algorithms. Version 1 is the original 16x16 generation; its strings carry no marker, so
+the entries already on-chain stay valid. Strings of any other version start with "<version>:", e.g.
+"2:ahash#dhash#phash" for the 8x8 hashes. Entries of different versions are never compared with
+each other.
+"""
+from dataclasses import dataclass
+import numpy as np
+
+HASH_TYPES = ('ahash', 'dhash', 'phash')
+
+
+@dataclass(frozen=True)
+class HashVersion:
+    """Descriptor of a hash generation: how the hashes of an entry carrying `version` were computed."""
+    version: int
+    hash_size: int
+    algorithms: tuple = HASH_TYPES
+
+    @property
+    def nbits(self) -> int:
+        """The number of bits of each individual hash."""
+        return self.hash_size * self.hash_size
+
+
+# Format version 1: three 16x16 hashes (256 bits each), ahash/dhash/phash order
+FORMAT_V1 = 1
+# Format version 2: three 8x8 hashes (64 bits each), a cheap pre-filter generation
+FORMAT_V2 = 2
+VERSIONS = {FORMAT_V1: HashVersion(FORMAT_V1, 16), FORMAT_V2: HashVersion(FORMAT_V2, 8)}
+FORMAT_NBITS = {version: descriptor.nbits for version, descriptor in VERSIONS.items()}
+
+
+def split_version(hash_string: str) -> tuple:
+    """
+    Splits the "<version>:" marker off a hash string.
+
+    Returns:
+        tuple[int | None, str]: The version (None for an unmarked string) and the "ahash#dhash#phash" part.
+    """
+    marker, separator, hashes = hash_string.rpartition(':')
+    if not separator:
+        return None, hash_string
+    try:
+        return int(marker), hashes
+    except ValueError:
+        raise ValueError(f"Invalid hash version marker {marker!r}.")
+
+
+def version_of(entry) -> int:
+    """
+    The hash version of a registry entry in either format. Unmarked strings are version 1, or the
+    version whose hash size they match for strings written before versions existed.
+
+    Raises:
+        ValueError: If the entry is empty, its version is unknown or an unmarked string matches none.
+    """
+    if isinstance(entry, str):
+        version, hashes = split_version(entry)
+        if version is None:
+            nbits = len(hashes.split('#')[0]) * 4
+            version = next((v for v, descriptor in VERSIONS.items() if descriptor.nbits == nbits), None)
+            if version is None:
+                raise ValueError(f"No hash version has {nbits}-bit hashes.")
+    else:
+        if not entry:
+            raise ValueError("Empty hash entry.")
+        version = entry[0]
+    if version not in VERSIONS:
+        raise ValueError(f"Unknown hash format version {version}.")
+    return version
+
+
+def format_hash_string(version: int, hashes) -> str:
+    """Formats the hex hashes of one version as a registry string (marked unless version 1)."""
+    hash_string = '#'.join(hashes)
+    return hash_string if version == FORMAT_V1 else f"{version}:{hash_string}"
+
+
+def join_hashes(hashes: dict) -> str:
+    """Joins the hash strings of several versions of one image, e.g. to cache them, in one string."""
+    return ' '.join(hashes.values())
+
+
+def split_hashes(text: str) -> dict:
+    """Inverse of `join_hashes()`: {version: hash string}. A single hash string is accepted too."""
+    return {version_of(hash_string): hash_string for hash_string in text.split(' ')}
+
+
+def decode_legacy(hash_string: str, nbits: int = 256) -> np.ndarray:
+    """
+    Decodes a legacy "ahash#dhash#phash" hex string into a packed bit matrix.
+
+    Parameters:
+        hash_string (str): The concatenated hash string produced by `calculate_image_hash()`, with
+                           or without a version marker.
+        nbits (int): The number of bits of each individual hash (hash_size * hash_size, 256 by default).
+
+    Returns:
+        np.ndarray: A (3, nbits / 8) uint8 array, one row per hash type, with bits packed MSB first
+                    (the same bit order `imagehash.hex_to_hash()` uses).
+
+    Raises:
+        ValueError: If the string does not contain exactly three hashes of `nbits` bits each.
+    """
+    parts = split_version(hash_string)[1].split('#')
+    if len(parts) != len(HASH_TYPES):
+        raise ValueError(f"Expected 3 hash values, but got {len(parts)} values.")
+    if any(len(part) * 4 != nbits for part in parts):
+        raise ValueError(f"Expected {nbits}-bit hashes, got {[len(part) * 4 for part in parts]}.")
+    return np.frombuffer(bytes.fromhex(''.join(parts)), dtype=np.uint8).reshape(len(HASH_TYPES), nbits // 8)
+
+
+def decode_packed(entry: bytes, nbits: int = 256) -> np.ndarray:
+    """
+    Decodes a versioned binary entry into a (3, nbits / 8) packed bit matrix without copying.
+
+    Raises:
+        ValueError: If the version is unknown, does not carry `nbits`-bit hashes, or the length is wrong.
+    """
+    if not entry:
+        raise ValueError("Empty hash entry.")
+    version = entry[0]
+    if version not in FORMAT_NBITS:
+        raise ValueError(f"Unknown hash format version {version}.")
+    if FORMAT_NBITS[version] != nbits:
+        raise ValueError(f"Expected {nbits}-bit hashes, got version {version} with {FORMAT_NBITS[version]}.")
+    nbytes = nbits // 8
+    if len(entry) != 1 + len(HASH_TYPES) * nbytes:
+        raise ValueError(f"Expected {1 + len(HASH_TYPES) * nbytes} bytes, got {len(entry)}.")
+    return np.frombuffer(entry, dtype=np.uint8, offset=1).reshape(len(HASH_TYPES), nbytes)
+
+
+def decode_entry(entry, nbits: int = 256) -> np.ndarray:
+    """Decodes a registry entry in either format: binary (bytes) or legacy (str)."""
+    if isinstance(entry, str):
+        return decode_legacy(entry, nbits)
+    return decode_packed(bytes(entry), nbits)
+
+
+def encode_hash(hash_string: str) -> bytes:
+    """
+    Encodes a composite "ahash#dhash#phash" string into the versioned binary format, under the
+    string's version (see `version_of()`).
+
+    Raises:
+        ValueError: If the string is not three hex hashes of a known version.
+    """
+    version = version_of(hash_string)
+    return bytes([version]) + decode_legacy(hash_string, FORMAT_NBITS[version]).tobytes()
+
+
+def to_hash_string(entry) -> str:
+    """Formats a registry entry in either format as a "ahash#dhash#phash" string (see `format_hash_string()`)."""
+    if isinstance(entry, str):
+        return entry
+    version = version_of(entry)
+    rows = decode_packed(bytes(entry), FORMAT_NBITS[version])
+    return format_hash_string(version, (row.tobytes().hex() for row in rows))
+
+
+def normalize_entry(entry) -> bytes | str:
+    """
+    Returns the binary form of an entry when it can be decoded, so that the same hash stored in
+    either format compares equal. Undecodable legacy strings are returned unchanged.
+    """
+    if isinstance(entry, str):
+        try:
+            return encode_hash(entry)
+        except ValueError:
+            return entry
+    return bytes(entry)
@@ -0,0 +1,344 @@
+import os
+import sqlite3
+import threading
+import time
+from itertools import islice
+import numpy as np
+from dotenv import load_dotenv
+from .registry import registry, registry_backend, HashRegistry, LEGACY_SOURCE, PACKED_SOURCE, TABLES
+from .hash_codec import normalize_entry, to_hash_string, version_of, VERSIONS
+from .similarity import HashMatrix
+from .log import get_logger
+from .metrics import STAGE_SECONDS, INCOMPATIBLE_HASHES
+from .shared_matrix import SharedHashMatrix
+from .merkle import merkle_log, MerkleLog
+
+load_dotenv()
+log = get_logger('hash_index')
+
+# Local SQLite mirror of the registry's `hashes` (and `packedHashes`) arrays. An in-memory registry
+# starts empty on every run, so its mirror does not outlive the process either.
+index_path = os.getenv('HASH_INDEX_PATH', ':memory:' if registry_backend == 'memory' else 'hash_index.db')
+# Maximum age (seconds) of the mirror before a read forces a synchronous sync
+max_staleness = float(os.getenv('HASH_INDEX_MAX_STALENESS', '30'))
+# Interval (seconds) between background syncs
+refresh_interval = float(os.getenv('HASH_INDEX_REFRESH_INTERVAL', '10'))
+# Number of fetched entries written per SQLite transaction
+sync_batch_size = int(os.getenv('HASH_INDEX_SYNC_BATCH_SIZE', '500'))
+# On-chain hash format: 'string' (legacy `hashes` only) or 'packed' (also mirror `packedHashes`)
+hash_format = os.getenv('HASH_FORMAT', 'string')
+# Hash versions (see hash_codec.VERSIONS) computed for every upload and searched, each in its own
+# partition of the index. The first one is the version new entries are published in.
+hash_versions = [int(version) for version in os.getenv('HASH_VERSIONS', '1').split(',')]
+# Control file of a hash matrix shared by all worker processes of the host (disabled when empty),
+# e.g. /dev/shm/pxlproof-hash-matrix when running `uvicorn --workers N`
+shared_matrix_path = os.getenv('SHARED_MATRIX_PATH', '')
+
+
+class HashIndex:
+    """
+    Persistent, incrementally synced mirror of the hash registry.
+
+    The registry is append-only, so the mirror only needs to know how many entries it has already
+    seen. A sync asks the registry for its `count()` and fetches the missing tail with
+    `iter_since()` (on-chain: `getTotalHashes()` and the indexed `hashes(i)` getter), instead of
+    downloading the whole array through `getAllHashes()` on every request. With `packed=True` the
+    binary `packedHashes` array (see `hash_codec`) is mirrored the same way.
+
+    Parameters:
+        path (str): Location of the SQLite database holding the mirrored entries.
+        registry (HashRegistry): The registry to mirror (see registry.py).
+        max_staleness (float): Maximum age, in seconds, of the mirror before `get_hashes()` syncs
+                               synchronously. Use 0 to always sync before reading.
+        refresh_interval (float): Interval, in seconds, between background syncs once
+                                  `start_refresher()` has been called.
+        packed (bool): Also mirror the binary `packedHashes` array.
+        shared_path (str): Keep the hash matrix in a `SharedHashMatrix` at this path, shared by every
+                           worker process of the host. Only the process holding the writer lock (the
+                           leader) syncs with the registry and loads the SQLite mirror; the others map
+                           the leader's matrix read-only and take over if the leader exits.
+        versions (list[int]): The hash versions searched (see `hash_codec.VERSIONS`), primary first.
+        merkle (MerkleLog): Also append every mirrored entry to this Merkle tree (see merkle.py). The
+                            leader passes its whole mirror when it loads, which rebuilds a missing tree.
+
+    The hash matrices are partitioned by hash version: entries of each version go to their own
+    `HashMatrix`, keyed by version in `matrices`, and a query is only compared with the partition of
+    its own version. `matrix` is the primary version's partition.
+    Entries of a version that is not searched are counted as incompatible, like undecodable ones.
+    """
+
+    def __init__(self, path: str, registry: HashRegistry, max_staleness: float = 30.0,
+                 refresh_interval: float = 10.0, packed: bool = False,
+                 shared_path: str = '', versions=(1,), merkle: MerkleLog = None):
+        self.path = path
+        self.registry = registry
+        self.max_staleness = max_staleness
+        self.refresh_interval = refresh_interval
+        self.sources = [LEGACY_SOURCE, PACKED_SOURCE] if packed else [LEGACY_SOURCE]
+        unknown = [version for version in versions if version not in VERSIONS]
+        if unknown or not versions:
+            raise ValueError(f"Unknown hash versions: {unknown or versions}")
+        self.versions = list(versions)
+        self.merkle = merkle
+        self.last_synced = 0.0
+
+        self._lock = threading.Lock()
+        self._sync_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._refresher = None
+
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        if shared_path:
+            # The leader writes while the other workers read
+            self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS hashes (position INTEGER PRIMARY KEY, hash TEXT NOT NULL)")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS packed_hashes (position INTEGER PRIMARY KEY, hash BLOB NOT NULL)")
+        self._conn.commit()
+
+        # Pre-decoded bit matrices used by search_image(), one per hash version
+        self.shared = bool(shared_path)
+        self.matrices = {}
+        for version in self.versions:
+            nbits = VERSIONS[version].nbits
+            if self.shared:
+                # The primary partition keeps the unsuffixed path of the single-version layout
+                path = shared_path if version == self.versions[0] else f"{shared_path}-v{version}"
+                self.matrices[version] = SharedHashMatrix(path, nbits=nbits)
+            else:
+                self.matrices[version] = HashMatrix(nbits=nbits)
+        self.matrix = self.matrices[self.versions[0]]
+
+        # In-memory copy of each table, ordered by on-chain position (leader only)
+        self._entries = {source: [] for source in self.sources}
+        # Every entry in binary form, so a hash is found whichever format it was stored in
+        self._known = set()
+        self.leader = False
+        self._try_lead()
+
+    def __len__(self) -> int:
+        if not self.leader:
+            return sum(len(matrix) + matrix.skipped for matrix in self.matrices.values())
+        return sum(len(entries) for entries in self._entries.values())
+
+    def _acquire_writers(self) -> bool:
+        """Take the writer lock of every shared partition, the primary one deciding who leads."""
+        if not self.matrix.acquire_writer():
+            return False
+        for matrix in self.matrices.values():
+            # Held by a leader that is still exiting, which also released the primary lock
+            for _ in range(50):
+                if matrix.acquire_writer():
+                    break
+                time.sleep(0.01)
+            else:
+                for held in self.matrices.values():
+                    held.close()
+                return False
+        return True
+
+    def _try_lead(self) -> bool:
+        """
+        Become the process that loads and syncs the mirror: always without a shared matrix, and only
+        once the writer lock is free with one.
+        """
+        if self.leader:
+            return True
+        if self.shared and not self._acquire_writers():
+            return False
+        with self._sync_lock:
+            if self.shared:
+                # Readers keep the previous leader's rows until the reload is published
+                for matrix in self.matrices.values():
+                    matrix.begin_rebuild()
+            for source in self.sources:
+                table = TABLES[source]
+                rows = self._conn.execute(f"SELECT hash FROM {table} ORDER BY position").fetchall()
+                self._add_entries(source, 0, [row[0] for row in rows])
+            if self.shared:
+                for matrix in self.matrices.values():
+                    matrix.end_rebuild()
+            self.leader = True
+        return True
+
+    def _partition_of(self, entry) -> int:
+        """The version partition an entry is searched in; the primary one (which skips it) if none."""
+        try:
+            version = version_of(entry)
+        except ValueError:
+            return self.versions[0]
+        return version if version in self.matrices else self.versions[0]
+
+    def _add_entries(self, source: int, position: int, entries: list):
+        with self._lock:
+            self._entries[source].extend(entries)
+            self._known.update(normalize_entry(entry) for entry in entries)
+            added = 0
+            # Consecutive entries of the same version are appended together
+            start = 0
+            while start < len(entries):
+                version = self._partition_of(entries[start])
+                stop = start + 1
+                while stop < len(entries) and self._partition_of(entries[stop]) == version:
+                    stop += 1
+                run = entries[start:stop]
+                added += self.matrices[version].append(run, start_position=position + start, source=source)
+                start = stop
+            if added < len(entries):
+                INCOMPATIBLE_HASHES.inc(len(entries) - added, where="registry")
+        if self.merkle is not None:
+            self.merkle.extend(source, position, entries)
+
+    def _sync_source(self, source: int) -> int | None:
+        """Sync one registry array. Returns None if the sync could not reach the registry's count."""
+        table = TABLES[source]
+        total = self.registry.count(source)
+        if total is None:
+            # Registry unreachable, keep serving the current mirror
+            return None
+
+        added = 0
+        position = len(self._entries[source])
+        entries = self.registry.iter_since(position, source, total)
+        while position < total:
+            expected = min(sync_batch_size, total - position)
+            batch = list(islice(entries, expected))
+            if not batch:
+                return None
+
+            self._conn.executemany(f"INSERT OR REPLACE INTO {table} (position, hash) VALUES (?, ?)",
+                                   [(position + offset, entry) for offset, entry in enumerate(batch)])
+            self._conn.commit()
+            self._add_entries(source, position, batch)
+            position += len(batch)
+            added += len(batch)
+
+            if position < total and len(batch) < expected:
+                # A single read failed, retry on the next sync
+                return None
+        return added
+
+    def sync(self) -> int:
+        """
+        Fetch every registry entry past the last position already mirrored.
+
+        Returns:
+            int: The number of new entries appended to the mirror.
+
+        Entries are committed in batches of `sync_batch_size`, so an interrupted sync resumes from
+        the last committed position instead of starting over. A follower of a shared index does not
+        talk to the registry: it takes over if the leader is gone, and otherwise just picks up what
+        the leader has published.
+        """
+        if not self._try_lead():
+            before = len(self)
+            for matrix in self.matrices.values():
+                matrix.refresh()
+            return len(self) - before
+        with self._sync_lock, STAGE_SECONDS.time(stage="registry_fetch"):
+            added = 0
+            complete = True
+            for source in self.sources:
+                source_added = self._sync_source(source)
+                if source_added is None:
+                    complete = False
+                else:
+                    added += source_added
+            if complete:
+                self.last_synced = time.monotonic()
+                if self.shared:
+                    for matrix in self.matrices.values():
+                        matrix.mark_synced()
+            return added
+
+    def entry_at(self, source: int, position: int) -> str | bytes | None:
+        """The mirrored entry at a registry position, or None if it has not been mirrored (yet)."""
+        row = self._conn.execute(f"SELECT hash FROM {TABLES[source]} WHERE position = ?", (position,)).fetchone()
+        return None if row is None else row[0]
+
+    def sizes(self) -> dict:
+        """Number of mirrored entries per registry source."""
+        if not self.leader:
+            counts = sum(np.bincount(matrix.sources, minlength=max(self.sources) + 1)
+                         for matrix in self.matrices.values())
+            return {source: int(counts[source]) for source in self.sources}
+        return {source: len(self._entries[source]) for source in self.sources}
+
+    def has_synced(self) -> bool:
+        """True once a sync (by this process, or by the leader of a shared index) has reached the registry."""
+        if not self.leader:
+            return self.matrix.last_synced > 0
+        return self.last_synced > 0
+
+    def is_stale(self) -> bool:
+        return time.monotonic() - self.last_synced > self.max_staleness
+
+    def ensure_fresh(self):
+        """
+        Sync synchronously if the mirror is older than `max_staleness`. Followers of a shared index
+        only map the rows the leader published since the last call, which costs a header read.
+        """
+        if not self.leader:
+            self.sync()
+        elif self.is_stale():
+            self.sync()
+
+    def get_hashes(self) -> list:
+        """
+        Return all mirrored hashes as "ahash#dhash#phash" strings, syncing first if the mirror is
+        older than `max_staleness`.
+        """
+        self.ensure_fresh()
+        if not self.leader:
+            return [to_hash_string(row[0]) for source in self.sources
+                    for row in self._conn.execute(f"SELECT hash FROM {TABLES[source]} ORDER BY position")]
+        with self._lock:
+            return [to_hash_string(entry) for source in self.sources for entry in self._entries[source]]
+
+    def get_matrices(self) -> dict:
+        """
+        Return the decoded hash matrix of each version partition ({version: HashMatrix}, primary
+        first), syncing first if the mirror is older than `max_staleness`.
+        """
+        self.ensure_fresh()
+        return self.matrices
+
+    def contains(self, hash_entry) -> bool:
+        """
+        Exact-match lookup against the mirror (replacement for the `getAllHashes()` duplicate check).
+        Accepts the hash in either format.
+        """
+        self.ensure_fresh()
+        if not self.leader:
+            try:
+                return self.matrices[self._partition_of(hash_entry)].contains(hash_entry)
+            except ValueError:
+                return False
+        return normalize_entry(hash_entry) in self._known
+
+    def _refresh_loop(self):
+        while not self._stop.wait(self.refresh_interval):
+            try:
+                self.sync()
+            except Exception as e:
+                log.error("Error refreshing hash index", extra={"error": str(e)})
+
+    def start_refresher(self):
+        """Start a daemon thread that syncs the mirror every `refresh_interval` seconds."""
+        if self._refresher is not None and self._refresher.is_alive():
+            return
+        self._stop.clear()
+        self._refresher = threading.Thread(target=self._refresh_loop, name="hash-index-refresher", daemon=True)
+        self._refresher.start()
+
+    def stop_refresher(self):
+        self._stop.set()
+        if self._refresher is not None:
+            self._refresher.join(timeout=self.refresh_interval)
+            self._refresher = None
+
+
+hash_index = HashIndex(index_path, registry, max_staleness=max_staleness, refresh_interval=refresh_interval,
+                       packed=hash_format == 'packed', shared_path=shared_matrix_path,
+                       versions=hash_versions, merkle=merkle_log)
@@ -0,0 +1,212 @@
+import itertools
+import os
+import time
+import numpy as np
+import scipy.fftpack
+import imagehash
+from PIL import Image, ImageSequence
+from dotenv import load_dotenv
+from .ingest import open_image
+from .hash_codec import HASH_TYPES, VERSIONS, FORMAT_V1, format_hash_string
+
+load_dotenv()
+
+# imagehash resizes with LANCZOS (its ANTIALIAS alias)
+RESAMPLE = Image.Resampling.LANCZOS
+# phash resizes to hash_size * highfreq_factor before the DCT
+PHASH_HIGHFREQ_FACTOR = 4
+# Decode and keep a working image of at least this many times the largest hash input (0 disables)
+working_scale = int(os.getenv('HASH_WORKING_SCALE', '4'))
+# Frames of an animation decoded per request, and how many of them are hashed at most
+max_frames = int(os.getenv('ANIMATION_MAX_FRAMES', '120'))
+max_keyframes = int(os.getenv('ANIMATION_MAX_KEYFRAMES', '32'))
+# Mean absolute difference (0-255) between the 16x16 grayscale thumbnails of a frame and of the last
+# keyframe above which the frame starts a new scene and is hashed
+scene_change_threshold = float(os.getenv('SCENE_CHANGE_THRESHOLD', '12'))
+
+# Side of the thumbnails frames are compared with for scene changes
+SCENE_SIGNATURE_SIZE = 16
+
+
+def working_size(hash_size: int = 16, scale: int = None) -> int:
+    """
+    The side the working image of `hash_size` hashes is kept at: `scale` times the largest hash input
+    (the phash DCT input, hash_size * 4 pixels). 0 means full resolution.
+    """
+    if scale is None:
+        scale = working_scale
+    return hash_size * PHASH_HIGHFREQ_FACTOR * scale
+
+
+def working_image(image: Image.Image, hash_size: int = 16, scale: int = None) -> Image.Image:
+    """
+    Decodes an image once into the grayscale working image all three hashes are derived from.
+
+    Parameters:
+        image (Image.Image): An image opened with `ingest.open_image(data, working_size(hash_size))`
+                             (pixels not decoded yet), or a frame of an animation.
+        hash_size (int): The hash size the working image has to serve.
+        scale (int): How many times larger than the largest hash input (the phash DCT input,
+                     hash_size * 4 pixels) the working image is kept. 0 decodes at full resolution,
+                     which makes the hashes bit-identical to the independent imagehash calls.
+
+    Returns:
+        Image.Image: A mode "L" image.
+
+    Steps:
+        1. `open_image()` has already asked the JPEG decoder for a grayscale, DCT-domain downscaled
+           image (`Image.draft`), so a 24MP upload is never decoded at full resolution, and checked
+           that size against the pixel budget (`MAX_IMAGE_PIXELS`).
+        2. Convert to "L" once (a no-op if the draft already produced grayscale).
+        3. Box-reduce by the largest integer factor that keeps the image above the working size.
+
+    With the default scale of 4 the working image is at least 256x256 for hash_size=16, and the hashes
+    of the sample images in experiments/ differ from the full-resolution ones by at most 3 bits per
+    256-bit hash (under 1.2% similarity), far inside the 80% matching threshold.
+    """
+    target = working_size(hash_size, scale)
+    gray = image.convert('L')
+    if target > 0:
+        factor = min(gray.size) // target
+        if factor > 1:
+            gray = gray.reduce(factor)
+    return gray
+
+
+def fused_image_hash(image: Image.Image, hash_size: int = 16, scale: int = None) -> tuple:
+    """
+    Computes the average, difference and perceptual hashes from a single decode.
+
+    Each hash is computed exactly the way `imagehash.average_hash`, `imagehash.dhash` and
+    `imagehash.phash` compute it, but from one shared grayscale working image (see `working_image()`)
+    instead of three separate grayscale conversions and full-resolution resizes.
+
+    Returns:
+        tuple[imagehash.ImageHash, imagehash.ImageHash, imagehash.ImageHash]: (ahash, dhash, phash).
+    """
+    if hash_size < 2:
+        raise ValueError('Hash size must be greater than or equal to 2')
+    return _hashes_from_working(working_image(image, hash_size, scale), hash_size)
+
+
+def _ahash(gray: Image.Image, hash_size: int) -> imagehash.ImageHash:
+    pixels = np.asarray(gray.resize((hash_size, hash_size), RESAMPLE))
+    return imagehash.ImageHash(pixels > np.mean(pixels))
+
+
+def _dhash(gray: Image.Image, hash_size: int) -> imagehash.ImageHash:
+    pixels = np.asarray(gray.resize((hash_size + 1, hash_size), RESAMPLE))
+    return imagehash.ImageHash(pixels[:, 1:] > pixels[:, :-1])
+
+
+def _phash(gray: Image.Image, hash_size: int) -> imagehash.ImageHash:
+    img_size = hash_size * PHASH_HIGHFREQ_FACTOR
+    pixels = np.asarray(gray.resize((img_size, img_size), RESAMPLE))
+    dct = scipy.fftpack.dct(scipy.fftpack.dct(pixels, axis=0), axis=1)
+    dctlowfreq = dct[:hash_size, :hash_size]
+    return imagehash.ImageHash(dctlowfreq > np.median(dctlowfreq))
+
+
+# Hash algorithms a `HashVersion` can name
+ALGORITHMS = {'ahash': _ahash, 'dhash': _dhash, 'phash': _phash}
+
+
+def _hashes_from_working(gray: Image.Image, hash_size: int, algorithms: tuple = HASH_TYPES) -> tuple:
+    return tuple(ALGORITHMS[algorithm](gray, hash_size) for algorithm in algorithms)
+
+
+def composite_hash(image_data: bytes, hash_size: int = 16) -> str:
+    """
+    Returns the "ahash#dhash#phash" string for raw image bytes.
+
+    Kept free of any app state so it can be shipped to worker processes by the execution layer.
+    """
+    image = open_image(image_data, working_size(hash_size))
+    ahash, dhash, phash = fused_image_hash(image, hash_size)
+    return str(ahash) + "#" + str(dhash) + "#" + str(phash)
+
+
+def timed_composite_hashes(image_data: bytes, versions=(FORMAT_V1,)) -> tuple:
+    """
+    Computes the registry hash string of every given hash version from a single decode, and
+    reports where the time went, for the latency metrics.
+
+    The working image is sized for the largest hash size of the versions; the smaller hashes are
+    resized from the same image.
+
+    Parameters:
+        image_data (bytes): The raw image bytes.
+        versions (list[int]): Hash versions to compute (see `hash_codec.VERSIONS`).
+
+    Returns:
+        tuple[dict, float, float]: {version: hash string} in the order of `versions`, the seconds
+                                   spent decoding the working image and the seconds spent hashing.
+    """
+    descriptors = [VERSIONS[version] for version in versions]
+    start = time.perf_counter()
+    hash_size = max(descriptor.hash_size for descriptor in descriptors)
+    gray = working_image(open_image(image_data, working_size(hash_size)), hash_size)
+    decoded = time.perf_counter()
+    return _version_hashes(gray, descriptors), decoded - start, time.perf_counter() - decoded
+
+
+def _version_hashes(gray: Image.Image, descriptors: list) -> dict:
+    hashes = {}
+    for descriptor in descriptors:
+        computed = _hashes_from_working(gray, descriptor.hash_size, descriptor.algorithms)
+        hashes[descriptor.version] = format_hash_string(descriptor.version, (str(h) for h in computed))
+    return hashes
+
+
+def scene_signature(frame: Image.Image) -> np.ndarray:
+    """A 16x16 grayscale thumbnail of a frame, for the scene change test of `hash_keyframes()`."""
+    size = (SCENE_SIGNATURE_SIZE, SCENE_SIGNATURE_SIZE)
+    return np.asarray(frame.convert('L').resize(size, Image.Resampling.BOX, reducing_gap=2.0), dtype=np.float32)
+
+
+def hash_keyframes(image_data: bytes, versions=(FORMAT_V1,), start: int = 0, count: int = 1,
+                   reference: np.ndarray = None, frame_limit: int = 120,
+                   threshold: float = 12.0) -> tuple:
+    """
+    Hashes the next keyframes of an animated image (GIF, WebP, APNG), resuming where an earlier call
+    stopped, so the caller can search each batch and stop at the first match.
+
+    Frames are decoded one at a time with `ImageSequence`, and only their 16x16 signature outlives
+    the loop iteration. A frame is a keyframe when its signature differs from the last keyframe's by
+    more than `threshold` (see `scene_signature()`); the frames in between repeat a scene that was
+    hashed already. Frame 0 only sets the first reference: its hashes are the upload's composite
+    hash, which is searched before any frame is. Kept free of any app state so it can be shipped to
+    worker processes by the execution layer.
+
+    Parameters:
+        image_data (bytes): The raw image bytes.
+        versions (list[int]): Hash versions to compute (see `hash_codec.VERSIONS`).
+        start (int): The first frame to decode, the `next_frame` of the previous call.
+        count (int): The number of keyframes to hash before returning.
+        reference (np.ndarray): The signature of the last keyframe, from the previous call.
+        frame_limit (int): Frames past this index are never decoded.
+        threshold (float): The scene change threshold.
+
+    Returns:
+        tuple[list, int, np.ndarray, bool]: The keyframes as (frame index, {version: hash string})
+                                            pairs, the frame to resume from, the reference signature
+                                            to resume with, and whether the animation (or the frame
+                                            limit) is exhausted.
+    """
+    descriptors = [VERSIONS[version] for version in versions]
+    hash_size = max(descriptor.hash_size for descriptor in descriptors)
+    image = open_image(image_data)
+    keyframes = []
+    # Seeking decodes the frames before `start` again: GIF and APNG frames build on their predecessors
+    frames = itertools.islice(ImageSequence.Iterator(image), start, max(start, frame_limit))
+    for index, frame in enumerate(frames, start):
+        signature = scene_signature(frame)
+        if reference is not None and np.abs(signature - reference).mean() <= threshold:
+            continue
+        reference = signature
+        if index == 0:
+            continue
+        keyframes.append((index, _version_hashes(working_image(frame, hash_size), descriptors)))
+        if len(keyframes) == count:
+            return keyframes, index + 1, reference, index + 1 >= frame_limit
+    return keyframes, max(start, frame_limit), reference, True
@@ -0,0 +1,213 @@
+import io
+import os
+import struct
+from PIL import Image
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# Bytes read from the start of the upload for JPEG/PNG/WebP headers
+probe_bytes = int(os.getenv('PROBE_BYTES', str(64 * 1024)))
+# Bytes a GIF is walked through while looking for a second frame
+gif_probe_limit = int(os.getenv('GIF_PROBE_LIMIT', str(1024 * 1024)))
+
+# JPEG start-of-frame markers (SOF0-SOF15 except DHT, JPG and DAC)
+_JPEG_SOF = {0xC0, 0xC1, 0xC2, 0xC3, 0xC5, 0xC6, 0xC7, 0xC9, 0xCA, 0xCB, 0xCD, 0xCE, 0xCF}
+# Mode Pillow reports for a JPEG by component count
+_JPEG_MODES = {1: 'L', 3: 'RGB', 4: 'CMYK'}
+# Mode Pillow reports for a PNG by (colour type, bit depth)
+_PNG_MODES = {
+    (0, 1): '1', (0, 2): 'L', (0, 4): 'L', (0, 8): 'L', (0, 16): 'I;16',
+    (2, 8): 'RGB', (2, 16): 'RGB',
+    (3, 1): 'P', (3, 2): 'P', (3, 4): 'P', (3, 8): 'P',
+    (4, 8): 'LA', (4, 16): 'RGBA',
+    (6, 8): 'RGBA', (6, 16): 'RGBA',
+}
+
+
+class ProbeError(ValueError):
+    """Raised when the header of a supported container is malformed."""
+
+
+def _probe_jpeg(head: bytes) -> dict | None:
+    """Walks the JPEG marker segments up to the start-of-frame header."""
+    offset = 2
+    while offset + 4 <= len(head):
+        if head[offset] != 0xFF:
+            raise ProbeError("Invalid JPEG marker")
+        marker = head[offset + 1]
+        if marker == 0xFF:
+            # Fill byte
+            offset += 1
+            continue
+        if marker in (0xD8, 0x01) or 0xD0 <= marker <= 0xD7:
+            # Markers without a length
+            offset += 2
+            continue
+        length = struct.unpack('>H', head[offset + 2:offset + 4])[0]
+        if marker in _JPEG_SOF:
+            if offset + 10 > len(head):
+                return None
+            height, width, components = struct.unpack('>HHB', head[offset + 5:offset + 10])
+            return {"format": "JPEG", "size": (width, height), "mode": _JPEG_MODES.get(components),
+                    "is_animated": False}
+        offset += 2 + length
+    return None
+
+
+def _probe_png(head: bytes) -> dict | None:
+    """Reads IHDR, then looks for an APNG acTL chunk before the first IDAT."""
+    if len(head) < 33 or head[12:16] != b'IHDR':
+        raise ProbeError("PNG without IHDR")
+    width, height, bit_depth, colour_type = struct.unpack('>IIBB', head[16:26])
+    result = {"format": "PNG", "size": (width, height), "mode": _PNG_MODES.get((colour_type, bit_depth)),
+              "is_animated": False}
+    offset = 8
+    while offset + 8 <= len(head):
+        length, chunk_type = struct.unpack('>I4s', head[offset:offset + 8])
+        if chunk_type == b'acTL':
+            if offset + 12 > len(head):
+                return None
+            result["is_animated"] = struct.unpack('>I', head[offset + 8:offset + 12])[0] > 1
+            return result
+        if chunk_type in (b'IDAT', b'IEND'):
+            return result
+        offset += 12 + length
+    # acTL may still follow beyond the probed bytes
+    return None
+
+
+def _probe_webp(head: bytes) -> dict | None:
+    """Reads the first chunk of a RIFF/WEBP container (VP8, VP8L or VP8X)."""
+    if len(head) < 30:
+        return None
+    chunk = head[12:16]
+    data = head[20:]
+    if chunk == b'VP8X':
+        flags = data[0]
+        width = int.from_bytes(data[4:7], 'little') + 1
+        height = int.from_bytes(data[7:10], 'little') + 1
+        return {"format": "WEBP", "size": (width, height), "mode": 'RGBA' if flags & 0x10 else 'RGB',
+                "is_animated": bool(flags & 0x02)}
+    if chunk == b'VP8 ':
+        if data[3:6] != b'\x9d\x01\x2a':
+            raise ProbeError("Invalid VP8 frame header")
+        width, height = struct.unpack('<HH', data[6:10])
+        return {"format": "WEBP", "size": (width & 0x3FFF, height & 0x3FFF), "mode": 'RGB',
+                "is_animated": False}
+    if chunk == b'VP8L':
+        if data[0] != 0x2F:
+            raise ProbeError("Invalid VP8L signature")
+        bits = int.from_bytes(data[1:5], 'little')
+        width = (bits & 0x3FFF) + 1
+        height = ((bits >> 14) & 0x3FFF) + 1
+        alpha = (bits >> 28) & 1
+        return {"format": "WEBP", "size": (width, height), "mode": 'RGBA' if alpha else 'RGB',
+                "is_animated": False}
+    raise ProbeError("Unknown WebP chunk")
+
+
+def _probe_gif(stream, head: bytes) -> dict | None:
+    """
+    Reads the logical screen size, then walks the block structure (skipping image data sub-blocks
+    without decoding them) until a second image descriptor is found or `gif_probe_limit` is reached.
+    """
+    if len(head) < 13:
+        return None
+    width, height, packed = struct.unpack('<HHB', head[6:11])
+    palette_size = 3 << ((packed & 0x07) + 1) if packed & 0x80 else 0
+    palette = head[13:13 + palette_size]
+    # Like Pillow, a global palette that is the identity grey ramp makes the image "L"
+    grey_ramp = palette_size and all(palette[i] == palette[i + 1] == palette[i + 2] == i // 3
+                                     for i in range(0, len(palette), 3))
+    result = {"format": "GIF", "size": (width, height), "mode": 'L' if grey_ramp else 'P', "is_animated": False}
+
+    stream.seek(13 + palette_size)
+    frames = 0
+    while stream.tell() < gif_probe_limit:
+        introducer = stream.read(1)
+        if not introducer or introducer == b'\x3b':
+            return result
+        if introducer == b'\x2c':
+            frames += 1
+            if frames > 1:
+                result["is_animated"] = True
+                return result
+            descriptor = stream.read(9)
+            if len(descriptor) < 9:
+                return result
+            if descriptor[8] & 0x80:
+                stream.seek(3 << ((descriptor[8] & 0x07) + 1), os.SEEK_CUR)
+            # LZW minimum code size
+            stream.read(1)
+        elif introducer == b'\x21':
+            # Extension label
+            stream.read(1)
+        else:
+            raise ProbeError("Invalid GIF block")
+        # Skip data sub-blocks
+        while True:
+            size = stream.read(1)
+            if not size or size == b'\x00':
+                break
+            stream.seek(size[0], os.SEEK_CUR)
+    # Too long to walk, let Pillow decide
+    return None
+
+
+def probe_image(stream) -> dict:
+    """
+    Reports format, size, mode and animation of an image from its container headers only.
+
+    Parameters:
+        stream (file-like): A seekable binary stream positioned anywhere (e.g. `UploadFile.file`).
+
+    Returns:
+        dict: The same keys `validate_image()` reports: "format", "size", "mode" and "is_animated".
+
+    Steps:
+        1. Read the first `probe_bytes` of the stream.
+        2. Parse the header of the detected container: the JPEG SOF segment, the PNG IHDR (and
+           APNG acTL) chunk, the WebP VP8/VP8L/VP8X chunk, or the GIF screen descriptor followed
+           by a walk over its blocks to count frames.
+        3. Formats without a dedicated parser (TIFF, BMP, ...) and headers that do not fit in the
+           probed bytes fall back to `Image.open()`, which also stops at the header.
+
+    No pixel data is ever decoded, and apart from the GIF frame walk (capped by `gif_probe_limit`)
+    the work does not depend on the size of the file.
+    """
+    stream.seek(0)
+    head = stream.read(probe_bytes)
+
+    result = None
+    if head[:3] == b'\xff\xd8\xff':
+        result = _probe_jpeg(head)
+    elif head[:8] == b'\x89PNG\r\n\x1a\n':
+        result = _probe_png(head)
+    elif head[:4] == b'RIFF' and head[8:12] == b'WEBP':
+        result = _probe_webp(head)
+    elif head[:6] in (b'GIF87a', b'GIF89a'):
+        result = _probe_gif(stream, head)
+
+    if result is None:
+        stream.seek(0)
+        image = Image.open(stream)
+        result = {
+            "format": image.format,
+            "size": image.size,
+            "mode": image.mode,
+            "is_animated": getattr(image, "is_animated", False),
+        }
+    return result
+
+
+def is_animated(image_data: bytes) -> bool:
+    """
+    Whether the raw bytes of an upload hold an animation (see `probe_image()`). Headers that cannot
+    be parsed count as a still image, since the upload has been decoded and hashed by then. Kept free
+    of any app state so it can run in the CPU pool next to the hashing.
+    """
+    try:
+        return bool(probe_image(io.BytesIO(image_data))["is_animated"])
+    except Exception:
+        return False
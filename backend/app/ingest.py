@@ -0,0 +1,102 @@
+import io
+import os
+from PIL import Image
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# Largest upload accepted, in bytes
+max_upload_bytes = int(os.getenv('MAX_UPLOAD_BYTES', str(50 * 1024 * 1024)))
+# Largest image decoded, in pixels (after JPEG draft downscaling)
+max_image_pixels = int(os.getenv('MAX_IMAGE_PIXELS', str(50_000_000)))
+# Chunk size used when reading uploads
+read_chunk_size = 64 * 1024
+
+
+class UploadTooLarge(ValueError):
+    """Raised when an upload exceeds the byte or pixel budget."""
+
+    def __init__(self, detail: str):
+        super().__init__(detail)
+        self.detail = detail
+
+
+async def read_upload(file, max_bytes: int = None) -> bytes:
+    """
+    Reads an upload in chunks, stopping as soon as it exceeds `max_bytes`.
+
+    Parameters:
+        file (UploadFile): The uploaded file.
+        max_bytes (int): The byte budget, `MAX_UPLOAD_BYTES` by default.
+
+    Returns:
+        bytes: The upload contents.
+
+    Raises:
+        UploadTooLarge: If the upload is larger than the budget. At most `max_bytes` plus one chunk
+                        is ever held in memory.
+    """
+    if max_bytes is None:
+        max_bytes = max_upload_bytes
+    if file.size is not None and file.size > max_bytes:
+        raise UploadTooLarge(f"Upload is {file.size} bytes, the limit is {max_bytes}")
+    chunks = []
+    size = 0
+    while chunk := await file.read(read_chunk_size):
+        size += len(chunk)
+        if size > max_bytes:
+            raise UploadTooLarge(f"Upload exceeds {max_bytes} bytes")
+        chunks.append(chunk)
+    return b''.join(chunks)
+
+
+def check_member_size(size: int, name: str, max_bytes: int = None):
+    """Rejects an archive member before it is read if it exceeds the byte budget."""
+    if max_bytes is None:
+        max_bytes = max_upload_bytes
+    if size > max_bytes:
+        raise UploadTooLarge(f"{name} is {size} bytes, the limit is {max_bytes}")
+
+
+def check_pixel_budget(image: Image.Image, max_pixels: int = None):
+    """
+    Rejects an image whose decode would exceed the pixel budget, using only its header.
+
+    Call after `Image.draft()`, which shrinks the size a JPEG will be decoded at, and before anything
+    that loads pixels.
+
+    Raises:
+        UploadTooLarge: If width * height is over the budget.
+    """
+    if max_pixels is None:
+        max_pixels = max_image_pixels
+    width, height = image.size
+    if width * height > max_pixels:
+        raise UploadTooLarge(f"Image is {width}x{height} pixels, the limit is {max_pixels}")
+
+
+def open_image(image_data: bytes, draft_size: int = None, draft_mode: str = 'L') -> Image.Image:
+    """
+    Opens image bytes for decoding within the pixel budget. Every path that decodes pixels (hashing,
+    animation frames, thumbnails, feature descriptors, tiles) opens its image here.
+
+    Pillow's own decompression bomb guard is left at its default and still runs in `Image.open()`,
+    on the header size. The budget is then checked on the size the image will actually be decoded at.
+
+    Parameters:
+        image_data (bytes): The raw image bytes.
+        draft_size (int): For JPEGs, let the decoder downscale in the DCT domain (`Image.draft`) to
+                          no less than draft_size x draft_size before the budget is checked.
+        draft_mode (str): The mode requested from the JPEG decoder along with `draft_size`.
+
+    Returns:
+        Image.Image: The opened image, pixels not decoded yet.
+
+    Raises:
+        UploadTooLarge: If the decoded size is over the budget.
+    """
+    image = Image.open(io.BytesIO(image_data))
+    if draft_size and image.format == 'JPEG':
+        image.draft(draft_mode, (draft_size, draft_size))
+    check_pixel_budget(image)
+    return image
@@ -0,0 +1,97 @@
+import json
+import logging
+import os
+import sys
+import threading
+import time
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# Minimum level written
+log_level = os.getenv('LOG_LEVEL', 'INFO').upper()
+# 'json' (one object per line) or 'text'
+log_format = os.getenv('LOG_FORMAT', 'json')
+# At most `sample_burst` records per `sample_interval` seconds for each logger and message
+sample_interval = float(os.getenv('LOG_SAMPLE_INTERVAL', '10'))
+sample_burst = int(os.getenv('LOG_SAMPLE_BURST', '5'))
+
+# Attributes every LogRecord has; anything else was passed through `extra=` and is a field
+_RECORD_ATTRIBUTES = set(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {'message', 'asctime'}
+
+
+class JsonFormatter(logging.Formatter):
+    """Formats a record as one JSON object: time, level, logger, event and the `extra=` fields."""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "ts": time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime(record.created)) + f".{int(record.msecs):03d}Z",
+            "level": record.levelname,
+            "logger": record.name,
+            "event": record.getMessage(),
+        }
+        entry.update({key: value for key, value in vars(record).items() if key not in _RECORD_ATTRIBUTES})
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+class TextFormatter(logging.Formatter):
+    """Human readable variant: the event followed by key=value fields."""
+
+    def format(self, record: logging.LogRecord) -> str:
+        fields = ' '.join(f"{key}={value}" for key, value in vars(record).items()
+                          if key not in _RECORD_ATTRIBUTES)
+        line = f"{self.formatTime(record)} {record.levelname} {record.name}: {record.getMessage()} {fields}".rstrip()
+        if record.exc_info:
+            line += '\n' + self.formatException(record.exc_info)
+        return line
+
+
+class SamplingFilter(logging.Filter):
+    """
+    Rate limits each call site: at most `burst` records per `interval` seconds for a given logger and
+    message template (fields passed through `extra=` do not make records distinct). The first record
+    of the next window carries a `suppressed` field with the number of records dropped in the
+    previous one, so a flood of RPC errors costs a few lines instead of one per request.
+    """
+
+    def __init__(self, interval: float, burst: int):
+        super().__init__()
+        self.interval = interval
+        self.burst = burst
+        self._windows = {}
+        self._lock = threading.Lock()
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if self.burst <= 0:
+            return True
+        key = (record.name, record.msg)
+        now = time.monotonic()
+        with self._lock:
+            window = self._windows.get(key)
+            if window is None or now - window[0] >= self.interval:
+                suppressed = window[2] if window is not None else 0
+                window = self._windows[key] = [now, 0, 0]
+                if suppressed:
+                    record.suppressed = suppressed
+            if window[1] < self.burst:
+                window[1] += 1
+                return True
+            window[2] += 1
+            return False
+
+
+_root = logging.getLogger('pxlproof')
+if not _root.handlers:
+    _handler = logging.StreamHandler(sys.stdout)
+    _handler.setFormatter(JsonFormatter() if log_format == 'json' else TextFormatter())
+    _handler.addFilter(SamplingFilter(sample_interval, sample_burst))
+    _root.addHandler(_handler)
+    _root.setLevel(log_level)
+    _root.propagate = False
+
+
+def get_logger(name: str) -> logging.Logger:
+    """Logger of an app module, e.g. get_logger('callSC'), writing through the sampled handler."""
+    return _root.getChild(name)
@@ -1,16 +1,110 @@
-from fastapi import FastAPI, UploadFile, HTTPException
+from fastapi import FastAPI, UploadFile, HTTPException, Request, File, Query
 from fastapi.middleware.cors import CORSMiddleware
-from PIL import Image
-import io
+from fastapi.responses import JSONResponse, StreamingResponse, PlainTextResponse
+from PIL import Image, UnidentifiedImageError
+import asyncio
+import os
+import tarfile
+import threading
+import zipfile
 import csv
 import json
 import imagehash
-from typing import Dict
+from contextlib import asynccontextmanager
 from pydantic import BaseModel
-from .callSC import add_hash, get_all_hashes
+from .callSC import get_client
+from .registry import registry
+from .hash_index import hash_index, hash_format
+from .hash_codec import encode_hash, format_hash_string, join_hashes, split_hashes, to_hash_string, VERSIONS
+from .hashing import composite_hash, timed_composite_hashes, hash_keyframes, max_frames, max_keyframes, \
+    scene_change_threshold
+from .executor import executor, ExecutorOverloaded
+from .tx_queue import TransactionSubmitter, AnchorJob, shared_state
+from .result_cache import result_cache, content_digest
+from .similarity import HashMatrix
+from .features import feature_verifier, orb_descriptors, gray_zone_low, max_candidates, feature_count, \
+    feature_image_size, extract_budget
+from .thumbnails import thumbnail_store, make_thumbnail, batched_ssim, thumbnail_size, ssim_top_k
+from .tiles import tile_index, tile_hashes, tile_image_size
+from .merkle import merkle_log, leaf_hash
+from .ingest import read_upload, check_member_size, UploadTooLarge
+from .image_probe import is_animated, probe_image, ProbeError
+from .registry import LEGACY_SOURCE, PACKED_SOURCE
+from .log import get_logger
+from .metrics import REGISTRY as METRICS, STAGE_SECONDS, INCOMPATIBLE_HASHES, Counter, Gauge
 
-db_name = 'db'
-app = FastAPI(title="Attested Image-Editing Stack API")
+log = get_logger('main')
+
+# Images of one batch request hashed concurrently
+batch_concurrency = int(os.getenv('BATCH_CONCURRENCY', str(2 * executor.cpu_workers)))
+# Largest number of matches /api/search returns
+search_max_k = int(os.getenv('SEARCH_MAX_K', '50'))
+
+# Average similarity (%) above which an image counts as already registered
+MATCH_THRESHOLD = 80.0
+
+
+def on_mined(jobs: list):
+    """
+    Pull mined entries into the hash index and store what was kept of their images, or keep the
+    record of a mined Merkle root anchor.
+    """
+    if isinstance(jobs[0], AnchorJob):
+        for job in jobs:
+            merkle_log.record_anchor(job.source, job.size, job.root, job.trx_hash, job.block_number)
+        return
+    hash_index.sync()
+    store_published(jobs)
+
+
+# Publishes are queued and sent by a background submitter; mined entries are pulled into the index.
+# Worker processes share the account nonce and the job states through `shared_state`.
+tx_submitter = TransactionSubmitter(on_mined=on_mined, registry=registry, shared=shared_state)
+
+# Values owned by other components, read when /metrics is scraped
+SOURCE_NAMES = {LEGACY_SOURCE: 'legacy', PACKED_SOURCE: 'packed'}
+Counter('pxlproof_result_cache_lookups_total', 'Result cache lookups by outcome.', ['result'],
+        callback=lambda: {('hit',): result_cache.hits, ('miss',): result_cache.misses})
+Counter('pxlproof_result_cache_stale_verdicts_total', 'Cache hits whose verdict had to be searched again.',
+        callback=lambda: result_cache.stale_verdicts)
+Gauge('pxlproof_registry_entries', 'Registry entries mirrored by the hash index.', ['source'],
+      callback=lambda: {(SOURCE_NAMES[source],): count for source, count in hash_index.sizes().items()})
+Counter('pxlproof_search_rows_ruled_out_total',
+        'Registry rows rejected by the search scan, after the first two hashes (stage="first") or after all '
+        'three (stage="full").', ['stage'],
+        callback=lambda: {(stage,): sum(matrix.rejections[i] for matrix in hash_index.matrices.values())
+                          for i, stage in enumerate(('first', 'full'))})
+FEATURE_VERIFICATIONS = Counter(
+    'pxlproof_feature_verifications_total',
+    'Hash near misses checked against stored feature descriptors, by outcome (match, no_match, '
+    'budget_exceeded, no_descriptors).', ['outcome'])
+TILE_LOOKUPS = Counter('pxlproof_tile_lookups_total',
+                       'Hash misses looked up in the tile index, by outcome (match, no_match).', ['outcome'])
+Gauge('pxlproof_merkle_unanchored_entries', 'Entries appended to the Merkle tree since its root was last anchored.',
+      ['source'], callback=lambda: {(SOURCE_NAMES[source],): count for source, count in merkle_log.unanchored().items()})
+Gauge('pxlproof_hash_index_leader', '1 if this process syncs the hash index, 0 if it follows a shared one.',
+      callback=lambda: int(hash_index.leader))
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Keep the local hash index in sync and the worker pools running for the lifetime of the app."""
+    executor.start()
+    if registry.on_chain:
+        # Build the chain client (and import web3) off the startup path, before the first request needs it
+        asyncio.get_running_loop().run_in_executor(None, get_client)
+    hash_index.start_refresher()
+    tx_submitter.start()
+    if registry.on_chain:
+        merkle_log.start_anchoring(tx_submitter.submit_anchor)
+    yield
+    merkle_log.stop_anchoring()
+    tx_submitter.stop()
+    hash_index.stop_refresher()
+    executor.shutdown()
+
+
+app = FastAPI(title="Attested Image-Editing Stack API", lifespan=lifespan)
 
 # Add CORS middleware
 app.add_middleware(
@@ -21,8 +115,25 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-# In-memory storage (replace with blockchain storage in production)
-image_store: Dict[str, dict] = {}
+
+@app.exception_handler(ExecutorOverloaded)
+async def executor_overloaded_handler(request: Request, exc: ExecutorOverloaded):
+    """Backpressure: reject work instead of queueing it without bound."""
+    return JSONResponse(status_code=503, content={"detail": str(exc)}, headers={"Retry-After": "1"})
+
+
+@app.exception_handler(UploadTooLarge)
+@app.exception_handler(Image.DecompressionBombError)
+async def upload_too_large_handler(request: Request, exc: Exception):
+    """Uploads over the byte or pixel budget (see ingest.py)."""
+    return JSONResponse(status_code=413, content={"detail": str(exc)})
+
+
+@app.exception_handler(ProbeError)
+@app.exception_handler(UnidentifiedImageError)
+async def unreadable_image_handler(request: Request, exc: Exception):
+    """Uploads whose header cannot be parsed as an image."""
+    return JSONResponse(status_code=400, content={"detail": str(exc)})
 
 
 class ImageResponse(BaseModel):
@@ -31,6 +142,69 @@ class ImageResponse(BaseModel):
     exists: bool | None = None
     validation: bool | None = None
     trx_hash: str | None = None
+    job_id: str | None = None
+    status: str | None = None
+    ssim: float | None = None
+
+
+class SearchMatch(BaseModel):
+    version: int
+    position: int
+    source: str
+    hash: str
+    ahash_similarity: float
+    dhash_similarity: float
+    phash_similarity: float
+    avg_similarity: float
+    match: bool
+
+
+class SearchResponse(BaseModel):
+    message: str
+    hash: str
+    exists: bool
+    threshold: float
+    matches: list[SearchMatch]
+
+
+class ImageValidation(BaseModel):
+    format: str | None = None
+    size: tuple[int, int]
+    mode: str | None = None
+    is_animated: bool = False
+
+
+class CheckResponse(BaseModel):
+    message: str
+    validation: ImageValidation
+
+
+class PublishStatusResponse(BaseModel):
+    job_id: str
+    status: str
+    hash: str
+    trx_hash: str | None = None
+    block_number: int | None = None
+    error: str | None = None
+
+
+class MerkleAnchor(BaseModel):
+    size: int
+    root: str
+    trx_hash: str | None = None
+    block_number: int | None = None
+
+
+class ProofResponse(BaseModel):
+    index: int
+    source: str
+    entry: str
+    hash: str
+    leaf: str
+    size: int
+    root: str
+    path: list[str]
+    anchor: MerkleAnchor | None = None
 
 
 def calculate_image_hash(image_data: bytes, hash_size=16) -> str:
@@ -47,18 +221,20 @@ def calculate_image_hash(image_data: bytes, hash_size=16) -> str:
 
     Steps:
         1. Convert the byte data into an image using PIL (Python Imaging Library).
-        2. Compute the average hash (ahash) of the image, which captures the overall visual features.
-        3. Compute the difference hash (dhash), which detects changes in pixel gradients.
-        4. Compute the perceptual hash (phash), which captures the perceptual features of the image.
-        5. Concatenate the three hash values into a single string, separated by the '#' symbol.
+        2. Decode it once into a downscaled grayscale working image shared by all three hashes
+           (see `hashing.working_image()`).
+        3. Compute the average hash (ahash) of the image, which captures the overall visual features.
+        4. Compute the difference hash (dhash), which detects changes in pixel gradients.
+        5. Compute the perceptual hash (phash), which captures the perceptual features of the image.
+        6. Concatenate the three hash values into a single string, separated by the '#' symbol.
+
+    With HASH_WORKING_SCALE=0 the result is bit-identical to calling `imagehash.average_hash`,
+    `imagehash.dhash` and `imagehash.phash` on the full image. The default working image changes at
+    most a few bits per hash on the sample images (see `hashing.working_image()`).
 
     This function is useful for image comparison, deduplication, or generating unique identifiers for images.
     """
-    image = Image.open(io.BytesIO(image_data))
-    ahash = imagehash.average_hash(image, hash_size)
-    dhash = imagehash.dhash(image, hash_size)
-    phash = imagehash.phash(image, hash_size)
-    return (str(ahash) + "#" + str(dhash) + "#" + str(phash))
+    return composite_hash(image_data, hash_size)
 
 
 def calculate_similarity(hash1, hash2) -> int:
@@ -91,7 +267,7 @@ def calculate_similarity(hash1, hash2) -> int:
         similarity = (1 - hamming_dist / total_bits) * 100
         return similarity
     except ValueError as e:
-        print(f"Error comparing hashes: {e}")
+        log.warning("Error comparing hashes", extra={"error": str(e)})
         # Return 0 similarity for incompatible hash formats
         raise
 
@@ -154,41 +330,391 @@ def calculate_similaties(hash_1: str, hash_2: str) -> dict:
 
 
 def read_image_hash():
-    """Read all image hashes from the blockchain."""
-    hashes = get_all_hashes()
+    """Read all image hashes from the local mirror of the registry."""
+    hashes = hash_index.get_hashes()
 
     return hashes
-    # hashes = []
-    # with open(db_name, 'r') as file:
-    #     hashes = file.readlines()
-    # return hashes
 
 
 def write_image_hash(hash):
 
-    """Append an image hash to the blockchain."""
-    return add_hash(hash)
-    # with open(db_name, mode='a+', newline='\n') as file:
-    #     file.write(hash + '\n')
+    """Append an image hash to the registry (the blockchain unless REGISTRY_BACKEND says otherwise)."""
+    if hash_index.contains(hash):
+        log.info("Hash already exists in registry, skipping addition", extra={"hash": hash})
+        return None
+    try:
+        trx_hash = registry.append_many([hash])
+    except Exception as e:
+        log.error("Error adding hash", extra={"error": str(e)})
+        return None
+    # Pull the new entry into the mirror right away
+    hash_index.sync()
+    return trx_hash
+
+
+def as_versions(image_hash) -> dict:
+    """The {version: hash string} of a query given as such a dict or as a single hash string."""
+    return image_hash if isinstance(image_hash, dict) else split_hashes(image_hash)
+
+
+def search_image(original_image_hash) -> bool:
+    """
+    Checks whether any registered hash has an average similarity above 80% to the given hash.
 
+    The query is a hash string, or the {version: hash string} of an upload hashed in several hash
+    versions (see `hash_codec.HashVersion`). The hash of each version is only compared with the
+    registry entries of the same version (`HashIndex` keeps one partition per version), and a match
+    in any partition counts.
 
-def search_image(original_image_hash: str) -> bool:
-    image_hashes = read_image_hash()
-    if not image_hashes:
+    The registry is kept pre-decoded in packed bit matrices (see `similarity.HashMatrix`), so the
+    comparison against every entry is one batched XOR + popcount instead of three `hex_to_hash()`
+    parses per entry. Registry entries with an incompatible format are skipped.
+    """
+    try:
+        hashes = as_versions(original_image_hash)
+        with STAGE_SECONDS.time(stage="similarity_scan"):
+            for version, matrix in hash_index.get_matrices().items():
+                if version in hashes and len(matrix) and matrix.exists(hashes[version], threshold=MATCH_THRESHOLD):
+                    return True
+        return False
+    except ValueError as e:
+        INCOMPATIBLE_HASHES.inc(where="query")
+        log.warning("Skipping search for incompatible hash format", extra={"error": str(e)})
         return False
 
-    for image_hash in image_hashes:
-        try:
-            similarities = calculate_similaties(original_image_hash, image_hash)
-            if similarities['avg_similarity'] > 80.0:
-                return True
-        except ValueError:
-            # Skip comparison if the hash format is incompatible
-            print(f"Skipping incompatible hash format: {image_hash}")
-            continue
+
+def search_images(image_hashes: list) -> list:
+    """
+    Batch version of `search_image()`: resolves many hashes against the registry in one vectorized
+    pass over the hash matrix of each version (see `HashMatrix.exists_many`).
+    """
+    found = [False] * len(image_hashes)
+    queries = [as_versions(image_hash) for image_hash in image_hashes]
+    with STAGE_SECONDS.time(stage="similarity_scan"):
+        for version, matrix in hash_index.get_matrices().items():
+            pending = [i for i, hashes in enumerate(queries) if not found[i] and version in hashes]
+            if not len(matrix) or not pending:
+                continue
+            version_hashes = [queries[i][version] for i in pending]
+            matches = matrix.exists_many(version_hashes, threshold=MATCH_THRESHOLD).tolist()
+            for i, match in zip(pending, matches):
+                found[i] = match
+    return found
+
+
+def search_top_k(image_hash, k: int, threshold: float) -> list:
+    """
+    Returns the k registered hashes closest to the given hash, best first (see `HashMatrix.top_k`).
+
+    Parameters:
+        image_hash (str | dict): The composite hash searched for, or its {version: hash string}.
+        k (int): The number of matches to return.
+        threshold (float): The average similarity above which a match counts as the same image.
+
+    Returns:
+        list[dict]: Per match, its hash `version`, the registry `source` ("legacy" or "packed") and
+                    `position`, the registered `hash`, the ahash/dhash/phash/avg similarities and
+                    whether it is above the threshold (`match`). Each version partition contributes
+                    its own k best, the best k of all of them are returned.
+    """
+    matches = []
+    try:
+        hashes = as_versions(image_hash)
+        with STAGE_SECONDS.time(stage="similarity_scan"):
+            for version, matrix in hash_index.get_matrices().items():
+                if version not in hashes:
+                    continue
+                for match in matrix.top_k(hashes[version], k):
+                    match['version'] = version
+                    match['hash'] = format_hash_string(version, match['hash'].split('#'))
+                    matches.append(match)
+    except ValueError as e:
+        INCOMPATIBLE_HASHES.inc(where="query")
+        log.warning("Skipping search for incompatible hash format", extra={"error": str(e)})
+        return []
+    # Stable, so ties keep the primary version first and registry order within a version
+    matches = sorted(matches, key=lambda match: -match['avg_similarity'])[:k]
+    for match in matches:
+        del match['row']
+        match['source'] = SOURCE_NAMES[match['source']]
+        match['match'] = match['avg_similarity'] > threshold
+    return matches
+
+
+def search_gray_zone(hashes: dict) -> tuple:
+    """
+    `search_image()` that also returns the closest registered hashes below the match threshold, the
+    candidates of the feature verifier (see `HashMatrix.gray_zone`).
+
+    Returns:
+        tuple[bool, list[bytes]]: Whether a similar image is registered, and otherwise the binary
+                                  entries (see `hash_codec.encode_hash()`) of up to
+                                  FEATURE_MAX_CANDIDATES hashes with an average similarity above
+                                  FEATURE_GRAY_ZONE_LOW, best first.
+    """
+    candidates = []
+    try:
+        with STAGE_SECONDS.time(stage="similarity_scan"):
+            for version, matrix in hash_index.get_matrices().items():
+                if version not in hashes or not len(matrix):
+                    continue
+                exists, rows = matrix.gray_zone(hashes[version], gray_zone_low, threshold=MATCH_THRESHOLD,
+                                                limit=max_candidates)
+                if exists:
+                    return True, []
+                bits = matrix.bits
+                candidates.extend((row['avg_similarity'], bytes([version]) + bits[row['row']].tobytes())
+                                  for row in rows)
+    except ValueError as e:
+        INCOMPATIBLE_HASHES.inc(where="query")
+        log.warning("Skipping search for incompatible hash format", extra={"error": str(e)})
+        return False, []
+    # Stable, so ties keep the primary version first
+    candidates.sort(key=lambda candidate: -candidate[0])
+    return False, [entry for _, entry in candidates[:max_candidates]]
+
+
+async def extract_features(contents: bytes):
+    """ORB descriptors of an upload, computed in the CPU pool (see `features.orb_descriptors()`)."""
+    with STAGE_SECONDS.time(stage="feature_extract"):
+        return await executor.run_cpu(orb_descriptors, contents, feature_count, feature_image_size)
+
+
+async def verify_features(contents: bytes, candidates: list) -> bool | None:
+    """
+    Second opinion on an upload no registered hash is similar enough to: matches its ORB descriptors
+    against the stored descriptors of the gray zone candidates.
+
+    Returns:
+        bool | None: Whether a candidate is the same image, or None when the feature stage ran out
+                     of its latency budget and the verdict is left to the hashes alone.
+    """
+    try:
+        descriptors = await asyncio.wait_for(extract_features(contents), extract_budget)
+    except asyncio.TimeoutError:
+        FEATURE_VERIFICATIONS.inc(outcome="budget_exceeded")
+        return None
+    with STAGE_SECONDS.time(stage="feature_match"):
+        outcome, entry = await executor.run_search(feature_verifier.verify, descriptors, candidates)
+    FEATURE_VERIFICATIONS.inc(outcome=outcome)
+    if outcome == "budget_exceeded":
+        return None
+    return outcome == "match"
+
+
+async def search_frames(contents: bytes) -> bool:
+    """
+    Searches the registry for the later frames of an animated upload, whose composite hash only
+    covers the first frame.
+
+    Keyframes (see `hashing.hash_keyframes()`) are hashed in the CPU pool in batches of 1, 2, 4, ...
+    and each batch is searched before the next one is hashed, so an animation whose second scene is
+    registered costs one more frame, not the whole animation. Resuming a batch decodes the frames
+    before it again, which the doubling keeps under twice the frames a single pass would decode.
+    At most ANIMATION_MAX_FRAMES frames are decoded and ANIMATION_MAX_KEYFRAMES hashed.
+
+    Returns:
+        bool: Whether a keyframe matches a registered image.
+    """
+    start, reference, batch, hashed = 0, None, 1, 0
+    while hashed < max_keyframes:
+        with STAGE_SECONDS.time(stage="frame_hash"):
+            keyframes, start, reference, done = await executor.run_cpu(
+                hash_keyframes, contents, hash_index.versions, start, min(batch, max_keyframes - hashed),
+                reference, max_frames, scene_change_threshold)
+        hashed += len(keyframes)
+        if keyframes:
+            found = await executor.run_search(search_images, [hashes for _, hashes in keyframes])
+            for (frame, _), match in zip(keyframes, found):
+                if match:
+                    log.debug("Animated upload matches in a later frame", extra={"frame": frame})
+                    return True
+        if done:
+            break
+        batch *= 2
     return False
 
 
+async def match_tiles(contents: bytes) -> bool:
+    """
+    Looks the tiles of an upload up in the tile index (see `tiles.TileIndex.vote()`), to find
+    published images it is a crop of.
+
+    Tiles are only indexed once their entry is mined, but the tile index is a separate file that
+    can outlive the registry it was built from, so the winning entry must also be in the hash index.
+    """
+    with STAGE_SECONDS.time(stage="tile_hash"):
+        hashes = await executor.run_cpu(tile_hashes, contents, tile_image_size)
+    with STAGE_SECONDS.time(stage="tile_vote"):
+        entry, votes = await executor.run_search(tile_index.vote, hashes)
+        if entry is not None and not await executor.run_search(hash_index.contains, entry):
+            entry = None
+    TILE_LOOKUPS.inc(outcome="match" if entry is not None else "no_match")
+    log.debug("Tile lookup", extra={"votes": votes, "match": entry is not None})
+    return entry is not None
+
+
+async def publish_artifacts(contents: bytes) -> dict:
+    """
+    Computes in the CPU pool what later uploads are compared with beyond the hashes, for the stores
+    that are enabled: feature descriptors, tile hashes and thumbnail.
+
+    They travel with the publish job and are only written once its entry is mined (see
+    `store_published()`), so an upload cannot be matched to an entry that never made it into the
+    registry. An artifact that fails is logged and left out.
+
+    Returns:
+        dict: {"features" | "tiles" | "thumbnail": value}
+    """
+    tasks = {}
+    if feature_verifier is not None:
+        tasks["features"] = extract_features(contents)
+    if tile_index is not None:
+        tasks["tiles"] = executor.run_cpu(tile_hashes, contents, tile_image_size)
+    if thumbnail_store is not None:
+        tasks["thumbnail"] = executor.run_cpu(make_thumbnail, contents, thumbnail_size)
+    artifacts = {}
+    for name, result in zip(tasks, await asyncio.gather(*tasks.values(), return_exceptions=True)):
+        if isinstance(result, Exception):
+            log.error("Error computing publish artifact", extra={"artifact": name, "error": str(result)})
+        else:
+            artifacts[name] = result
+    return artifacts
+
+
+def store_published(jobs: list):
+    """Write the artifacts of mined publish jobs (see `publish_artifacts()`) to their stores."""
+    stores = {"features": feature_verifier.store if feature_verifier is not None else None,
+              "tiles": tile_index, "thumbnail": thumbnail_store}
+    for job in jobs:
+        artifacts, job.artifacts = job.artifacts, None
+        for name, value in (artifacts or {}).items():
+            try:
+                stores[name].put(encode_hash(job.hash), value)
+            except Exception as e:
+                log.error("Error storing publish artifact", extra={"artifact": name, "error": str(e)})
+
+
+def rank_by_ssim(query, matches: list) -> list:
+    """
+    Adds the SSIM of the query thumbnail against the stored thumbnail of each match (`ssim`, None
+    when it has none) and sorts the matches by it, best first.
+    """
+    found, thumbnails = thumbnail_store.get_many([encode_hash(match['hash']) for match in matches])
+    for match in matches:
+        match['ssim'] = None
+    for i, score in zip(found, batched_ssim(query, thumbnails).tolist() if found else []):
+        matches[i]['ssim'] = score
+    return sorted(matches, key=lambda match: -match['ssim'] if match['ssim'] is not None else float('inf'))
+
+
+async def ssim_rerank(image_hash: str, contents: bytes, exists: bool, candidates: list) -> list:
+    """
+    Re-ranks the registered hashes the search found near an upload by the SSIM of their thumbnails
+    (see `thumbnails.batched_ssim()`).
+
+    Only uploads the search had something to say about are re-ranked: on a match, the SSIM_TOP_K
+    closest registered hashes; on a miss, its gray zone candidates (see `search_gray_zone()`). A
+    plain miss costs nothing more.
+
+    Both sides are fixed size thumbnails, so the cost does not depend on the resolution of the
+    upload or of the registered originals.
+
+    Returns:
+        list[dict]: The matches with their `hash` and `ssim`, best first. Empty when thumbnails are
+                    disabled or the search found nothing near the upload.
+    """
+    if thumbnail_store is None or ssim_top_k <= 0:
+        return []
+    if exists:
+        matches = await executor.run_search(search_top_k, image_hash, ssim_top_k, MATCH_THRESHOLD)
+    else:
+        matches = [{'hash': to_hash_string(entry)} for entry in candidates[:ssim_top_k]]
+    if not matches:
+        return []
+    with STAGE_SECONDS.time(stage="thumbnail"):
+        query = await executor.run_cpu(make_thumbnail, contents, thumbnail_size)
+    with STAGE_SECONDS.time(stage="ssim_rerank"):
+        return await executor.run_search(rank_by_ssim, query, matches)
+
+
+async def hash_upload(contents: bytes) -> dict:
+    """
+    Hashes an upload in the CPU pool in every searched hash version, from one decode, recording the
+    decode and hash stage latencies.
+
+    Returns:
+        dict: {version: hash string}, the primary (published) version first.
+    """
+    hashes, decode_seconds, hash_seconds = await executor.run_cpu(timed_composite_hashes, contents,
+                                                                  hash_index.versions)
+    STAGE_SECONDS.observe(decode_seconds, stage="decode")
+    STAGE_SECONDS.observe(hash_seconds, stage="hash")
+    return hashes
+
+
+def cached_hashes(cached) -> dict | None:
+    """The {version: hash string} of a cached result, or None if it was not hashed in the searched versions."""
+    if cached is None:
+        return None
+    try:
+        hashes = split_hashes(cached.hash)
+    except ValueError:
+        return None
+    return hashes if list(hashes) == hash_index.versions else None
+
+
+async def hash_and_search(contents: bytes) -> tuple:
+    """
+    Hashes an upload and searches the registry for it, reusing cached work for repeat uploads.
+
+    Returns:
+        tuple[str, bool, list[bytes]]: The composite hash (of the primary hash version), whether a
+                                       similar image is registered, and on a miss the gray zone
+                                       candidates the search found (see `search_gray_zone()`;
+                                       empty for a cached verdict).
+
+    Steps:
+        1. Look the SHA-256 of the bytes up in the result cache. Entries hashed in other hash versions
+           than the ones searched now are ignored.
+        2. If the cached verdict is still valid for the current registry size, return it as is.
+        3. Otherwise reuse the cached hashes (or compute them in the CPU pool) and search the registry again.
+        4. A miss that is animated (GIF, WebP, APNG) is searched again with the hashes of its later
+           scenes, until one matches (see `search_frames()`). The headers are probed in the CPU pool,
+           and headers that cannot be parsed count as a still image.
+        5. With TILE_INDEX_PATH set, a miss is looked up in the tile index, which finds crops of
+           published images (see `match_tiles()`).
+        6. With FEATURE_VERIFIER set, a miss whose closest registered hashes are in the gray zone is
+           decided by matching feature descriptors against theirs (see `verify_features()`).
+        7. Store the hashes and the new verdict together with the registry size it was computed at.
+           A verdict the feature stage could not finish in its budget is not cached.
+    """
+    digest = content_digest(contents)
+    watermark = len(hash_index)
+    cached = result_cache.get(digest, watermark)
+    hashes = cached_hashes(cached)
+    if hashes is not None and cached.verdict_valid(watermark):
+        return hashes[hash_index.versions[0]], cached.exists, []
+
+    if hashes is None:
+        hashes = await hash_upload(contents)
+    candidates = []
+    if feature_verifier is None:
+        exists = await executor.run_search(search_image, hashes)
+    else:
+        exists, candidates = await executor.run_search(search_gray_zone, hashes)
+    if not exists and await executor.run_cpu(is_animated, contents):
+        exists = await search_frames(contents)
+    if not exists and tile_index is not None:
+        exists = await match_tiles(contents)
+    verdict = exists
+    if not exists and candidates:
+        verdict = await verify_features(contents, candidates)
+        exists = bool(verdict)
+    result_cache.put(digest, join_hashes(hashes), verdict, watermark)
+    return hashes[hash_index.versions[0]], exists, candidates
+
+
 '''
 import hashlib
 
@@ -210,76 +736,403 @@ def validate_image(image: Image.Image) -> dict:
 
 @app.post("/api/publish", response_model=ImageResponse)
 async def publish_image(file: UploadFile):
-    """Publish image to blockchain"""
+    """
+    Queue an image for publishing to the blockchain.
+
+    Returns as soon as the transaction is queued; poll `GET /api/publish/{job_id}` for the
+    transaction hash and whether it was mined.
+    """
     if not file.content_type.startswith("image/"):
         raise HTTPException(status_code=400, detail="File must be an image")
 
-    contents = await file.read()
-    print(read_image_hash())
-    image_hash = calculate_image_hash(contents)
-    exists = search_image(image_hash)
+    contents = await read_upload(file)
+    image_hash, exists, _ = await hash_and_search(contents)
+    job = None
     if not exists:
-        trx_hash = write_image_hash(image_hash)
-    else:
-        trx_hash = None
-
-
-    '''
-    # Store image metadata (replace with blockchain storage)
-    image_store[image_hash] = {
-        "filename": file.filename,
-        "content_type": file.content_type,
-        "size": len(contents),
-        "timestamp": "2025-02-08T16:13:44+01:00"  # Use actual blockchain timestamp
-    }
-    '''
+        entry = encode_hash(image_hash) if hash_format == 'packed' else image_hash
+        job = tx_submitter.submit(image_hash, entry, await publish_artifacts(contents))
 
     return ImageResponse(
         message="Image published successfully",
         hash=image_hash,
         exists=exists,
         validation=exists,
-        trx_hash=trx_hash
+        trx_hash=job.trx_hash if job else None,
+        job_id=job.id if job else None,
+        status=job.status if job else None
+    )
+
+
+def iter_archive(archive: UploadFile):
+    """
+    Yields (filename, uncompressed size, read function) for every regular file of an uploaded zip
+    or tar archive.
+    Members are read lazily when their read function is called, so the archive is left open; it
+    is closed with the upload at the end of the request. The read functions block and are meant to
+    run in a thread pool; they take turns on the archive, which one file position serves.
+    """
+    lock = threading.Lock()
+
+    def locked(read, *args):
+        with lock:
+            return read(*args)
+
+    archive.file.seek(0)
+    if zipfile.is_zipfile(archive.file):
+        archive.file.seek(0)
+        zf = zipfile.ZipFile(archive.file)
+        for info in zf.infolist():
+            if not info.is_dir():
+                yield info.filename, info.file_size, (lambda info=info: locked(zf.read, info))
+        return
+    archive.file.seek(0)
+    try:
+        tf = tarfile.open(fileobj=archive.file, mode='r:*')
+        members = [member for member in tf if member.isfile()]
+    except tarfile.TarError:
+        raise HTTPException(status_code=400, detail="Archive must be a zip or tar file")
+
+    def extract(member):
+        return tf.extractfile(member).read()
+
+    for member in members:
+        yield member.name, member.size, (lambda member=member: locked(extract, member))
+
+
+def batch_items(files: list, archive: UploadFile | None) -> list:
+    """Lists (filename, async read function) for the images of a batch request."""
+    items = []
+    for upload in files:
+        if upload.content_type and not upload.content_type.startswith("image/"):
+            raise HTTPException(status_code=400, detail=f"File must be an image: {upload.filename}")
+        items.append((upload.filename, lambda upload=upload: read_upload(upload)))
+    if archive is not None:
+        for filename, size, read in iter_archive(archive):
+            async def read_member(filename=filename, size=size, read=read):
+                # Reject by the size recorded in the archive before inflating anything
+                check_member_size(size, filename)
+                return await executor.run_search(read)
+            items.append((filename, read_member))
+    if not items:
+        raise HTTPException(status_code=400, detail="No images uploaded")
+    return items
+
+
+async def resolve_batch(items: list, keep_contents: bool = False):
+    """
+    Hashes the images of a batch concurrently and yields their results as they complete.
+
+    Verdicts are those of the whole-image hashes alone: the later frames of animations, the tile
+    index (TILE_INDEX_PATH) and the feature verifier (FEATURE_VERIFIER) are only searched for single
+    uploads.
+
+    Parameters:
+        items (list): (filename, read) pairs, see `batch_items()`.
+        keep_contents (bool): Also return the uploaded bytes of each image under "contents".
+
+    Yields:
+        list[dict]: Groups of per-image results ({"index", "filename", "hash", "exists", "error"}).
+
+    Steps:
+        1. Hash up to `batch_concurrency` images at a time in the CPU pool, reusing cached hashes
+           and still valid cached verdicts (see `hash_and_search()`).
+        2. Whenever some images finish hashing, resolve all of them against the registry in one
+           vectorized pass (`search_images()`) and yield their results.
+    """
+    semaphore = asyncio.Semaphore(batch_concurrency)
+    watermark = len(hash_index)
+
+    async def hash_item(index, filename, read):
+        result = {"index": index, "filename": filename, "hash": None, "exists": None, "error": None}
+        async with semaphore:
+            try:
+                contents = await read()
+                digest = content_digest(contents)
+                cached = result_cache.get(digest, watermark)
+                hashes = cached_hashes(cached)
+                if hashes is not None:
+                    if cached.verdict_valid(watermark):
+                        result["exists"] = cached.exists
+                else:
+                    hashes = await hash_upload(contents)
+                result["hash"] = hashes[hash_index.versions[0]]
+                result["digest"], result["hashes"] = digest, hashes
+                if keep_contents:
+                    result["contents"] = contents
+            except Exception as e:
+                result["error"] = f"Could not hash image: {e}"
+        return result
+
+    pending = {asyncio.ensure_future(hash_item(index, filename, read))
+               for index, (filename, read) in enumerate(items)}
+    try:
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            results = [task.result() for task in done]
+            unresolved = [r for r in results if r["hash"] is not None and r["exists"] is None]
+            if unresolved:
+                found = await executor.run_search(search_images, [r["hashes"] for r in unresolved])
+                for r, exists in zip(unresolved, found):
+                    r["exists"] = exists
+                    result_cache.put(r["digest"], join_hashes(r["hashes"]), exists, watermark)
+            for r in results:
+                r.pop("digest", None)
+                r.pop("hashes", None)
+            yield sorted(results, key=lambda r: r["index"])
+    finally:
+        for task in pending:
+            task.cancel()
+
+
+def ndjson(result: dict) -> str:
+    return json.dumps(result) + "\n"
+
+
+@app.post("/api/verify/batch")
+async def verify_batch(files: list[UploadFile] = File(default=[]), archive: UploadFile | None = File(default=None)):
+    """
+    Verify many images in one request.
+
+    Accepts any number of `files` and/or one zip or tar `archive`. Streams one NDJSON line per
+    image ({"index", "filename", "hash", "exists", "error"}) as soon as it is resolved.
+    """
+    items = batch_items(files, archive)
+
+    async def stream():
+        async for results in resolve_batch(items):
+            for result in results:
+                yield ndjson(result)
+
+    return StreamingResponse(stream(), media_type="application/x-ndjson")
+
+
+@app.post("/api/publish/batch")
+async def publish_batch(files: list[UploadFile] = File(default=[]), archive: UploadFile | None = File(default=None)):
+    """
+    Publish many images in one request.
+
+    Images that are not registered yet are deduplicated against each other before anything is
+    queued: an image similar to one published earlier in the same batch is reported with
+    `duplicate_of` (that image's index) instead of being sent again. The rest are queued on the
+    transaction submitter, which coalesces them into batched transactions. Streams one NDJSON
+    line per image, adding `job_id` and `status` to the verify fields.
+    """
+    items = batch_items(files, archive)
+
+    async def stream():
+        published = HashMatrix(nbits=VERSIONS[hash_index.versions[0]].nbits)
+        published_indexes = []
+        keep_contents = feature_verifier is not None or tile_index is not None or thumbnail_store is not None
+        async for results in resolve_batch(items, keep_contents=keep_contents):
+            for result in results:
+                contents = result.pop("contents", None)
+                result.update(job_id=None, status=None, duplicate_of=None)
+                if result["hash"] is not None and result["exists"] is False:
+                    if len(published):
+                        sims = published.similarities(result["hash"])['avg_similarity']
+                        matches = (sims > MATCH_THRESHOLD).nonzero()[0]
+                        if len(matches):
+                            result["duplicate_of"] = published_indexes[matches[0]]
+                    if result["duplicate_of"] is None:
+                        entry = encode_hash(result["hash"]) if hash_format == 'packed' else result["hash"]
+                        artifacts = await publish_artifacts(contents) if contents is not None else None
+                        job = tx_submitter.submit(result["hash"], entry, artifacts)
+                        result["job_id"], result["status"] = job.id, job.status
+                        published.append([result["hash"]])
+                        published_indexes.append(result["index"])
+                yield ndjson(result)
+
+    return StreamingResponse(stream(), media_type="application/x-ndjson")
+
+
+@app.get("/api/publish/{job_id}", response_model=PublishStatusResponse)
+async def publish_status(job_id: str):
+    """Report whether a queued publish is pending, submitted, mined or failed"""
+    job = tx_submitter.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Unknown publish job")
+
+    return PublishStatusResponse(
+        job_id=job.id,
+        status=job.status,
+        hash=job.hash,
+        trx_hash=job.trx_hash,
+        block_number=job.block_number,
+        error=job.error
+    )
+
+
+@app.get("/api/proof/{index}", response_model=ProofResponse)
+async def inclusion_proof(index: int, source: str = Query(default='legacy', pattern='^(legacy|packed)$'),
+                          size: int | None = Query(default=None, ge=1)):
+    """
+    Prove that a registry entry is in the Merkle tree of its registry array (see merkle.py).
+
+    Parameters:
+        index (int): The position of the entry in the registry array.
+        source (str): The registry array: 'legacy' (`hashes`) or 'packed' (`packedHashes`).
+        size (int): The number of leaves of the tree to prove against. Defaults to the latest
+                    anchored tree containing the entry, so the root can be checked on-chain, or to
+                    the whole current tree if none is anchored yet.
+
+    Returns:
+        ProofResponse: The entry (hex for packed entries) and its hash string, its leaf hash, the
+                       tree size, root and audit path (sibling hashes from the leaf up, hex), and
+                       the anchor of that root if it has been mined.
+
+    A verifier hashes the entry into the leaf, folds in the path (RFC 9162, section 2.1.3.2, see
+    `merkle.verify_inclusion()`) and compares the result with the anchored root: log2(size)
+    hashes instead of the whole registry.
+    """
+    source_id = {name: source_id for source_id, name in SOURCE_NAMES.items()}[source]
+    if source_id not in hash_index.sources:
+        raise HTTPException(status_code=404, detail=f"The {source} registry array is not mirrored")
+    current = merkle_log.size(source_id)
+    if size is None:
+        latest = merkle_log.latest_anchor(source_id, min_size=index + 1)
+        size = latest['size'] if latest else current
+    elif size > current:
+        raise HTTPException(status_code=400, detail=f"The tree has {current} leaves, not {size}")
+    entry = hash_index.entry_at(source_id, index)
+    if index < 0 or index >= size or entry is None:
+        raise HTTPException(status_code=404, detail=f"No entry {index} in a tree of {size} leaves")
+
+    path, root = await executor.run_search(merkle_log.proof, source_id, index, size)
+    anchor = merkle_log.get_anchor(source_id, size)
+
+    return ProofResponse(
+        index=index,
+        source=source,
+        entry=entry.hex() if isinstance(entry, bytes) else entry,
+        hash=to_hash_string(entry),
+        leaf=leaf_hash(entry).hex(),
+        size=size,
+        root=root.hex(),
+        path=[sibling.hex() for sibling in path],
+        anchor=MerkleAnchor(size=anchor['size'], root=anchor['root'].hex(), trx_hash=anchor['trx_hash'],
+                            block_number=anchor['block_number']) if anchor else None
     )
 
 
 @app.post("/api/verify", response_model=ImageResponse)
 async def verify_image(file: UploadFile):
-    """Verify if image exists on blockchain"""
+    """
+    Verify if image exists on blockchain
+
+    `ssim` is the best SSIM between the image and the stored thumbnails of the registered hashes
+    the search found near it (see `ssim_rerank()`), or null when there are none or none of them has
+    a thumbnail.
+    """
     if not file.content_type.startswith("image/"):
         raise HTTPException(status_code=400, detail="File must be an image")
 
-    contents = await file.read()
-    image_hash = calculate_image_hash(contents)
-    exists = search_image(image_hash)
+    contents = await read_upload(file)
+    image_hash, exists, candidates = await hash_and_search(contents)
+    ranked = await ssim_rerank(image_hash, contents, exists, candidates)
 
-    print(image_hash)
+    log.debug("Verified image", extra={"hash": image_hash, "exists": exists})
 
     return ImageResponse(
         message="Image verification complete",
         hash=image_hash,
         exists=exists,
-        validation=exists
+        validation=exists,
+        ssim=ranked[0]['ssim'] if ranked else None
+    )
+
+
+@app.post("/api/search", response_model=SearchResponse)
+async def search_registry(file: UploadFile,
+                          k: int = Query(default=5, ge=1),
+                          threshold: float = Query(default=MATCH_THRESHOLD, ge=0.0, le=100.0)):
+    """
+    Find the registered images closest to an image.
+
+    Parameters:
+        file (UploadFile): The image searched for.
+        k (int): The number of closest registry entries to return (at most SEARCH_MAX_K).
+        threshold (float): The average similarity (%) above which an entry counts as the same
+                           image, instead of the default 80.
+
+    Returns:
+        SearchResponse: The composite hash, whether an entry is above the threshold, and the k
+                        closest entries with their registry position and per-hash similarities.
+
+    Steps:
+        1. Reuse the cached hashes of the upload, or hash it in the CPU pool in every searched hash version.
+        2. Score it against every registered hash in one vectorized pass, keeping the k best with a
+           partial sort (see `search_top_k()`).
+    """
+    if not file.content_type.startswith("image/"):
+        raise HTTPException(status_code=400, detail="File must be an image")
+    if k > search_max_k:
+        raise HTTPException(status_code=400, detail=f"k must be at most {search_max_k}")
+
+    contents = await read_upload(file)
+    digest = content_digest(contents)
+    watermark = len(hash_index)
+    hashes = cached_hashes(result_cache.get(digest, watermark))
+    if hashes is None:
+        hashes = await hash_upload(contents)
+        result_cache.put(digest, join_hashes(hashes), None, watermark)
+    matches = await executor.run_search(search_top_k, hashes, k, threshold)
+
+    return SearchResponse(
+        message="Image search complete",
+        hash=hashes[hash_index.versions[0]],
+        exists=any(match['match'] for match in matches),
+        threshold=threshold,
+        matches=matches
     )
 
 
-@app.post("/api/check", response_model=ImageResponse)
+@app.post("/api/check", response_model=CheckResponse)
 async def check_image(file: UploadFile):
-    """Validate image properties and check for tampering"""
+    """
+    Validate image properties and check for tampering.
+
+    The properties come from the container headers only (see `probe_image()`): the upload is read
+    straight from its spooled file, without copying it into memory or decoding any pixels, so the
+    cost does not grow with the resolution of the image.
+    """
     if not file.content_type.startswith("image/"):
         raise HTTPException(status_code=400, detail="File must be an image")
 
-    contents = await file.read()
-    image = Image.open(io.BytesIO(contents))
-    validation_result = validate_image(image)
+    validation_result = probe_image(file.file)
 
-    return ImageResponse(
+    return CheckResponse(
         message="Image validation complete",
         validation=validation_result
     )
 
 
+@app.get("/api/cache/stats")
+async def cache_stats():
+    """Hit/miss counters of the upload result cache"""
+    return result_cache.stats()
+
+
+@app.get("/metrics")
+async def metrics():
+    """Prometheus scrape endpoint: per-stage latency histograms, error and cache counters, registry size."""
+    return PlainTextResponse(METRICS.render(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
+
 @app.get("/health")
 async def health_check():
     """Health check endpoint"""
     return {"status": "healthy"}
+
+
+@app.get("/ready")
+async def readiness_check():
+    """
+    Readiness probe, separate from the /health liveness check: the registry (on-chain: the node)
+    answers and the hash index has synced with it at least once. Returns 503 until both hold, so
+    traffic is held back during RPC outages without the process being restarted.
+    """
+    registry_ready = await executor.run_chain(registry.ready)
+    index_ready = hash_index.has_synced()
+    content = {"status": "ready" if registry_ready and index_ready else "not ready",
+               "registry": registry_ready, "hash_index": index_ready, "hashes": len(hash_index)}
+    return JSONResponse(status_code=200 if registry_ready and index_ready else 503, content=content)
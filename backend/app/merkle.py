@@ -0,0 +1,370 @@
+"""
+Append-only Merkle tree over the registry, for inclusion proofs that do not need the whole registry.
+
+Proving that an entry is registered used to mean downloading every entry (`getAllHashes()`). The
+mirror of each registry array (see hash_index.py) now also feeds a Merkle tree, in registry order,
+whose root is periodically anchored on-chain. A third party verifies an entry with its position, the
+log2(n) sibling hashes `MerkleLog.proof()` returns and an anchored root.
+
+Hashing follows RFC 6962 (Certificate Transparency), so existing verifiers work unchanged:
+    - leaf = SHA-256(0x00 || entry), the entry as stored on-chain: the UTF-8 hash string for the
+      legacy `hashes` array, the raw bytes for `packedHashes`
+    - node = SHA-256(0x01 || left || right)
+    - a tree of n leaves that is not a power of two splits after the largest power of two below n
+
+Only complete subtrees are stored, so an append writes its leaf and the parents it completes
+(O(log n) at worst, O(1) amortized), and a root or proof reads O(log n) of them.
+"""
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+from dotenv import load_dotenv
+from .registry import registry_backend
+from .log import get_logger
+
+load_dotenv()
+log = get_logger('merkle')
+
+# SQLite file holding the Merkle tree nodes and anchored roots. Like the hash index, the tree of an
+# in-memory registry does not outlive the process.
+merkle_path = os.getenv('MERKLE_PATH', ':memory:' if registry_backend == 'memory' else 'merkle.db')
+# Interval (seconds) between on-chain anchors of the roots that changed. Each anchor is a transaction
+# paid by the publishing account, so anchoring is off (0) unless an interval is set.
+anchor_interval = float(os.getenv('MERKLE_ANCHOR_INTERVAL', '0'))
+
+# Prefix of the calldata of an anchor transaction, followed by the source (1 byte), the tree size
+# (8 bytes, big-endian) and the root (32 bytes)
+ANCHOR_MAGIC = b'pxlroot1'
+EMPTY_ROOT = hashlib.sha256(b'').digest()
+
+
+def leaf_hash(entry: str | bytes) -> bytes:
+    """The RFC 6962 leaf hash of a registry entry."""
+    data = entry.encode() if isinstance(entry, str) else bytes(entry)
+    return hashlib.sha256(b'\x00' + data).digest()
+
+
+def node_hash(left: bytes, right: bytes) -> bytes:
+    """The RFC 6962 hash of an interior node."""
+    return hashlib.sha256(b'\x01' + left + right).digest()
+
+
+def _split(n: int) -> int:
+    """The largest power of two smaller than n (n > 1)."""
+    return 1 << ((n - 1).bit_length() - 1)
+
+
+def merkle_root(entries: list) -> bytes:
+    """The RFC 6962 root of a list of registry entries, computed from the entries alone."""
+    if not entries:
+        return EMPTY_ROOT
+    if len(entries) == 1:
+        return leaf_hash(entries[0])
+    k = _split(len(entries))
+    return node_hash(merkle_root(entries[:k]), merkle_root(entries[k:]))
+
+
+def verify_inclusion(entry: str | bytes, index: int, size: int, path: list, root: bytes) -> bool:
+    """
+    Checks an inclusion proof (RFC 9162, section 2.1.3.2) without any app state.
+
+    Parameters:
+        entry (str | bytes): The registry entry.
+        index (int): Its position in the registry array.
+        size (int): The number of leaves of the tree the proof was made for.
+        path (list[bytes]): The sibling hashes, from the leaf up.
+        root (bytes): The root of the tree of that size, e.g. an anchored one.
+    """
+    if index >= size:
+        return False
+    fn, sn = index, size - 1
+    r = leaf_hash(entry)
+    for sibling in path:
+        if sn == 0:
+            return False
+        if fn & 1 or fn == sn:
+            r = node_hash(sibling, r)
+            while not fn & 1 and fn != 0:
+                fn >>= 1
+                sn >>= 1
+        else:
+            r = node_hash(r, sibling)
+        fn >>= 1
+        sn >>= 1
+    return sn == 0 and r == root
+
+
+def anchor_data(source: int, size: int, root: bytes) -> bytes:
+    """The calldata of the transaction anchoring a root."""
+    return ANCHOR_MAGIC + bytes([source]) + size.to_bytes(8, 'big') + root
+
+
+def _anchor(row) -> dict | None:
+    if row is None:
+        return None
+    return {"size": row[0], "root": bytes(row[1]), "trx_hash": row[2], "block_number": row[3], "anchored": row[4]}
+
+
+class MerkleLog:
+    """
+    One append-only Merkle tree per registry source, persisted in SQLite, with the roots anchored so far.
+
+    Layout:
+        - `merkle_nodes`: the complete subtrees, keyed by (source, level, position). Level 0 holds
+          the leaves; the node at (level, p) covers leaves p * 2^level to (p + 1) * 2^level - 1.
+        - `merkle_anchors`: the mined anchors, one row per (source, size) with its root and transaction.
+
+    The hash index leader appends through `extend()` whenever it mirrors registry entries, including
+    the whole mirror when it loads, so a tree that is missing or does not match the mirror is rebuilt
+    from it. That process also keeps the frontier (the last node of each level) in memory and anchors
+    the roots. Other worker processes answer proofs from the database the leader writes.
+
+    Parameters:
+        path (str): Location of the database file.
+        anchor_interval (float): Seconds between anchors once `start_anchoring()` has been called
+                                 (0 never anchors).
+    """
+
+    def __init__(self, path: str, anchor_interval: float = 0.0):
+        self.path = path
+        self.anchor_interval = anchor_interval
+        self.writer = False
+        self._frontiers = {}
+        self._sizes = {}
+        self._anchored = {}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._anchorer = None
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        # The leader writes while the other workers read
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS merkle_nodes (source INTEGER NOT NULL, level INTEGER NOT NULL, "
+            "position INTEGER NOT NULL, hash BLOB NOT NULL, PRIMARY KEY (source, level, position)) WITHOUT ROWID")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS merkle_anchors (source INTEGER NOT NULL, size INTEGER NOT NULL, "
+            "root BLOB NOT NULL, trx_hash TEXT, block_number INTEGER, anchored REAL NOT NULL, "
+            "PRIMARY KEY (source, size))")
+        self._conn.commit()
+
+    def _node(self, source: int, level: int, position: int) -> bytes | None:
+        row = self._conn.execute("SELECT hash FROM merkle_nodes WHERE source = ? AND level = ? AND position = ?",
+                                 (source, level, position)).fetchone()
+        return None if row is None else bytes(row[0])
+
+    def _stored_size(self, source: int) -> int:
+        row = self._conn.execute("SELECT MAX(position) FROM merkle_nodes WHERE source = ? AND level = 0",
+                                 (source,)).fetchone()
+        return 0 if row[0] is None else row[0] + 1
+
+    def _load(self, source: int):
+        """Read the size and frontier of a tree the first time this process appends to it."""
+        size = self._stored_size(source)
+        self._sizes[source] = size
+        self._frontiers[source] = {level: self._node(source, level, (size >> level) - 1)
+                                   for level in range(size.bit_length()) if size >> level}
+        anchored = self._latest_anchor(source)
+        self._anchored[source] = anchored['size'] if anchored else 0
+
+    def _reset(self, source: int):
+        # Anchors of the old tree are not roots of this registry either
+        self._conn.execute("DELETE FROM merkle_nodes WHERE source = ?", (source,))
+        self._conn.execute("DELETE FROM merkle_anchors WHERE source = ?", (source,))
+        self._conn.commit()
+        self._sizes[source] = 0
+        self._frontiers[source] = {}
+        self._anchored[source] = 0
+
+    def size(self, source: int) -> int:
+        """The number of leaves of a tree."""
+        with self._lock:
+            if source in self._sizes:
+                return self._sizes[source]
+            return self._stored_size(source)
+
+    def extend(self, source: int, position: int, entries: list):
+        """
+        Append registry entries, given from their registry position on, to the tree of their source.
+
+        Entries the tree already holds are skipped, after checking that the tree agrees with them.
+        When the entries start at 0 (the hash index passes its whole mirror when it loads), the stored
+        root over the overlapping prefix must equal the root recomputed from the entries, so a tree
+        built from another registry is rebuilt even if it happens to share its last leaf. A later
+        batch only overlaps by the entries appended since, so its last overlapping leaf is compared.
+        """
+        with self._lock:
+            self.writer = True
+            if source not in self._sizes:
+                self._load(source)
+            size = self._sizes[source]
+            overlap = min(size, position + len(entries)) - position
+            if overlap > 0 and not self._matches(source, position, entries[:overlap]):
+                if position != 0:
+                    log.error("Merkle tree does not match the registry", extra={"source": source, "position": position})
+                    return
+                log.warning("Rebuilding Merkle tree from the registry mirror", extra={"source": source})
+                self._reset(source)
+                size, overlap = 0, 0
+            if position > size:
+                log.error("Merkle tree is missing entries", extra={"source": source, "size": size, "position": position})
+                return
+
+            frontier = self._frontiers[source]
+            rows = []
+            for index, entry in enumerate(entries[overlap:], start=size):
+                node = leaf_hash(entry)
+                level, offset = 0, index
+                # A right child completes its parent, whose left child is the previous node of the level
+                while True:
+                    rows.append((source, level, offset, node))
+                    left = frontier.get(level)
+                    frontier[level] = node
+                    if not offset & 1:
+                        break
+                    node = node_hash(left, node)
+                    level, offset = level + 1, offset >> 1
+            if rows:
+                self._conn.executemany(
+                    "INSERT OR REPLACE INTO merkle_nodes (source, level, position, hash) VALUES (?, ?, ?, ?)", rows)
+                self._conn.commit()
+            self._sizes[source] = size + len(entries) - overlap
+
+    def _matches(self, source: int, position: int, entries: list) -> bool:
+        """Whether the stored tree holds `entries` from `position` on (see `extend()`)."""
+        if position == 0:
+            try:
+                return self._range_hash(source, 0, len(entries), {}) == merkle_root(entries)
+            except LookupError:
+                return False
+        return self._node(source, 0, position + len(entries) - 1) == leaf_hash(entries[-1])
+
+    def _range_hash(self, source: int, start: int, stop: int, nodes: dict) -> bytes:
+        """The hash of the subtree over leaves start to stop - 1, as RFC 6962 splits it."""
+        n = stop - start
+        if n & (n - 1) == 0:
+            # A complete subtree: stored
+            level = n.bit_length() - 1
+            key = (level, start >> level)
+            if key not in nodes:
+                nodes[key] = self._node(source, *key)
+                if nodes[key] is None:
+                    raise LookupError(f"Merkle node {key} of source {source} is missing")
+            return nodes[key]
+        k = _split(n)
+        return node_hash(self._range_hash(source, start, start + k, nodes),
+                         self._range_hash(source, start + k, stop, nodes))
+
+    def root(self, source: int, size: int = None) -> bytes:
+        """The root of the tree of a source over its first `size` leaves (by default all of them)."""
+        with self._lock:
+            size = self._sizes.get(source) if size is None else size
+            if size is None:
+                size = self._stored_size(source)
+            return self._range_hash(source, 0, size, {}) if size else EMPTY_ROOT
+
+    def proof(self, source: int, index: int, size: int) -> tuple:
+        """
+        The inclusion proof of a leaf in the tree over the first `size` leaves (RFC 6962 audit path).
+
+        Returns:
+            tuple[list[bytes], bytes]: The sibling hashes from the leaf up, and the root they lead to.
+        """
+        if not 0 <= index < size:
+            raise IndexError(f"Leaf {index} is not in a tree of {size} leaves")
+        with self._lock:
+            nodes = {}
+            path = []
+            start, stop, offset = 0, size, index
+            while stop - start > 1:
+                k = _split(stop - start)
+                if offset < k:
+                    path.append(self._range_hash(source, start + k, stop, nodes))
+                    stop = start + k
+                else:
+                    path.append(self._range_hash(source, start, start + k, nodes))
+                    start, offset = start + k, offset - k
+            return path[::-1], self._range_hash(source, 0, size, nodes)
+
+    def _latest_anchor(self, source: int, min_size: int = 0) -> dict | None:
+        row = self._conn.execute(
+            "SELECT size, root, trx_hash, block_number, anchored FROM merkle_anchors "
+            "WHERE source = ? AND size >= ? ORDER BY size DESC LIMIT 1", (source, min_size)).fetchone()
+        return _anchor(row)
+
+    def latest_anchor(self, source: int, min_size: int = 0) -> dict | None:
+        """The largest anchored tree of a source with at least `min_size` leaves, or None."""
+        with self._lock:
+            return self._latest_anchor(source, min_size)
+
+    def get_anchor(self, source: int, size: int) -> dict | None:
+        """The mined anchor of the tree of a source over its first `size` leaves, or None."""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT size, root, trx_hash, block_number, anchored FROM merkle_anchors WHERE source = ? AND size = ?",
+                (source, size)).fetchone()
+        return _anchor(row)
+
+    def record_anchor(self, source: int, size: int, root: bytes, trx_hash: str = None, block_number: int = None):
+        """Keep the record of a mined anchor."""
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO merkle_anchors (source, size, root, trx_hash, block_number, anchored) "
+                "VALUES (?, ?, ?, ?, ?, ?)", (source, size, root, trx_hash, block_number, time.time()))
+            self._conn.commit()
+
+    def unanchored(self) -> dict:
+        """Leaves appended since the last anchor, per source (of the trees this process appends to)."""
+        with self._lock:
+            return {source: size - self._anchored[source] for source, size in self._sizes.items()}
+
+    def anchor(self, submit) -> list:
+        """
+        Submit the root of every tree that grew since it was last anchored.
+
+        Parameters:
+            submit (callable): Called with (source, size, root, calldata) for each root, e.g.
+                               `TransactionSubmitter.submit_anchor()`.
+
+        Returns:
+            list: What `submit` returned for each root. Does nothing outside the process appending
+                  to the trees.
+        """
+        with self._lock:
+            if not self.writer:
+                return []
+            due = [(source, size) for source, size in self._sizes.items() if size > self._anchored[source]]
+        submitted = []
+        for source, size in due:
+            root = self.root(source, size)
+            submitted.append(submit(source, size, root, anchor_data(source, size, root)))
+            # A root whose transaction fails is not sent again, the next growth of the tree is
+            with self._lock:
+                self._anchored[source] = max(self._anchored[source], size)
+        return submitted
+
+    def _anchor_loop(self, submit):
+        while not self._stop.wait(self.anchor_interval):
+            try:
+                self.anchor(submit)
+            except Exception as e:
+                log.error("Error anchoring Merkle roots", extra={"error": str(e)})
+
+    def start_anchoring(self, submit):
+        """Start a daemon thread that calls `anchor(submit)` every `anchor_interval` seconds."""
+        if self.anchor_interval <= 0 or (self._anchorer is not None and self._anchorer.is_alive()):
+            return
+        self._stop.clear()
+        self._anchorer = threading.Thread(target=self._anchor_loop, args=(submit,), name="merkle-anchorer",
+                                          daemon=True)
+        self._anchorer.start()
+
+    def stop_anchoring(self):
+        self._stop.set()
+        if self._anchorer is not None:
+            self._anchorer.join(timeout=1)
+            self._anchorer = None
+
+
+merkle_log = MerkleLog(merkle_path, anchor_interval=anchor_interval)
@@ -0,0 +1,182 @@
+import bisect
+import math
+import threading
+import time
+from contextlib import contextmanager
+
+# Latency buckets (seconds), from sub-millisecond index scans to slow chain round trips
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0,
+                   30.0, 60.0, 120.0, 300.0)
+
+
+def _format_value(value: float) -> str:
+    if math.isinf(value):
+        return '+Inf' if value > 0 else '-Inf'
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+def _escape(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _labels_text(names: tuple, values: tuple, extra: str = '') -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+class MetricsRegistry:
+    """The metrics of the process, rendered in the Prometheus text exposition format (0.0.4)."""
+
+    def __init__(self):
+        self._metrics = []
+        self._lock = threading.Lock()
+
+    def register(self, metric):
+        with self._lock:
+            if any(existing.name == metric.name for existing in self._metrics):
+                raise ValueError(f"Duplicate metric: {metric.name}")
+            self._metrics.append(metric)
+
+    def render(self) -> str:
+        with self._lock:
+            metrics = list(self._metrics)
+        lines = []
+        for metric in metrics:
+            lines.append(f"# HELP {metric.name} {metric.documentation}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            lines.extend(metric.samples())
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = MetricsRegistry()
+
+
+class _Metric:
+    """
+    Base of the metric types: a value per combination of label values.
+
+    Parameters:
+        name (str): Metric name, e.g. "pxlproof_rpc_errors_total".
+        documentation (str): The HELP text.
+        labelnames (tuple[str]): Names of the labels every update has to provide.
+        callback (callable): Instead of being updated, read the current values when scraped: the
+                             callback returns a number, or a {label values tuple: number} dict.
+    """
+    kind = 'untyped'
+
+    def __init__(self, name: str, documentation: str, labelnames=(), callback=None,
+                 registry: MetricsRegistry = REGISTRY):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.callback = callback
+        self._values = {}
+        self._lock = threading.Lock()
+        registry.register(self)
+
+    def _key(self, labels: dict) -> tuple:
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"{self.name} expects labels {self.labelnames}, got {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def _current(self) -> dict:
+        if self.callback is None:
+            with self._lock:
+                return dict(self._values)
+        try:
+            values = self.callback()
+        except Exception:
+            # A broken callback must not take the whole scrape down
+            return {}
+        if not isinstance(values, dict):
+            values = {(): values}
+        return {tuple(str(value) for value in key): value for key, value in values.items()}
+
+    def samples(self) -> list:
+        return [f"{self.name}{_labels_text(self.labelnames, key)} {_format_value(value)}"
+                for key, value in sorted(self._current().items())]
+
+
+class Counter(_Metric):
+    """A value that only goes up (errors, cache hits, ...)."""
+    kind = 'counter'
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(_Metric):
+    """A value that goes up and down (registry size, queue depth, ...)."""
+    kind = 'gauge'
+
+    def set(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+
+class Histogram(_Metric):
+    """
+    Distribution of observed values (latencies) over fixed buckets, with their sum and count.
+
+    Parameters:
+        buckets (tuple[float]): Upper bounds of the buckets, ascending; +Inf is implied.
+    """
+    kind = 'histogram'
+
+    def __init__(self, name: str, documentation: str, labelnames=(), buckets=DEFAULT_BUCKETS,
+                 registry: MetricsRegistry = REGISTRY):
+        super().__init__(name, documentation, labelnames, registry=registry)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                # Per-bucket (non cumulative) counts, then the sum of the observations
+                state = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0]
+            state[0][bisect.bisect_left(self.buckets, value)] += 1
+            state[1] += value
+
+    @contextmanager
+    def time(self, **labels):
+        """Observe the wall time spent in the `with` block."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def samples(self) -> list:
+        with self._lock:
+            values = {key: (list(state[0]), state[1]) for key, state in self._values.items()}
+        lines = []
+        for key, (counts, total) in sorted(values.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (math.inf,), counts):
+                cumulative += count
+                le = f'le="{_format_value(bound)}"'
+                lines.append(f"{self.name}_bucket{_labels_text(self.labelnames, key, le)} {cumulative}")
+            lines.append(f"{self.name}_sum{_labels_text(self.labelnames, key)} {_format_value(total)}")
+            lines.append(f"{self.name}_count{_labels_text(self.labelnames, key)} {cumulative}")
+        return lines
+
+
+# Hot path instrumentation shared by the modules
+STAGE_SECONDS = Histogram(
+    'pxlproof_stage_duration_seconds',
+    'Time spent per request stage: decode, hash, registry_fetch, similarity_scan, frame_hash, tile_hash, tile_vote, '
+    'feature_extract, feature_match, thumbnail, ssim_rerank, chain_submit, chain_receipt, registry_append.',
+    ['stage'])
+RPC_ERRORS = Counter('pxlproof_rpc_errors_total', 'Failed chain RPC attempts, retried or not.', ['call'])
+INCOMPATIBLE_HASHES = Counter(
+    'pxlproof_incompatible_hashes_total',
+    'Hashes that could not be decoded and were skipped, in the registry or as a search query.',
+    ['where'])
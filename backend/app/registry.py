@@ -0,0 +1,201 @@
+import os
+import sqlite3
+import threading
+from abc import ABC, abstractmethod
+from dotenv import load_dotenv
+from .callSC import (get_total_hashes, get_hash, get_total_packed_hashes, get_packed_hash, get_pending_nonce,
+                     send_add_hash, send_add_hashes, wait_for_receipt, check_ready)
+
+load_dotenv()
+
+# Where published hashes are registered: 'chain' (the contract), 'sqlite' or 'memory' (offline modes)
+registry_backend = os.getenv('REGISTRY_BACKEND', 'chain')
+# SQLite file of the 'sqlite' backend
+registry_path = os.getenv('REGISTRY_PATH', 'registry.db')
+
+# Registry arrays: legacy "ahash#dhash#phash" strings (`hashes`) and binary entries (`packedHashes`)
+LEGACY_SOURCE = 0
+PACKED_SOURCE = 1
+SOURCES = (LEGACY_SOURCE, PACKED_SOURCE)
+# SQLite table holding each array
+TABLES = {LEGACY_SOURCE: 'hashes', PACKED_SOURCE: 'packed_hashes'}
+
+
+def source_of(entry) -> int:
+    """The array an entry belongs to: binary entries (see hash_codec) go to `packedHashes`."""
+    return PACKED_SOURCE if isinstance(entry, bytes) else LEGACY_SOURCE
+
+
+class HashRegistry(ABC):
+    """
+    Append-only store the composite hashes are published to.
+
+    Each source (`LEGACY_SOURCE`, `PACKED_SOURCE`) is its own sequence indexed from 0, like the
+    contract's `hashes` and `packedHashes` arrays. An entry never moves once appended, so a reader
+    only needs to remember how many entries of each source it has seen (its cursor).
+
+    Subclasses must implement (an incomplete one cannot be instantiated):
+        count(source): The number of entries, or None if the backend cannot be reached.
+        iter_since(cursor, source, total): The entries from position `cursor` up to `total` (the
+                                           caller's `count()`, read again if None), in order. May
+                                           stop early if the backend fails mid-way; callers compare
+                                           with the count.
+        append_many(entries): Append entries (strings and/or bytes, each to its source) and return
+                              a reference to the write (the transaction hash on-chain), raising on
+                              failure.
+
+    and may override `ready()`, the readiness probe of the backend (always ready by default).
+
+    `on_chain` tells whether appends are blockchain transactions, which the `TransactionSubmitter`
+    pipelines itself instead of calling `append_many()`.
+    """
+    on_chain = False
+
+    @abstractmethod
+    def count(self, source: int = LEGACY_SOURCE) -> int | None:
+        ...
+
+    @abstractmethod
+    def iter_since(self, cursor: int, source: int = LEGACY_SOURCE, total: int = None):
+        ...
+
+    @abstractmethod
+    def append_many(self, entries: list) -> str | None:
+        ...
+
+    def ready(self) -> bool:
+        return True
+
+
+class MemoryRegistry(HashRegistry):
+    """Registry kept in process memory, for tests, benchmarks and throwaway offline runs."""
+
+    def __init__(self):
+        self._entries = {source: [] for source in SOURCES}
+        self._lock = threading.Lock()
+
+    def count(self, source: int = LEGACY_SOURCE) -> int:
+        return len(self._entries[source])
+
+    def iter_since(self, cursor: int, source: int = LEGACY_SOURCE, total: int = None):
+        with self._lock:
+            entries = self._entries[source][cursor:total]
+        yield from entries
+
+    def append_many(self, entries: list) -> None:
+        with self._lock:
+            for entry in entries:
+                self._entries[source_of(entry)].append(entry)
+        return None
+
+
+class SQLiteRegistry(HashRegistry):
+    """
+    Registry stored in a SQLite file in WAL mode, for offline deployments. Several worker processes
+    can append to the same file: each append runs in an IMMEDIATE transaction, so positions are
+    assigned one writer at a time while readers keep reading.
+
+    Parameters:
+        path (str): Location of the database file.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS hashes (position INTEGER PRIMARY KEY, hash TEXT NOT NULL)")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS packed_hashes (position INTEGER PRIMARY KEY, hash BLOB NOT NULL)")
+
+    def count(self, source: int = LEGACY_SOURCE) -> int:
+        with self._lock:
+            return self._conn.execute(f"SELECT COUNT(*) FROM {TABLES[source]}").fetchone()[0]
+
+    def iter_since(self, cursor: int, source: int = LEGACY_SOURCE, total: int = None):
+        if total is None:
+            query, params = "position >= ?", (cursor,)
+        else:
+            query, params = "position >= ? AND position < ?", (cursor, total)
+        with self._lock:
+            rows = self._conn.execute(
+                f"SELECT hash FROM {TABLES[source]} WHERE {query} ORDER BY position", params).fetchall()
+        for row in rows:
+            yield row[0]
+
+    def append_many(self, entries: list) -> None:
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                for source in SOURCES:
+                    batch = [entry for entry in entries if source_of(entry) == source]
+                    if not batch:
+                        continue
+                    table = TABLES[source]
+                    start = self._conn.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0]
+                    self._conn.executemany(f"INSERT INTO {table} (position, hash) VALUES (?, ?)",
+                                           [(start + i, entry) for i, entry in enumerate(batch)])
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+        return None
+
+
+class ChainRegistry(HashRegistry):
+    """
+    The contract's `hashes` and `packedHashes` arrays, read one indexed getter call at a time.
+
+    `append_many()` sends one transaction and waits for its receipt, like `add_hash()`; the publish
+    endpoints go through the pipelined `TransactionSubmitter` instead.
+    """
+    on_chain = True
+
+    def count(self, source: int = LEGACY_SOURCE) -> int | None:
+        return get_total_packed_hashes() if source == PACKED_SOURCE else get_total_hashes()
+
+    def iter_since(self, cursor: int, source: int = LEGACY_SOURCE, total: int = None):
+        if total is None:
+            # Callers that already know the count pass it in, which saves a getTotal*() call
+            total = self.count(source)
+        if total is None:
+            return
+        get_entry = get_packed_hash if source == PACKED_SOURCE else get_hash
+        for position in range(cursor, total):
+            entry = get_entry(position)
+            if entry is None:
+                # Read failed, the caller retries from here on its next pass
+                return
+            yield entry
+
+    def append_many(self, entries: list) -> str:
+        nonce = get_pending_nonce()
+        if len(entries) == 1:
+            tx_hash = send_add_hash(entries[0], nonce)
+        else:
+            if len({source_of(entry) for entry in entries}) > 1:
+                raise ValueError("A single transaction cannot mix string and binary hashes")
+            tx_hash = send_add_hashes(entries, nonce)
+        receipt = wait_for_receipt(tx_hash)
+        if receipt['status'] != 1:
+            raise RuntimeError(f"Transaction {tx_hash.hex()} reverted")
+        return tx_hash.hex()
+
+    def ready(self) -> bool:
+        return check_ready()
+
+
+def create_registry(backend: str, path: str = '') -> HashRegistry:
+    """Build the registry selected by `REGISTRY_BACKEND`."""
+    if backend == 'chain':
+        return ChainRegistry()
+    if backend == 'sqlite':
+        return SQLiteRegistry(path)
+    if backend == 'memory':
+        return MemoryRegistry()
+    raise ValueError(f"Unknown registry backend: {backend}")
+
+
+registry = create_registry(registry_backend, registry_path)
@@ -0,0 +1,161 @@
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from dotenv import load_dotenv
+from .log import get_logger
+
+load_dotenv()
+log = get_logger('result_cache')
+
+# Maximum entries kept in memory
+max_entries = int(os.getenv('RESULT_CACHE_SIZE', '10000'))
+# Seconds an entry stays valid
+ttl = float(os.getenv('RESULT_CACHE_TTL', '3600'))
+# Optional SQLite file shared by all workers on the host (disabled when empty)
+disk_path = os.getenv('RESULT_CACHE_PATH', '')
+
+
+def content_digest(contents: bytes) -> str:
+    """SHA-256 of the uploaded bytes, the cache key."""
+    return hashlib.sha256(contents).hexdigest()
+
+
+@dataclass
+class CachedResult:
+    """
+    What was computed for one exact upload: its composite hash, and the search verdict together with
+    the registry size (watermark) the verdict was computed at.
+    """
+    hash: str
+    exists: bool | None
+    watermark: int
+    stored: float
+
+    def verdict_valid(self, watermark: int) -> bool:
+        """
+        The registry is append-only, so a positive verdict stays true. A negative verdict only holds
+        until the registry grows past the watermark it was computed at.
+        """
+        if self.exists is None:
+            return False
+        return self.exists or watermark <= self.watermark
+
+
+class ResultCache:
+    """
+    Content-addressed LRU + TTL cache for repeat uploads.
+
+    Keyed by the SHA-256 of the uploaded bytes, it stores the composite perceptual hash (which never
+    changes for the same bytes) and the last search verdict. A hit skips decoding and hashing; a hit
+    with a still valid verdict also skips the registry scan.
+
+    Parameters:
+        max_entries (int): Entries kept in the in-process tier before the least recently used is evicted.
+        ttl (float): Seconds after which an entry is ignored and dropped.
+        disk_path (str): Optional SQLite file used as a shared second tier, looked up on in-process misses.
+    """
+
+    def __init__(self, max_entries: int = 10000, ttl: float = 3600.0, disk_path: str = ''):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.disk_hits = 0
+        self.stale_verdicts = 0
+
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._conn = None
+        if disk_path:
+            self._conn = sqlite3.connect(disk_path, check_same_thread=False, timeout=1.0)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS results (digest TEXT PRIMARY KEY, hash TEXT NOT NULL, "
+                "exists_ INTEGER, watermark INTEGER NOT NULL, stored REAL NOT NULL)")
+            self._conn.commit()
+
+    def _get_disk(self, digest: str) -> CachedResult | None:
+        if self._conn is None:
+            return None
+        try:
+            with self._lock:
+                row = self._conn.execute(
+                    "SELECT hash, exists_, watermark, stored FROM results WHERE digest = ?", (digest,)).fetchone()
+                if row is not None and time.time() - row[3] > self.ttl:
+                    # Expired rows would otherwise be read (and dropped) again on every lookup
+                    self._conn.execute("DELETE FROM results WHERE digest = ? AND stored = ?", (digest, row[3]))
+                    self._conn.commit()
+                    row = None
+        except sqlite3.Error as e:
+            log.error("Error reading result cache", extra={"error": str(e)})
+            return None
+        if row is None:
+            return None
+        return CachedResult(row[0], None if row[1] is None else bool(row[1]), row[2], row[3])
+
+    def get(self, digest: str, watermark: int) -> CachedResult | None:
+        """
+        Look up an upload by digest.
+
+        Returns:
+            CachedResult | None: The cached entry, or None on a miss. Check `verdict_valid(watermark)`
+                                 before reusing `exists`; the hash is always reusable.
+        """
+        with self._lock:
+            entry = self._entries.get(digest)
+            if entry is not None:
+                self._entries.move_to_end(digest)
+        if entry is None:
+            entry = self._get_disk(digest)
+            if entry is not None:
+                self.disk_hits += 1
+                self._put_memory(digest, entry)
+
+        if entry is not None and time.time() - entry.stored > self.ttl:
+            with self._lock:
+                self._entries.pop(digest, None)
+            entry = None
+        if entry is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        if not entry.verdict_valid(watermark):
+            self.stale_verdicts += 1
+        return entry
+
+    def _put_memory(self, digest: str, entry: CachedResult):
+        with self._lock:
+            self._entries[digest] = entry
+            self._entries.move_to_end(digest)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def put(self, digest: str, image_hash: str, exists: bool | None, watermark: int):
+        """Store the hash and verdict computed for an upload at the given registry size."""
+        entry = CachedResult(image_hash, exists, watermark, time.time())
+        self._put_memory(digest, entry)
+        if self._conn is not None:
+            try:
+                with self._lock:
+                    self._conn.execute(
+                        "INSERT OR REPLACE INTO results (digest, hash, exists_, watermark, stored) VALUES (?, ?, ?, ?, ?)",
+                        (digest, image_hash, None if exists is None else int(exists), watermark, entry.stored))
+                    self._conn.commit()
+            except sqlite3.Error as e:
+                log.error("Error writing result cache", extra={"error": str(e)})
+
+    def stats(self) -> dict:
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "disk_hits": self.disk_hits,
+            "stale_verdicts": self.stale_verdicts,
+            "entries": len(self._entries),
+        }
+
+
+result_cache = ResultCache(max_entries=max_entries, ttl=ttl, disk_path=disk_path)
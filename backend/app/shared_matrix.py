@@ -0,0 +1,235 @@
+import fcntl
+import mmap
+import os
+import time
+import numpy as np
+from .hash_codec import HASH_TYPES
+from .similarity import HashMatrix
+
+# Header of the control file, one little-endian uint64 per field
+_MAGIC = int.from_bytes(b'PXLHMAT1', 'little')
+_HEADER_FIELDS = ('magic', 'nbits', 'epoch', 'capacity', 'count', 'skipped', 'sequence', 'last_synced_ms')
+_HEADER = {name: i for i, name in enumerate(_HEADER_FIELDS)}
+_HEADER_SIZE = 8 * len(_HEADER_FIELDS)
+
+
+class SharedHashMatrix(HashMatrix):
+    """
+    `HashMatrix` whose rows live in memory-mapped files, so every worker process of the host maps the
+    same physical pages instead of decoding its own copy of the registry.
+
+    Layout (all files under `path`, which should be on a tmpfs such as /dev/shm):
+        - `path`: a small control header holding the current data file epoch, its capacity, the
+          number of published rows and a sequence counter.
+        - `path.<epoch>`: the (capacity, 3, nbytes) bit matrix followed by the positions (int64) and
+          the sources (uint8) of each row.
+        - `path.lock`: held with `flock()` by the single writer for as long as it lives.
+
+    One process, the writer (see `acquire_writer()`), appends rows; every other process only reads.
+    The registry is append-only, so the writer fills the rows past `count` first and only then
+    publishes the new count. A data file that runs out of capacity is copied into a larger one under
+    a new epoch; readers see the epoch change and remap, and the old file is unlinked (the pages stay
+    alive until the last reader drops its mapping).
+
+    Header updates are guarded by the sequence counter: the writer makes it odd while it rewrites the
+    header and even again once done, and a reader retries until it reads the same even value before
+    and after copying the header. `generation` (the sequence divided by two) therefore changes on
+    every published append, growth or rebuild.
+
+    Parameters:
+        path (str): Location of the control file; data and lock files are created next to it.
+        nbits (int): The number of bits of each individual hash (256 for hash_size=16).
+        chunk_size (int): The number of rows compared per step by the early-exit `exists()` scan.
+    """
+
+    def __init__(self, path: str, nbits: int = 256, chunk_size: int = 8192):
+        super().__init__(nbits=nbits, chunk_size=chunk_size)
+        self.path = path
+        self.writer = False
+        self.generation = 0
+        self.last_synced = 0.0
+
+        self._row_bytes = len(HASH_TYPES) * self.nbytes
+        self._epoch = 0
+        self._capacity = 0
+        self._publishing = True
+        self._lock_fd = None
+
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            if os.fstat(fd).st_size < _HEADER_SIZE:
+                # A zeroed header (no magic) reads as an empty matrix until a writer publishes
+                os.ftruncate(fd, _HEADER_SIZE)
+            self._control = mmap.mmap(fd, _HEADER_SIZE)
+        finally:
+            os.close(fd)
+        self._header = np.ndarray((len(_HEADER_FIELDS),), dtype='<u8', buffer=self._control)
+        self.refresh()
+
+    def _data_path(self, epoch: int) -> str:
+        return f"{self.path}.{epoch}"
+
+    def _map(self, epoch: int, capacity: int, create: bool = False):
+        """Map the data file of an epoch and point the row arrays at it."""
+        size = capacity * (self._row_bytes + 9)
+        flags = os.O_RDWR | os.O_CREAT | os.O_TRUNC if create else (os.O_RDWR if self.writer else os.O_RDONLY)
+        fd = os.open(self._data_path(epoch), flags, 0o644)
+        try:
+            if create:
+                os.ftruncate(fd, size)
+            data = mmap.mmap(fd, size, access=mmap.ACCESS_WRITE if self.writer else mmap.ACCESS_READ)
+        finally:
+            os.close(fd)
+        bits_size = capacity * self._row_bytes
+        bits = np.ndarray((capacity, len(HASH_TYPES), self.nbytes), dtype=np.uint8, buffer=data)
+        positions = np.ndarray((capacity,), dtype='<i8', buffer=data, offset=bits_size)
+        sources = np.ndarray((capacity,), dtype=np.uint8, buffer=data, offset=bits_size + 8 * capacity)
+        return bits, positions, sources
+
+    def _read_header(self) -> dict:
+        while True:
+            before = int(self._header[_HEADER['sequence']])
+            if before % 2:
+                time.sleep(0)
+                continue
+            header = dict(zip(_HEADER_FIELDS, (int(value) for value in self._header)))
+            if int(self._header[_HEADER['sequence']]) == before:
+                return header
+
+    def refresh(self) -> bool:
+        """
+        Pick up what the writer published since the last call (reader side, a no-op for the writer).
+
+        Returns:
+            bool: True if the generation changed.
+        """
+        if self.writer:
+            return False
+        while True:
+            header = self._read_header()
+            if header['magic'] != _MAGIC:
+                return False
+            if header['nbits'] != self.nbits:
+                raise ValueError(f"Shared hash matrix at {self.path} holds {header['nbits']} bit hashes, "
+                                 f"expected {self.nbits}.")
+            generation = header['sequence'] // 2
+            if generation == self.generation:
+                return False
+            if header['epoch'] != self._epoch:
+                try:
+                    arrays = self._map(header['epoch'], header['capacity'])
+                except FileNotFoundError:
+                    # Replaced again between reading the header and opening the file
+                    continue
+                # Swap the arrays before the count so a concurrent scan never reads past them
+                self._bits, self._positions, self._sources = arrays
+                self._epoch, self._capacity = header['epoch'], header['capacity']
+            self._count = header['count']
+            self.skipped = header['skipped']
+            self.last_synced = header['last_synced_ms'] / 1000
+            self.generation = generation
+            return True
+
+    def acquire_writer(self) -> bool:
+        """
+        Try to become the single writer of the shared matrix, without blocking.
+
+        The lock is released by the kernel when the process exits, so a follower that calls this
+        periodically takes over from a writer that died. A new writer must `begin_rebuild()` before
+        appending, since it does not know which rows the previous writer had published.
+        """
+        if self.writer:
+            return True
+        if self._lock_fd is None:
+            self._lock_fd = os.open(f"{self.path}.lock", os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(self._lock_fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            return False
+        self.writer = True
+        self._epoch = int(self._header[_HEADER['epoch']])
+        return True
+
+    def _grow(self, capacity: int):
+        """Move the rows into a new, larger data file under the next epoch."""
+        published = int(self._header[_HEADER['epoch']])
+        old_epoch = self._epoch
+        epoch = max(old_epoch, published) + 1
+        bits, positions, sources = self._map(epoch, capacity, create=True)
+        bits[:self._count] = self._bits[:self._count]
+        positions[:self._count] = self._positions[:self._count]
+        sources[:self._count] = self._sources[:self._count]
+        self._bits, self._positions, self._sources = bits, positions, sources
+        self._epoch, self._capacity = epoch, capacity
+        if old_epoch and old_epoch != published:
+            # Never published, nobody else maps it
+            self._unlink(old_epoch)
+
+    def _unlink(self, epoch: int):
+        try:
+            os.unlink(self._data_path(epoch))
+        except FileNotFoundError:
+            pass
+
+    def _reserve(self, extra: int):
+        needed = self._count + extra
+        if needed <= self._capacity:
+            return
+        self._grow(max(needed, 2 * self._capacity, 1024))
+
+    def _publish(self):
+        """Expose the rows appended so far to the readers."""
+        if not self._publishing:
+            return
+        header = self._header
+        old_epoch = int(header[_HEADER['epoch']])
+        sequence = int(header[_HEADER['sequence']])
+        header[_HEADER['sequence']] = sequence + 1
+        header[_HEADER['magic']] = _MAGIC
+        header[_HEADER['nbits']] = self.nbits
+        header[_HEADER['epoch']] = self._epoch
+        header[_HEADER['capacity']] = self._capacity
+        header[_HEADER['count']] = self._count
+        header[_HEADER['skipped']] = self.skipped
+        header[_HEADER['last_synced_ms']] = int(self.last_synced * 1000)
+        header[_HEADER['sequence']] = sequence + 2
+        self.generation = (sequence + 2) // 2
+        if old_epoch and old_epoch != self._epoch:
+            self._unlink(old_epoch)
+
+    def append(self, entries, start_position: int = None, source: int = 0) -> int:
+        """Decode, append and publish registry entries (writer only). See `HashMatrix.append()`."""
+        if not self.writer:
+            raise RuntimeError("Only the writer process can append to the shared hash matrix.")
+        added = super().append(entries, start_position=start_position, source=source)
+        self._publish()
+        return added
+
+    def mark_synced(self):
+        """Record in the header that the writer has just caught up with the registry."""
+        self.last_synced = time.time()
+        self._publish()
+
+    def begin_rebuild(self):
+        """
+        Start refilling the matrix from scratch (writer only). Appends go to a fresh data file that
+        readers keep ignoring, serving the previously published rows, until `end_rebuild()`.
+        """
+        if not self.writer:
+            raise RuntimeError("Only the writer process can rebuild the shared hash matrix.")
+        self._publishing = False
+        self._count = 0
+        self.skipped = 0
+        self._grow(max(self._capacity, 1024))
+
+    def end_rebuild(self):
+        """Publish the rebuilt matrix in one header update."""
+        self._publishing = True
+        self._publish()
+
+    def close(self):
+        """Give up the writer role (the published files stay for the other workers)."""
+        if self._lock_fd is not None:
+            os.close(self._lock_fd)
+            self._lock_fd = None
+        self.writer = False
@@ -0,0 +1,419 @@
+import os
+import threading
+import numpy as np
+from dotenv import load_dotenv
+from .hash_codec import HASH_TYPES, decode_entry
+
+load_dotenv()
+
+# Order in which `HashMatrix.exists()` compares the hash types, the most discriminating first: the
+# first two are compared on every row, the last only on the rows they do not rule out. All three
+# cost the same popcount; aHash goes last because coarse luminance is shared by many unrelated
+# photos, so its distances rule out the fewest rows.
+cascade_order = tuple(os.getenv('CASCADE_ORDER', 'phash,dhash,ahash').split(','))
+
+# Query x row pairs compared at once by `HashMatrix.match_pairs()`
+PAIRS_PER_BLOCK = 1 << 20
+
+# Popcount lookup table for numpy builds without np.bitwise_count
+_POPCOUNT = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8)
+
+
+def popcount(xor: np.ndarray) -> np.ndarray:
+    """Counts set bits along the last axis of a packed uint8 (or uint64 word) array."""
+    if hasattr(np, 'bitwise_count') and (xor.dtype == np.uint64 or xor.shape[-1] % 8 == 0):
+        counts = np.bitwise_count(np.ascontiguousarray(xor).view(np.uint64))
+        # Adding the few words of a hash column by column is much faster than a sum() over a short axis
+        total = counts[..., 0].astype(np.int64)
+        for word in range(1, counts.shape[-1]):
+            total += counts[..., word]
+        return total
+    return _POPCOUNT[np.ascontiguousarray(xor).view(np.uint8)].sum(axis=-1, dtype=np.int64)
+
+
+def to_similarity(hamming_dist: np.ndarray, total_bits: int) -> np.ndarray:
+    """Same formula as `calculate_similarity()`, applied element-wise in float64."""
+    return (1 - hamming_dist / total_bits) * 100
+
+
+class HashMatrix:
+    """
+    Registry hashes kept pre-decoded as packed bit matrices, one per hash type.
+
+    Entries may be binary (see `hash_codec`) or legacy "ahash#dhash#phash" strings; binary entries
+    are copied into the matrix straight from their bytes, without any string parsing.
+
+    Distances are computed for many entries at once with a batched XOR + popcount, and the resulting
+    per-type and average similarities are bit-for-bit the values `calculate_similaties()` returns for
+    the same pair of strings. Entries that cannot be decoded (wrong number of hashes or wrong hash size)
+    are skipped, like `search_image()` skipped them.
+
+    Parameters:
+        nbits (int): The number of bits of each individual hash (256 for hash_size=16).
+        chunk_size (int): The number of rows compared per step by the early-exit `exists()` scan.
+        order (tuple[str]): The order in which `exists()` compares the hash types, most discriminating
+                            first.
+    """
+
+    def __init__(self, nbits: int = 256, chunk_size: int = 8192, order: tuple = None):
+        self.nbits = nbits
+        self.nbytes = nbits // 8
+        self.chunk_size = chunk_size
+        self.skipped = 0
+
+        if order is None:
+            order = cascade_order
+        if sorted(order) != sorted(HASH_TYPES):
+            raise ValueError(f"The cascade order must list each of {HASH_TYPES} once, got {order}.")
+        self.order = tuple(HASH_TYPES.index(hash_type) for hash_type in order)
+        # Hash types compared by each `exists()` stage, as column indexes (a slice when adjacent)
+        self._stage_types = (sorted(self.order[:2]), sorted(self.order[2:]))
+        self._stages = tuple(slice(types[0], types[-1] + 1) if types[-1] - types[0] == len(types) - 1 else types
+                             for types in self._stage_types)
+        # Rows ruled out by `exists()` after the first stage and after the full comparison
+        self.rejections = [0, 0]
+        self._stats_lock = threading.Lock()
+
+        self._count = 0
+        self._bits = np.empty((0, len(HASH_TYPES), self.nbytes), dtype=np.uint8)
+        self._positions = np.empty(0, dtype=np.int64)
+        self._sources = np.empty(0, dtype=np.uint8)
+
+    def __len__(self) -> int:
+        return self._count
+
+    @property
+    def bits(self) -> np.ndarray:
+        """The (N, 3, nbytes) packed matrix of all decoded entries."""
+        return self._bits[:self._count]
+
+    @property
+    def positions(self) -> np.ndarray:
+        """The registry position of each matrix row."""
+        return self._positions[:self._count]
+
+    @property
+    def sources(self) -> np.ndarray:
+        """The registry array (0: legacy `hashes`, 1: binary `packedHashes`) of each matrix row."""
+        return self._sources[:self._count]
+
+    def _reserve(self, extra: int):
+        needed = self._count + extra
+        if needed <= len(self._bits):
+            return
+        capacity = max(needed, 2 * len(self._bits), 1024)
+        bits = np.empty((capacity, len(HASH_TYPES), self.nbytes), dtype=np.uint8)
+        bits[:self._count] = self._bits[:self._count]
+        positions = np.empty(capacity, dtype=np.int64)
+        positions[:self._count] = self._positions[:self._count]
+        sources = np.empty(capacity, dtype=np.uint8)
+        sources[:self._count] = self._sources[:self._count]
+        self._bits, self._positions, self._sources = bits, positions, sources
+
+    def append(self, entries, start_position: int = None, source: int = 0) -> int:
+        """
+        Decodes and appends registry entries.
+
+        Parameters:
+            entries (list[str | bytes]): Registry entries, in registry order.
+            start_position (int): Registry position of the first entry. Defaults to the number of
+                                  entries appended so far (decoded or skipped).
+            source (int): The registry array the entries come from (0: `hashes`, 1: `packedHashes`).
+
+        Returns:
+            int: The number of entries that were decoded and added.
+        """
+        if start_position is None:
+            start_position = self._count + self.skipped
+        self._reserve(len(entries))
+        added = 0
+        for offset, entry in enumerate(entries):
+            try:
+                decoded = decode_entry(entry, self.nbits)
+            except ValueError:
+                self.skipped += 1
+                continue
+            self._bits[self._count] = decoded
+            self._positions[self._count] = start_position + offset
+            self._sources[self._count] = source
+            self._count += 1
+            added += 1
+        return added
+
+    def append_bits(self, bits: np.ndarray, positions: np.ndarray, source: int = 0):
+        """
+        Appends rows that are already packed, such as tile hashes, without going through registry
+        entries.
+
+        Parameters:
+            bits (np.ndarray): An (n, 3, nbytes) uint8 array.
+            positions (np.ndarray): The position stored for each row.
+            source (int): The source stored for every row.
+        """
+        if bits.shape[1:] != (len(HASH_TYPES), self.nbytes):
+            raise ValueError(f"Expected (n, 3, {self.nbytes}) rows, got {bits.shape}.")
+        self._reserve(len(bits))
+        end = self._count + len(bits)
+        self._bits[self._count:end] = bits
+        self._positions[self._count:end] = positions
+        self._sources[self._count:end] = source
+        self._count = end
+
+    def _query_bits(self, query) -> np.ndarray:
+        if isinstance(query, (str, bytes)):
+            return decode_entry(query, self.nbits)
+        query = np.asarray(query, dtype=np.uint8)
+        if query.shape != (len(HASH_TYPES), self.nbytes):
+            raise ValueError(f"Expected a (3, {self.nbytes}) query, got {query.shape}.")
+        return query
+
+    def distances(self, query, start: int = 0, stop: int = None) -> np.ndarray:
+        """
+        Returns the (N, 3) Hamming distances between the query and rows [start, stop).
+
+        The query is a registry entry (composite hash string or binary) or an already decoded
+        (3, nbytes) array.
+        """
+        query = self._query_bits(query)
+        rows = self._bits[start:self._count if stop is None else min(stop, self._count)]
+        return popcount(np.bitwise_xor(rows, query))
+
+    def similarities(self, query, start: int = 0, stop: int = None) -> dict:
+        """
+        Returns the same dictionary as `calculate_similaties()`, with one array element per row.
+        """
+        distances = self.distances(query, start, stop)
+        result = {}
+        for i, hash_type in enumerate(HASH_TYPES):
+            result[f'{hash_type}_similarity'] = to_similarity(distances[:, i], self.nbits)
+        result['avg_similarity'] = (result['ahash_similarity'] + result['dhash_similarity'] +
+                                    result['phash_similarity']) / 3
+        return result
+
+    @property
+    def pruned_comparisons(self) -> int:
+        """Hash comparisons `exists()` skipped because a row was already ruled out."""
+        return self.rejections[0] * len(self._stage_types[1])
+
+    def _as_words(self, bits: np.ndarray) -> np.ndarray:
+        """The packed bytes viewed as uint64 words when they split evenly, so XORs run 8 bytes at a time."""
+        if self.nbytes % 8 == 0 and bits.flags.c_contiguous:
+            return bits.view(np.uint64)
+        return bits
+
+    def _distance_limit(self, threshold: float) -> float:
+        """
+        The summed distance above which a row cannot be above the threshold, whatever its remaining
+        distances: the average of the three similarities is 100 * (1 - total / (3 * nbits)), and the
+        types not compared yet add at least 0. The margin keeps float rounding on the side of
+        comparing a row in full.
+        """
+        return len(HASH_TYPES) * self.nbits * (100 - threshold) / 100 + 1e-6
+
+    def _candidates(self, query, bound: float, rejections: list):
+        """
+        Yields, chunk by chunk, the rows whose first two hash types do not already rule out an
+        average similarity above `bound` (see `_distance_limit()`), as (matrix rows, exact average
+        similarity of each) arrays. Rows ruled out are added to `rejections[0]`.
+        """
+        query = self._as_words(np.ascontiguousarray(self._query_bits(query)))
+        limit = self._distance_limit(bound)
+        first, second = self._stages
+        for start in range(0, self._count, self.chunk_size):
+            words = self._as_words(self._bits[start:min(start + self.chunk_size, self._count)])
+            distances = popcount(np.bitwise_xor(words[:, first], query[first]))
+            candidates = np.flatnonzero(distances[:, 0] + distances[:, 1] <= limit)
+            rejections[0] += len(words) - len(candidates)
+            if not len(candidates):
+                continue
+            rest = popcount(np.bitwise_xor(words[candidates][:, second], query[second]))
+            known = dict(zip(self._stage_types[0], distances[candidates].T))
+            known.update(zip(self._stage_types[1], rest.T))
+            similarities = [to_similarity(known[i], self.nbits) for i in range(len(HASH_TYPES))]
+            yield start + candidates, (similarities[0] + similarities[1] + similarities[2]) / 3
+
+    def _record(self, rejections: list):
+        with self._stats_lock:
+            self.rejections[0] += rejections[0]
+            self.rejections[1] += rejections[1]
+
+    def exists(self, query, threshold: float = 80.0) -> bool:
+        """
+        Returns True as soon as one row has an average similarity above the threshold.
+
+        Rows are compared `chunk_size` at a time, so a match near the start of the registry does not
+        pay for a full scan. Within a chunk, the first two hash types of `order` are compared first,
+        and only the rows their distances do not already rule out (see `_distance_limit()`) are
+        compared on the last one. Those rows get the exact average of `calculate_similaties()`, so
+        the decisions are the same as comparing every row in full. `rejections` counts the rows
+        ruled out after the first stage and after the full comparison.
+        """
+        rejections = [0, 0]
+        try:
+            for rows, avg in self._candidates(query, threshold, rejections):
+                matches = int(np.count_nonzero(avg > threshold))
+                rejections[1] += len(rows) - matches
+                if matches:
+                    return True
+            return False
+        finally:
+            self._record(rejections)
+
+    def gray_zone(self, query, low: float, threshold: float = 80.0, limit: int = 8) -> tuple:
+        """
+        `exists()` that also collects the rows just below the threshold, for a slower verifier.
+
+        The scan prunes with `low` instead of `threshold`, which rules out far fewer rows: expect the
+        cost of a full comparison of the registry when nothing matches. It still stops at the first
+        row above the threshold.
+
+        Returns:
+            tuple[bool, list[dict]]: Whether a row is above the threshold, and otherwise up to `limit`
+                                     rows with an average similarity above `low`, best first, each
+                                     with its matrix `row`, registry `source` and `position` and its
+                                     `avg_similarity`.
+        """
+        rejections = [0, 0]
+        best_rows = np.empty(0, dtype=np.int64)
+        best_avg = np.empty(0)
+        try:
+            for rows, avg in self._candidates(query, low, rejections):
+                if np.any(avg > threshold):
+                    return True, []
+                keep = avg > low
+                rejections[1] += len(rows) - int(np.count_nonzero(keep))
+                best_rows = np.concatenate([best_rows, rows[keep]])
+                best_avg = np.concatenate([best_avg, avg[keep]])
+                # Ties are kept in registry order
+                best = np.lexsort((best_rows, -best_avg))[:limit]
+                best_rows, best_avg = best_rows[best], best_avg[best]
+        finally:
+            self._record(rejections)
+        return False, [{'row': int(row), 'source': int(self._sources[row]), 'position': int(self._positions[row]),
+                        'avg_similarity': float(avg)} for row, avg in zip(best_rows, best_avg)]
+
+    def contains(self, query) -> bool:
+        """Returns True if a row holds exactly the query's three hashes."""
+        query = self._query_bits(query)
+        for start in range(0, self._count, self.chunk_size):
+            if np.any(self.distances(query, start, start + self.chunk_size).sum(axis=1) == 0):
+                return True
+        return False
+
+    def exists_many(self, queries, threshold: float = 80.0) -> np.ndarray:
+        """
+        Answers `exists()` for many queries in one pass over the matrix.
+
+        Each block of rows is XORed against every query still without a match at once, so the
+        registry is read once per batch instead of once per query. Queries drop out as soon as
+        they match.
+
+        Returns:
+            np.ndarray: One bool per query.
+        """
+        if not len(queries):
+            return np.zeros(0, dtype=bool)
+        queries = np.stack([self._query_bits(query) for query in queries])
+        found = np.zeros(len(queries), dtype=bool)
+        # Keep the (queries, rows, 3, nbytes) XOR block around chunk_size rows' worth of memory
+        rows_per_block = max(1, self.chunk_size // len(queries))
+        for start in range(0, self._count, rows_per_block):
+            active = np.flatnonzero(~found)
+            if not len(active):
+                break
+            rows = self._bits[start:min(start + rows_per_block, self._count)]
+            distances = popcount(np.bitwise_xor(rows[None], queries[active][:, None]))
+            similarities = to_similarity(distances, self.nbits)
+            avg = (similarities[..., 0] + similarities[..., 1] + similarities[..., 2]) / 3
+            found[active[np.any(avg > threshold, axis=1)]] = True
+        return found
+
+    def match_pairs(self, queries: np.ndarray, threshold: float = 80.0) -> tuple:
+        """
+        Finds every (query, row) pair with an average similarity above the threshold.
+
+        Like `exists_many()`, each block of rows is compared with all queries at once, and like
+        `exists()` the first two hash types of the cascade order rule out most pairs before the
+        third is compared.
+
+        Parameters:
+            queries (np.ndarray): A (Q, 3, nbytes) uint8 array of packed hashes.
+
+        Returns:
+            tuple[np.ndarray, np.ndarray]: The query indexes and matrix rows of the matching pairs.
+        """
+        if not len(queries) or self._count == 0:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+        queries = self._as_words(np.ascontiguousarray(queries, dtype=np.uint8))
+        limit = self._distance_limit(threshold)
+        first, second = self._stage_types
+        found_queries, found_rows = [], []
+        # Every query is compared with every row, so blocks are sized in pairs rather than rows
+        rows_per_block = max(1, PAIRS_PER_BLOCK // len(queries))
+        for start in range(0, self._count, rows_per_block):
+            words = self._as_words(self._bits[start:min(start + rows_per_block, self._count)])
+            # One contiguous (rows, words) column per hash type broadcasts much faster than the strided matrix
+            distances = [popcount(np.bitwise_xor(np.ascontiguousarray(words[:, i])[None], queries[:, None, i]))
+                         for i in first]
+            query_indexes, rows = np.nonzero(distances[0] + distances[1] <= limit)
+            if not len(rows):
+                continue
+            rest = popcount(np.bitwise_xor(words[rows][:, second], queries[query_indexes][:, second]))
+            known = {i: distance[query_indexes, rows] for i, distance in zip(first, distances)}
+            known.update(zip(second, rest.T))
+            similarities = [to_similarity(known[i], self.nbits) for i in range(len(HASH_TYPES))]
+            keep = (similarities[0] + similarities[1] + similarities[2]) / 3 > threshold
+            found_queries.append(query_indexes[keep])
+            found_rows.append(start + rows[keep])
+        if not found_rows:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+        return np.concatenate(found_queries), np.concatenate(found_rows)
+
+    def top_k(self, query, k: int = 5) -> list:
+        """
+        Returns the k rows with the highest average similarity, best first.
+
+        Each chunk of `chunk_size` rows keeps its own k best with a partial sort (`np.argpartition`),
+        and the final k are picked among those, so neither the whole registry nor its similarities
+        are ever sorted or held in memory at once.
+
+        Returns:
+            list[dict]: One dictionary per match with its matrix `row`, registry `source` and
+                        `position`, its `hash` as an "ahash#dhash#phash" string and the per-type and
+                        average similarities.
+        """
+        if self._count == 0 or k <= 0:
+            return []
+        query = self._query_bits(query)
+        rows, scores = [], []
+        for start in range(0, self._count, self.chunk_size):
+            avg = self.similarities(query, start, start + self.chunk_size)['avg_similarity']
+            if len(avg) > k:
+                best = np.argpartition(-avg, k - 1)[:k]
+                rows.append(start + best)
+                scores.append(avg[best])
+            else:
+                rows.append(start + np.arange(len(avg)))
+                scores.append(avg)
+        rows, scores = np.concatenate(rows), np.concatenate(scores)
+        if len(rows) > k:
+            best = np.argpartition(-scores, k - 1)[:k]
+            rows, scores = rows[best], scores[best]
+        # Ties are listed in registry order
+        rows = rows[np.lexsort((rows, -scores))]
+
+        distances = popcount(np.bitwise_xor(self._bits[rows], query))
+        matches = []
+        for row, row_distances in zip(rows, distances):
+            similarities = {f'{hash_type}_similarity': float(to_similarity(row_distances[i], self.nbits))
+                            for i, hash_type in enumerate(HASH_TYPES)}
+            similarities['avg_similarity'] = (similarities['ahash_similarity'] + similarities['dhash_similarity'] +
+                                              similarities['phash_similarity']) / 3
+            matches.append({
+                'row': int(row),
+                'source': int(self._sources[row]),
+                'position': int(self._positions[row]),
+                'hash': '#'.join(bits.tobytes().hex() for bits in self._bits[row]),
+                **similarities,
+            })
+        return matches
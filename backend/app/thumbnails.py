@@ -0,0 +1,171 @@
+"""
+Small grayscale thumbnails of published images, for re-ranking hash candidates with SSIM.
+
+experiments/ssim.py compares two images with a full resolution SSIM, which costs time in the size of
+the originals. Here every published image is reduced once to a fixed size thumbnail, and a verify
+only needs the thumbnail of the upload and one batched SSIM against the thumbnails of its closest
+hash candidates: the same work for a 100KB and a 20MB upload.
+"""
+import fcntl
+import os
+import threading
+import numpy as np
+from scipy.ndimage import uniform_filter
+from dotenv import load_dotenv
+from PIL import Image
+from .ingest import open_image
+from .hash_codec import FORMAT_NBITS, HASH_TYPES
+
+load_dotenv()
+
+# Data file of the thumbnail store. Thumbnails and SSIM re-ranking are opt-in: empty disables them.
+thumbnail_store_path = os.getenv('THUMBNAIL_STORE_PATH', '')
+# Side (pixels) of the square thumbnails
+thumbnail_size = int(os.getenv('THUMBNAIL_SIZE', '64'))
+# Hash candidates re-ranked by SSIM on verify
+ssim_top_k = int(os.getenv('SSIM_TOP_K', '5'))
+
+# skimage.metrics.structural_similarity defaults
+SSIM_WINDOW = 7
+SSIM_K1 = 0.01
+SSIM_K2 = 0.03
+
+# Keys are binary registry entries (see `hash_codec.encode_hash()`), zero padded to the longest version
+KEY_SIZE = 1 + len(HASH_TYPES) * max(FORMAT_NBITS.values()) // 8
+
+
+def make_thumbnail(image_data: bytes, size: int = 64) -> np.ndarray:
+    """
+    Reduces an image to a size x size grayscale thumbnail, ignoring the aspect ratio like the resize
+    in `compute_ssim()` does.
+
+    JPEGs are decoded at the smallest DCT scale that still covers the thumbnail (`Image.draft`), so
+    the cost barely depends on the resolution of the upload. Kept free of any app state so it can be
+    shipped to worker processes by the execution layer.
+
+    Returns:
+        np.ndarray: A (size, size) uint8 array.
+    """
+    image = open_image(image_data, size)
+    gray = image.convert('L').resize((size, size), Image.Resampling.BILINEAR, reducing_gap=2.0)
+    return np.asarray(gray, dtype=np.uint8)
+
+
+def batched_ssim(query: np.ndarray, thumbnails: np.ndarray) -> np.ndarray:
+    """
+    Mean SSIM of one thumbnail against many, computed as `skimage.metrics.structural_similarity`
+    does with its defaults for 8-bit images: a 7x7 uniform window, sample covariances and the mean
+    over the pixels the window fits around.
+
+    Parameters:
+        query (np.ndarray): A (size, size) uint8 thumbnail.
+        thumbnails (np.ndarray): A (k, size, size) uint8 array.
+
+    Returns:
+        np.ndarray: The k SSIM scores, in [-1, 1].
+    """
+    window = (1, SSIM_WINDOW, SSIM_WINDOW)
+    count = SSIM_WINDOW * SSIM_WINDOW
+    covariance_norm = count / (count - 1)
+    c1 = (SSIM_K1 * 255) ** 2
+    c2 = (SSIM_K2 * 255) ** 2
+
+    x = np.broadcast_to(query.astype(np.float64), thumbnails.shape)
+    y = thumbnails.astype(np.float64)
+    # The query's statistics are the same for every candidate, filter them once
+    ux = uniform_filter(x[:1], size=window)
+    uxx = uniform_filter(x[:1] * x[:1], size=window)
+    uy = uniform_filter(y, size=window)
+    uyy = uniform_filter(y * y, size=window)
+    uxy = uniform_filter(x * y, size=window)
+    vx = covariance_norm * (uxx - ux * ux)
+    vy = covariance_norm * (uyy - uy * uy)
+    vxy = covariance_norm * (uxy - ux * uy)
+
+    s = ((2 * ux * uy + c1) * (2 * vxy + c2)) / ((ux ** 2 + uy ** 2 + c1) * (vx + vy + c2))
+    pad = (SSIM_WINDOW - 1) // 2
+    return s[:, pad:-pad, pad:-pad].mean(axis=(1, 2))
+
+
+class ThumbnailStore:
+    """
+    Append-only thumbnail store shared by the worker processes of the host.
+
+    Layout:
+        - `path`: the thumbnails, size * size bytes each, back to back. Readers map it with
+          `np.memmap`, so lookups read a few pages instead of the whole file.
+        - `path.keys`: the key of each thumbnail, KEY_SIZE bytes each, in the same order.
+        - `path.lock`: `flock()`ed around each append.
+
+    An append writes the thumbnail before its key, so a key that is visible always has its pixels.
+    Each process keeps a {key: slot} map of the keys file and reads the records past what it has
+    seen on lookup. A key added twice resolves to its latest thumbnail.
+
+    Parameters:
+        path (str): Location of the data file; the keys and lock files are created next to it.
+        size (int): Side of the thumbnails. A store must always be opened with the same size.
+    """
+
+    def __init__(self, path: str, size: int = 64):
+        self.path = path
+        self.size = size
+        self._slot_bytes = size * size
+        self._slots = {}
+        self._keys_read = 0
+        self._data = None
+        self._lock = threading.Lock()
+        for name in (path, f"{path}.keys"):
+            os.close(os.open(name, os.O_RDWR | os.O_CREAT, 0o644))
+
+    def __len__(self) -> int:
+        with self._lock:
+            self._refresh()
+            return len(self._slots)
+
+    def _refresh(self):
+        with open(f"{self.path}.keys", 'rb') as keys:
+            keys.seek(self._keys_read * KEY_SIZE)
+            data = keys.read()
+        for i in range(len(data) // KEY_SIZE):
+            key = data[i * KEY_SIZE:(i + 1) * KEY_SIZE]
+            length = 1 + len(HASH_TYPES) * FORMAT_NBITS[key[0]] // 8
+            self._slots[key[:length]] = self._keys_read + i
+        self._keys_read += len(data) // KEY_SIZE
+        if self._keys_read and (self._data is None or len(self._data) < self._keys_read):
+            self._data = np.memmap(self.path, dtype=np.uint8, mode='r',
+                                   shape=(self._keys_read, self.size, self.size))
+
+    def put(self, key: bytes, thumbnail: np.ndarray):
+        """Append the thumbnail of a published entry."""
+        if thumbnail.shape != (self.size, self.size):
+            raise ValueError(f"Expected a {self.size}x{self.size} thumbnail, got {thumbnail.shape}")
+        if len(key) > KEY_SIZE:
+            raise ValueError(f"Thumbnail key of {len(key)} bytes, at most {KEY_SIZE} fit")
+        with open(f"{self.path}.lock", 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            with open(self.path, 'r+b') as data, open(f"{self.path}.keys", 'r+b') as keys:
+                # Slots are numbered by key records; a torn append left pixels without a key behind
+                slot = os.fstat(keys.fileno()).st_size // KEY_SIZE
+                data.seek(slot * self._slot_bytes)
+                data.write(np.ascontiguousarray(thumbnail, dtype=np.uint8).tobytes())
+                data.flush()
+                keys.seek(slot * KEY_SIZE)
+                keys.write(key.ljust(KEY_SIZE, b'\0'))
+
+    def get_many(self, keys: list) -> tuple:
+        """
+        The stored thumbnails of the given keys.
+
+        Returns:
+            tuple[list[int], np.ndarray]: The indexes (into `keys`) of the keys that have a thumbnail,
+                                          and their (n, size, size) thumbnails in the same order.
+        """
+        with self._lock:
+            self._refresh()
+            found = [i for i, key in enumerate(keys) if key in self._slots]
+            if not found:
+                return [], np.empty((0, self.size, self.size), dtype=np.uint8)
+            return found, np.array(self._data[[self._slots[keys[i]] for i in found]])
+
+
+thumbnail_store = ThumbnailStore(thumbnail_store_path, thumbnail_size) if thumbnail_store_path else None
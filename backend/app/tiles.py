@@ -0,0 +1,234 @@
+"""
+Tile index: perceptual hashes of overlapping sub-images, so that crops of a published image are found.
+
+A large crop changes every whole-image hash (experiments/hash.py: the ahash of test_image_cb.jpeg is
+59% similar to its original), but the crop still contains regions of the original at some scale and
+offset. Publish hashes a pyramid of overlapping square tiles of the image; verify hashes the same
+pyramid of the upload, looks every tile up in the index and lets each tile vote for the published
+images it matches. An image with enough votes counts as registered.
+
+On the sample images (experiments/, tile side from the full to 0.42 times the shorter side in steps
+of 0.84, stride a quarter tile), the large crop gets 10 voting tiles at the default threshold while
+unrelated photos get at most one.
+
+Tiles with little detail are left out on both sides: a plain background, a sky or a single edge
+hashes alike in unrelated images, and a white-background graphic would otherwise collect a hundred
+votes from any other one.
+
+Tiles are hashed in one vectorized pass (summed-area table box sampling, batched DCT) into the same
+(3, 8) packed rows a `HashMatrix` holds for 8x8 hashes, and looked up with its batched XOR +
+popcount.
+"""
+import os
+import sqlite3
+import threading
+import numpy as np
+import scipy.fft
+from dotenv import load_dotenv
+from PIL import Image
+from .ingest import open_image
+from .hash_codec import HASH_TYPES
+from .similarity import HashMatrix
+
+load_dotenv()
+
+# SQLite file holding the tile hashes of published images (empty disables the tile index)
+tile_index_path = os.getenv('TILE_INDEX_PATH', '')
+# Tile sides, as fractions of the shorter image side
+tile_scales = tuple(float(scale) for scale in os.getenv('TILE_SCALES', '1,0.84,0.71,0.59,0.5,0.42').split(','))
+# Step between neighbouring tiles, as a fraction of the tile side
+tile_stride = float(os.getenv('TILE_STRIDE', '0.25'))
+# Longest side (pixels) of the working image the tiles are cut from
+tile_image_size = int(os.getenv('TILE_IMAGE_SIZE', '512'))
+# Average similarity (%) above which two tiles match
+tile_threshold = float(os.getenv('TILE_THRESHOLD', '76'))
+# Matching upload tiles a published image needs to count as the same image
+tile_min_votes = int(os.getenv('TILE_MIN_VOTES', '5'))
+# Share of neighbouring tile cells that must differ by more than TILE_DETAIL_CONTRAST gray levels
+# for the tile to be hashed; flatter tiles (plain backgrounds, sky, a single edge) are skipped
+tile_min_detail = float(os.getenv('TILE_MIN_DETAIL', '0.1'))
+tile_detail_contrast = float(os.getenv('TILE_DETAIL_CONTRAST', '4'))
+
+# Tiles are hashed like the 8x8 hash version: 64 bits per hash
+TILE_HASH_SIZE = 8
+TILE_NBITS = TILE_HASH_SIZE * TILE_HASH_SIZE
+
+
+def tile_boxes(width: int, height: int, scales: tuple = tile_scales, stride: float = tile_stride) -> np.ndarray:
+    """
+    The pyramid of square tiles of an image: for each scale, a grid of tiles with the given side
+    and stride, centered on the image.
+
+    Returns:
+        np.ndarray: A (T, 4) int array of (left, top, right, bottom) boxes.
+    """
+    boxes = []
+    for scale in scales:
+        side = max(1, min(width, height, round(min(width, height) * scale)))
+        step = max(1, round(side * stride))
+        columns = (width - side) // step + 1
+        rows = (height - side) // step + 1
+        left = (width - side - (columns - 1) * step) // 2 + step * np.arange(columns)
+        top = (height - side - (rows - 1) * step) // 2 + step * np.arange(rows)
+        left, top = np.meshgrid(left, top, indexing='ij')
+        left, top = left.ravel(), top.ravel()
+        boxes.append(np.stack([left, top, left + side, top + side], axis=1))
+    return np.concatenate(boxes)
+
+
+def _box_sample(table: np.ndarray, boxes: np.ndarray, rows: int, columns: int) -> np.ndarray:
+    """
+    Averages each box over a rows x columns grid of cells, for all boxes at once.
+
+    Parameters:
+        table (np.ndarray): The summed-area table of the image, with a leading row and column of zeros.
+        boxes (np.ndarray): (T, 4) boxes, see `tile_boxes()`.
+
+    Returns:
+        np.ndarray: A (T, rows, columns) float64 array.
+    """
+    left, top, right, bottom = (boxes[:, i, None].astype(np.float64) for i in range(4))
+    xs = np.rint(left + (right - left) * np.arange(columns + 1) / columns).astype(np.int64)
+    ys = np.rint(top + (bottom - top) * np.arange(rows + 1) / rows).astype(np.int64)
+    # Every cell covers at least one pixel, even when a tile is smaller than the grid
+    xs = np.maximum(xs, xs[:, :1] + np.arange(columns + 1))
+    ys = np.maximum(ys, ys[:, :1] + np.arange(rows + 1))
+    xs = np.minimum(xs, table.shape[1] - 1)
+    ys = np.minimum(ys, table.shape[0] - 1)
+    y0, y1 = ys[:, :-1, None], ys[:, 1:, None]
+    x0, x1 = xs[:, None, :-1], xs[:, None, 1:]
+    sums = table[y1, x1] - table[y0, x1] - table[y1, x0] + table[y0, x0]
+    return sums / np.maximum((y1 - y0) * (x1 - x0), 1)
+
+
+def tile_hashes(image_data: bytes, size: int = 512, scales: tuple = tile_scales, stride: float = tile_stride,
+                min_detail: float = tile_min_detail, contrast: float = tile_detail_contrast) -> np.ndarray:
+    """
+    Hashes the tiles of an image (see `tile_boxes()`) with 8x8 average, difference and perceptual hashes.
+
+    The hashes follow the imagehash definitions, but the tiles are sampled with box filters from a
+    summed-area table rather than resized with LANCZOS one by one, so they are not bit-identical to
+    calling imagehash on each tile; publish and verify both hash through this function. Kept free of
+    any app state so it can be shipped to worker processes by the execution layer.
+
+    Tiles whose 32x32 pHash input has fewer than `min_detail` of its neighbouring cells more than
+    `contrast` gray levels apart are skipped: their hashes say little about the image, and flat
+    tiles of unrelated images match each other.
+
+    Parameters:
+        image_data (bytes): The raw image bytes.
+        size (int): The longest side of the working image the tiles are cut from.
+        min_detail (float): The share of neighbouring cells that must differ for a tile to be hashed.
+        contrast (float): The gray level difference above which two neighbouring cells differ.
+
+    Returns:
+        np.ndarray: A (T, 3, 8) uint8 array of packed ahash, dhash and phash bits per hashed tile,
+                    with T = 0 for an image without detail.
+    """
+    image = open_image(image_data, size)
+    gray = image.convert('L')
+    gray.thumbnail((size, size), Image.Resampling.BOX)
+    pixels = np.asarray(gray, dtype=np.float64)
+    table = np.zeros((pixels.shape[0] + 1, pixels.shape[1] + 1))
+    table[1:, 1:] = pixels.cumsum(axis=0).cumsum(axis=1)
+    boxes = tile_boxes(gray.width, gray.height, scales, stride)
+
+    hash_size = TILE_HASH_SIZE
+    dct_input = _box_sample(table, boxes, 4 * hash_size, 4 * hash_size)
+    detail = ((np.abs(np.diff(dct_input, axis=1)) > contrast).mean(axis=(1, 2))
+              + (np.abs(np.diff(dct_input, axis=2)) > contrast).mean(axis=(1, 2))) / 2
+    keep = detail >= min_detail
+    if not keep.any():
+        return np.zeros((0, len(HASH_TYPES), TILE_NBITS // 8), dtype=np.uint8)
+    boxes, dct_input = boxes[keep], dct_input[keep]
+
+    small = _box_sample(table, boxes, hash_size, hash_size)
+    ahash = small > small.mean(axis=(1, 2), keepdims=True)
+    wide = _box_sample(table, boxes, hash_size, hash_size + 1)
+    dhash = wide[:, :, 1:] > wide[:, :, :-1]
+    dct = scipy.fft.dct(scipy.fft.dct(dct_input, axis=1), axis=2)[:, :hash_size, :hash_size]
+    phash = dct > np.median(dct.reshape(len(boxes), -1), axis=1)[:, None, None]
+
+    bits = np.stack([ahash, dhash, phash], axis=1).reshape(len(boxes), len(HASH_TYPES), -1)
+    return np.packbits(bits, axis=-1)
+
+
+class TileIndex:
+    """
+    The tile hashes of published images, persisted in SQLite and searched in a `HashMatrix`.
+
+    Each published image takes one row: the binary registry entry it was published as (see
+    `hash_codec.encode_hash()`) and its (T, 3, 8) tile hashes. Every process loads the rows into
+    its own matrix, one matrix row per tile with the image's row id as position, and picks up the
+    images other workers published on each lookup.
+
+    Parameters:
+        path (str): Location of the database file.
+        threshold (float): Average similarity (%) above which two tiles match.
+        min_votes (int): Matching upload tiles a published image needs.
+    """
+
+    def __init__(self, path: str, threshold: float = 76.0, min_votes: int = 5):
+        self.path = path
+        self.threshold = threshold
+        self.min_votes = min_votes
+        self.matrix = HashMatrix(nbits=TILE_NBITS)
+        self._entries = {}
+        self._last_id = 0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS tiles (id INTEGER PRIMARY KEY, entry BLOB NOT NULL, hashes BLOB NOT NULL)")
+        self._conn.commit()
+
+    def __len__(self) -> int:
+        """The number of published images indexed."""
+        with self._lock:
+            self._refresh()
+            return len(self._entries)
+
+    def _refresh(self):
+        rows = self._conn.execute("SELECT id, entry, hashes FROM tiles WHERE id > ? ORDER BY id",
+                                  (self._last_id,)).fetchall()
+        for image_id, entry, hashes in rows:
+            bits = np.frombuffer(hashes, dtype=np.uint8).reshape(-1, len(HASH_TYPES), self.matrix.nbytes)
+            self.matrix.append_bits(bits, np.full(len(bits), image_id))
+            self._entries[image_id] = bytes(entry)
+            self._last_id = image_id
+
+    def put(self, entry: bytes, hashes: np.ndarray):
+        """Index the tile hashes of a published entry."""
+        with self._lock:
+            self._conn.execute("INSERT INTO tiles (entry, hashes) VALUES (?, ?)",
+                               (entry, np.ascontiguousarray(hashes, dtype=np.uint8).tobytes()))
+            self._conn.commit()
+
+    def vote(self, hashes: np.ndarray) -> tuple:
+        """
+        Looks the tiles of an upload up and counts, per published image, how many of them match one
+        of its tiles.
+
+        Parameters:
+            hashes (np.ndarray): The (T, 3, 8) tile hashes of the upload (see `tile_hashes()`).
+
+        Returns:
+            tuple[bytes | None, int]: The entry of the published image with the most votes if it has
+                                      at least `min_votes` (else None), and its number of votes.
+        """
+        with self._lock:
+            self._refresh()
+            queries, rows = self.matrix.match_pairs(hashes, threshold=self.threshold)
+            images = self.matrix.positions[rows]
+            entries = self._entries
+        if not len(images):
+            return None, 0
+        # One vote per upload tile and image, however many of the image's tiles it matches
+        voters = np.unique(np.stack([images, queries]), axis=1)
+        image_ids, votes = np.unique(voters[0], return_counts=True)
+        best = int(np.argmax(votes))
+        votes = int(votes[best])
+        return (entries[int(image_ids[best])] if votes >= self.min_votes else None), votes
+
+
+tile_index = TileIndex(tile_index_path, threshold=tile_threshold, min_votes=tile_min_votes) if tile_index_path else None
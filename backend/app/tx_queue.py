@@ -0,0 +1,442 @@
+import contextlib
+import fcntl
+import os
+import queue
+import sqlite3
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from dotenv import load_dotenv
+from .callSC import send_add_hash, send_add_hashes, send_anchor, get_pending_nonce, get_receipt, get_block_number
+from .executor import ExecutorOverloaded
+from .log import get_logger
+from .metrics import STAGE_SECONDS, RPC_ERRORS
+
+load_dotenv()
+log = get_logger('tx_queue')
+
+# Maximum number of publish jobs waiting to be submitted
+queue_size = int(os.getenv('TX_QUEUE_SIZE', '1000'))
+# Maximum hashes per addHashes transaction (1 sends plain addHash, for contracts without addHashes)
+batch_size = int(os.getenv('TX_BATCH_SIZE', '1'))
+# Seconds the submitter waits for a batch to fill before sending what it has
+batch_deadline = float(os.getenv('TX_BATCH_DEADLINE', '2'))
+# Seconds between receipt polls for submitted transactions
+receipt_poll_interval = float(os.getenv('TX_RECEIPT_POLL_INTERVAL', '2'))
+# Blocks on top of the inclusion block before a job counts as mined
+confirmations = int(os.getenv('TX_CONFIRMATIONS', '1'))
+# Seconds after which a submitted transaction without receipt is marked failed
+receipt_timeout = float(os.getenv('TX_RECEIPT_TIMEOUT', '600'))
+# Finished jobs kept for status lookups
+max_finished_jobs = int(os.getenv('TX_MAX_FINISHED_JOBS', '10000'))
+# SQLite file the worker processes of one host share the account nonce and the job states through.
+# Required with more than one worker (WEB_CONCURRENCY > 1); empty keeps both in this process.
+publish_state_path = os.getenv('PUBLISH_STATE_PATH', '')
+# uvicorn worker processes; read by uvicorn itself, checked here because they all publish from one account
+web_concurrency = int(os.getenv('WEB_CONCURRENCY', '1'))
+
+PENDING = 'pending'
+SUBMITTED = 'submitted'
+MINED = 'mined'
+FAILED = 'failed'
+
+
+@dataclass
+class PublishJob:
+    """State of one queued addHash transaction."""
+    hash: str
+    # What is sent on-chain: the hash string, or its binary encoding (see hash_codec)
+    entry: str | bytes
+    id: str = field(default_factory=lambda: uuid.uuid4().hex)
+    status: str = PENDING
+    trx_hash: str | None = None
+    block_number: int | None = None
+    error: str | None = None
+    created: float = field(default_factory=time.time)
+    submitted: float | None = None
+    # What the publisher keeps of the image once the entry is mined (see `submit()`)
+    artifacts: dict | None = field(default=None, repr=False)
+
+
+@dataclass
+class AnchorJob(PublishJob):
+    """State of one Merkle root anchor transaction (see merkle.py); `entry` is its calldata."""
+    source: int = 0
+    size: int = 0
+    root: bytes = b''
+
+
+class SharedPublishState:
+    """
+    The account nonce and the publish job states, shared by the worker processes of one host.
+
+    Every worker queues, batches and tracks its own publishes, but they all send from the same
+    account. A worker sends a transaction while holding an exclusive lock on `<path>.lock`: it
+    takes the next nonce from the database (or the pending nonce from the node when it is unset),
+    sends, and stores the nonce after it before releasing the lock. So two workers never sign with
+    the same nonce, and a worker that resets the nonce after an error never reads the pending nonce
+    while another one is between reading and sending.
+
+    Job states are written on every transition, so `GET /api/publish/{job_id}` can be answered by
+    any worker. Jobs still queued in a worker that exits stay pending.
+
+    Parameters:
+        path (str): Location of the database file.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self._lock_file = open(f"{path}.lock", 'a')
+        self._conn = sqlite3.connect(path, check_same_thread=False, timeout=30.0)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS publish_nonce (id INTEGER PRIMARY KEY CHECK (id = 0), nonce INTEGER)")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS publish_jobs (id TEXT PRIMARY KEY, hash TEXT NOT NULL, status TEXT NOT NULL, "
+            "trx_hash TEXT, block_number INTEGER, error TEXT, created REAL NOT NULL, submitted REAL)")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS publish_jobs_finished ON publish_jobs (status, created)")
+        self._conn.commit()
+
+    @contextlib.contextmanager
+    def sending(self):
+        """Hold the send lock of the account, across processes."""
+        fcntl.flock(self._lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(self._lock_file, fcntl.LOCK_UN)
+
+    def get_nonce(self) -> int | None:
+        """The next nonce to send with, or None if it has to be read from the node."""
+        with self._lock:
+            row = self._conn.execute("SELECT nonce FROM publish_nonce WHERE id = 0").fetchone()
+        return None if row is None else row[0]
+
+    def set_nonce(self, nonce: int | None):
+        """Store the next nonce; None makes the next sender read the pending nonce again."""
+        with self._lock:
+            self._conn.execute("INSERT OR REPLACE INTO publish_nonce (id, nonce) VALUES (0, ?)", (nonce,))
+            self._conn.commit()
+
+    def put_job(self, job: PublishJob):
+        """Write the current state of a job, and forget the oldest finished jobs past `max_finished_jobs`."""
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO publish_jobs (id, hash, status, trx_hash, block_number, error, created, "
+                "submitted) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (job.id, job.hash, job.status, job.trx_hash, job.block_number, job.error, job.created, job.submitted))
+            if job.status in (MINED, FAILED):
+                self._conn.execute(
+                    "DELETE FROM publish_jobs WHERE id IN (SELECT id FROM publish_jobs WHERE status IN (?, ?) "
+                    "ORDER BY created DESC LIMIT -1 OFFSET ?)", (MINED, FAILED, max_finished_jobs))
+            self._conn.commit()
+
+    def get_job(self, job_id: str) -> PublishJob | None:
+        """A job queued by any worker, without the fields only its own worker needs (entry, artifacts)."""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT hash, status, trx_hash, block_number, error, created, submitted FROM publish_jobs "
+                "WHERE id = ?", (job_id,)).fetchone()
+        if row is None:
+            return None
+        return PublishJob(row[0], None, id=job_id, status=row[1], trx_hash=row[2], block_number=row[3],
+                          error=row[4], created=row[5], submitted=row[6])
+
+
+class TransactionSubmitter:
+    """
+    Pipelined publisher for addHash transactions.
+
+    `submit()` queues a hash and returns a `PublishJob` immediately. A submitter thread owns the
+    account nonce: it reads the pending nonce once, then signs and sends each queued transaction
+    with the next nonce without waiting for the previous one to be mined, so several publishes can
+    land in the same block. A tracker thread polls receipts of submitted transactions and moves jobs
+    to mined (after `confirmations` blocks) or failed (reverted or timed out).
+
+    With `batch_size` > 1 the submitter coalesces queued jobs: it flushes one addHashes transaction
+    once `batch_size` hashes are waiting or `batch_deadline` seconds after the first one arrived,
+    whichever comes first. Every job of a batch shares the batch's transaction hash.
+
+    With an off-chain `registry` (see registry.py) each batch is written with `append_many()`
+    instead, and its jobs are mined as soon as the write returns.
+
+    Merkle roots queued with `submit_anchor()` take the same nonce sequence, each in its own
+    transaction, and reach `on_mined` as a single `AnchorJob`.
+
+    Each worker process runs its own submitter. With more than one, they must share a
+    `SharedPublishState` (PUBLISH_STATE_PATH), or they would sign with the same nonces and only
+    know about the jobs they queued themselves.
+
+    Parameters:
+        on_mined (callable): Called with the jobs of a transaction once it is mined, e.g. to sync
+                             the hash index, and before the jobs are marked MINED, so a client
+                             that sees a job mined finds its hash in the index.
+        registry (HashRegistry): The registry to publish to; None or an on-chain registry sends
+                                 transactions from the account.
+        shared (SharedPublishState): The nonce and job states shared with the other workers, if any.
+    """
+
+    def __init__(self, on_mined=None, registry=None, shared: SharedPublishState = None):
+        self.on_mined = on_mined
+        self.registry = registry
+        self.shared = shared
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._jobs = OrderedDict()
+        self._by_hash = {}
+        # Transaction hash -> jobs it registers
+        self._submitted = {}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._threads = []
+        self._nonce = None
+        # Set by the tracker when a transaction times out: its nonce may have been dropped
+        self._nonce_stale = threading.Event()
+
+    def start(self):
+        if self._threads:
+            return
+        self._stop.clear()
+        self._threads = [
+            threading.Thread(target=self._submit_loop, name="tx-submitter", daemon=True),
+            threading.Thread(target=self._track_loop, name="tx-receipt-tracker", daemon=True),
+        ]
+        for thread in self._threads:
+            thread.start()
+
+    def stop(self):
+        self._stop.set()
+        for thread in self._threads:
+            thread.join(timeout=receipt_poll_interval)
+        self._threads = []
+
+    def submit(self, hash_string: str, entry: str | bytes = None, artifacts: dict = None) -> PublishJob:
+        """
+        Queue a hash for publishing. A hash that is already queued or in flight returns its existing
+        job instead of sending a duplicate transaction.
+
+        Parameters:
+            hash_string (str): The "ahash#dhash#phash" string.
+            entry (str | bytes): The on-chain form of the hash, defaults to the string itself.
+            artifacts (dict): Carried on the job to `on_mined`, and dropped if the job fails.
+
+        Raises:
+            ExecutorOverloaded: If `queue_size` jobs are already waiting.
+        """
+        with self._lock:
+            job = self._by_hash.get(hash_string)
+            if job is not None and job.status != FAILED:
+                return job
+            job = PublishJob(hash_string, hash_string if entry is None else entry, artifacts=artifacts)
+            try:
+                self._queue.put_nowait(job)
+            except queue.Full:
+                raise ExecutorOverloaded('transaction')
+            self._jobs[job.id] = job
+            self._by_hash[hash_string] = job
+        self._share(job)
+        return job
+
+    def submit_anchor(self, source: int, size: int, root: bytes, data: bytes) -> AnchorJob:
+        """
+        Queue the on-chain anchor of a Merkle root (see `MerkleLog.anchor()`).
+
+        Raises:
+            ValueError: If the registry is off-chain, where there is no chain to anchor to.
+            ExecutorOverloaded: If `queue_size` jobs are already waiting.
+        """
+        if self.registry is not None and not self.registry.on_chain:
+            raise ValueError("Merkle roots are only anchored with an on-chain registry")
+        job = AnchorJob(f"merkle-root:{root.hex()}", data, source=source, size=size, root=root)
+        with self._lock:
+            try:
+                self._queue.put_nowait(job)
+            except queue.Full:
+                raise ExecutorOverloaded('transaction')
+            self._jobs[job.id] = job
+        self._share(job)
+        return job
+
+    def get(self, job_id: str) -> PublishJob | None:
+        job = self._jobs.get(job_id)
+        if job is None and self.shared is not None:
+            # Queued by another worker
+            try:
+                job = self.shared.get_job(job_id)
+            except sqlite3.Error as e:
+                log.error("Error reading shared publish job", extra={"job_id": job_id, "error": str(e)})
+        return job
+
+    def _share(self, job: PublishJob):
+        """Write a job's state for the other workers."""
+        if self.shared is None:
+            return
+        try:
+            self.shared.put_job(job)
+        except sqlite3.Error as e:
+            log.error("Error writing shared publish job", extra={"job_id": job.id, "error": str(e)})
+
+    def _finish(self, job: PublishJob, status: str, error: str = None):
+        with self._lock:
+            job.status = status
+            job.error = error
+            if status == FAILED:
+                job.artifacts = None
+            if self._by_hash.get(job.hash) is job:
+                del self._by_hash[job.hash]
+            # Forget the oldest finished jobs
+            finished = [job_id for job_id, j in self._jobs.items() if j.status in (MINED, FAILED)]
+            for job_id in finished[:max(0, len(finished) - max_finished_jobs)]:
+                del self._jobs[job_id]
+        self._share(job)
+
+    def _next_batch(self) -> list:
+        """Block for the first job, then collect more until the batch is full or the deadline passes."""
+        try:
+            batch = [self._queue.get(timeout=0.5)]
+        except queue.Empty:
+            return []
+        deadline = time.monotonic() + batch_deadline
+        while len(batch) < batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _append_batch(self, batch: list):
+        """Write a batch to an off-chain registry, where a successful write is final."""
+        try:
+            with STAGE_SECONDS.time(stage="registry_append"):
+                self.registry.append_many([job.entry for job in batch])
+        except Exception as e:
+            log.error("Error appending hashes", extra={"count": len(batch), "error": str(e)})
+            for job in batch:
+                self._finish(job, FAILED, str(e))
+            return
+        self._mined(batch)
+
+    def _mined(self, jobs: list):
+        """Hand the jobs of a mined transaction or write to `on_mined`, then mark them MINED."""
+        if self.on_mined is not None:
+            try:
+                self.on_mined(jobs)
+            except Exception as e:
+                log.error("Error handling mined hashes", extra={"trx_hash": jobs[0].trx_hash, "error": str(e)})
+        for job in jobs:
+            self._finish(job, MINED)
+
+    def _submit_loop(self):
+        while not self._stop.is_set():
+            batch = self._next_batch()
+            if not batch:
+                continue
+            if self.registry is not None and not self.registry.on_chain:
+                self._append_batch(batch)
+                continue
+            anchors = [job for job in batch if isinstance(job, AnchorJob)]
+            hashes = [job for job in batch if not isinstance(job, AnchorJob)]
+            for job in anchors:
+                self._send_batch([job], lambda nonce: send_anchor(job.entry, nonce))
+            if len(hashes) == 1:
+                self._send_batch(hashes, lambda nonce: send_add_hash(hashes[0].entry, nonce))
+            elif hashes:
+                self._send_batch(hashes, lambda nonce: send_add_hashes([job.entry for job in hashes], nonce))
+
+    def _send_batch(self, batch: list, send):
+        """Send one transaction for a batch with the next nonce, and track it until it is mined."""
+        try:
+            with self.shared.sending() if self.shared is not None else contextlib.nullcontext():
+                if self.shared is not None:
+                    # Another worker may have sent since, or reset it
+                    self._nonce = self.shared.get_nonce()
+                if self._nonce is None or self._nonce_stale.is_set():
+                    # A dropped transaction left a gap that would hold back every later one
+                    self._nonce_stale.clear()
+                    self._nonce = get_pending_nonce()
+                with STAGE_SECONDS.time(stage="chain_submit"):
+                    tx_hash = send(self._nonce)
+                self._nonce += 1
+                if self.shared is not None:
+                    self.shared.set_nonce(self._nonce)
+            with self._lock:
+                for job in batch:
+                    job.trx_hash = tx_hash.hex()
+                    job.status = SUBMITTED
+                    job.submitted = time.time()
+                self._submitted[tx_hash.hex()] = batch
+            for job in batch:
+                self._share(job)
+        except Exception as e:
+            RPC_ERRORS.inc(call="send")
+            log.error("Error submitting hashes", extra={"count": len(batch), "nonce": self._nonce,
+                                                        "error": str(e)})
+            # The nonce may be out of sync (e.g. a transaction was sent elsewhere), re-read it
+            self._nonce = None
+            self._invalidate_nonce()
+            for job in batch:
+                self._finish(job, FAILED, str(e))
+
+    def _invalidate_nonce(self):
+        """Make the next send, in any worker, read the pending nonce from the node again."""
+        self._nonce_stale.set()
+        if self.shared is not None:
+            try:
+                self.shared.set_nonce(None)
+            except sqlite3.Error as e:
+                log.error("Error resetting shared nonce", extra={"error": str(e)})
+
+    def _track_loop(self):
+        while not self._stop.wait(receipt_poll_interval):
+            with self._lock:
+                submitted = list(self._submitted.items())
+            if not submitted:
+                continue
+            try:
+                block_number = get_block_number()
+            except Exception as e:
+                log.error("Error reading block number", extra={"error": str(e)})
+                continue
+            for trx_hash, jobs in submitted:
+                try:
+                    receipt = get_receipt(trx_hash)
+                except Exception as e:
+                    log.error("Error reading receipt", extra={"trx_hash": trx_hash, "error": str(e)})
+                    continue
+                if receipt is None:
+                    if time.time() - jobs[0].submitted > receipt_timeout:
+                        self._untrack(trx_hash)
+                        self._invalidate_nonce()
+                        for job in jobs:
+                            self._finish(job, FAILED, "Timed out waiting for receipt")
+                    continue
+                for job in jobs:
+                    job.block_number = receipt['blockNumber']
+                if receipt['status'] != 1:
+                    self._untrack(trx_hash)
+                    for job in jobs:
+                        self._finish(job, FAILED, "Transaction reverted")
+                elif block_number - receipt['blockNumber'] + 1 >= confirmations:
+                    self._untrack(trx_hash)
+                    STAGE_SECONDS.observe(time.time() - jobs[0].submitted, stage="chain_receipt")
+                    self._mined(jobs)
+
+    def _untrack(self, trx_hash: str):
+        with self._lock:
+            self._submitted.pop(trx_hash, None)
+
+
+def create_shared_state(path: str, workers: int) -> SharedPublishState | None:
+    """Build the publish state shared between workers (`PUBLISH_STATE_PATH`), required with several workers."""
+    if path:
+        return SharedPublishState(path)
+    if workers > 1:
+        raise ValueError("WEB_CONCURRENCY > 1 requires PUBLISH_STATE_PATH, the workers publish from one account")
+    return None
+
+
+shared_state = create_shared_state(publish_state_path, web_concurrency)
@@ -0,0 +1,415 @@
+"""
+Benchmark suite for app import time, hashing, peak memory, similarity, registry search and the HTTP
+endpoints.
+
+Usage (from the backend directory):
+
+    python benchmarks/run.py                                  # everything, default sizes
+    python benchmarks/run.py --only hashing,similarity        # a subset of the groups
+    python benchmarks/run.py --sizes 1000,100000              # smaller registries for search
+    python benchmarks/run.py --compare benchmarks/results/<earlier run>.json --max-regression 0.25
+
+Every case is timed `--repeat` times after one warm-up run, and the min / median / mean / stdev
+(seconds) are written, with the machine and library versions, to a JSON file under
+`benchmarks/results/` (or `--output`). The memory group records instead the peak RSS one upload
+adds to the process serving it. With `--compare`, medians and peak RSS are checked against an
+earlier results file and the process exits with status 1 if a case got slower or bigger than
+`--max-regression` allows, so the run can gate a deploy. Only compare results produced on the same
+machine.
+
+The app runs against the in-memory registry (REGISTRY_BACKEND=memory), so no node is needed and
+nothing is published on-chain. The optional stores (thumbnails, tiles, feature descriptors) are
+turned off and nothing is written next to the deployment's files. Results files are not committed:
+keep the one to compare against on the machine that runs the benchmarks.
+"""
+import argparse
+import glob
+import io
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import statistics
+import subprocess
+import sys
+import time
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BACKEND_DIR)
+
+# Isolate the app from any deployment settings before it is imported
+os.environ['REGISTRY_BACKEND'] = 'memory'
+os.environ['HASH_INDEX_PATH'] = ':memory:'
+os.environ['SHARED_MATRIX_PATH'] = ''
+os.environ['RESULT_CACHE_PATH'] = ''
+os.environ['THUMBNAIL_STORE_PATH'] = ''
+os.environ['TILE_INDEX_PATH'] = ''
+os.environ['FEATURE_VERIFIER'] = 'off'
+os.environ['FEATURE_STORE_PATH'] = ''
+os.environ['MERKLE_PATH'] = ':memory:'
+os.environ['PUBLISH_STATE_PATH'] = ''
+os.environ['WEB_CONCURRENCY'] = '1'
+
+import numpy as np
+from PIL import Image
+
+GROUPS = ('startup', 'hashing', 'memory', 'similarity', 'search', 'endpoints')
+EXPERIMENTS_DIR = os.path.join(BACKEND_DIR, 'experiments')
+RESULTS_DIR = os.path.join(BACKEND_DIR, 'benchmarks', 'results')
+# Synthetic image sizes for the hashing benchmarks
+SYNTHETIC_SIZES = ((512, 512), (2048, 1536), (6000, 4000))
+SYNTHETIC_FORMATS = ('JPEG', 'PNG', 'WEBP')
+# Peak RSS growth too small to flag as a regression, whatever the ratio (allocator noise)
+MEMORY_NOISE_BYTES = 8 * 2 ** 20
+
+
+def measure(fn, repeat: int) -> dict:
+    """Time `fn` `repeat` times after one untimed warm-up call."""
+    fn()
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        timings.append(time.perf_counter() - start)
+    return summarize(timings)
+
+
+def summarize(timings: list) -> dict:
+    """The statistics written for a timed case."""
+    return {
+        "repeat": len(timings),
+        "min": min(timings),
+        "median": statistics.median(timings),
+        "mean": statistics.fmean(timings),
+        "stdev": statistics.stdev(timings) if len(timings) > 1 else 0.0,
+    }
+
+
+def synthetic_image(size: tuple, seed: int = 0) -> Image.Image:
+    """A smooth random colour field: compresses like a photo, unlike pure noise."""
+    rng = np.random.default_rng(seed)
+    low = rng.integers(0, 256, size=(24, 32, 3), dtype=np.uint8)
+    image = Image.fromarray(low).resize(size, Image.BICUBIC)
+    noise = rng.integers(-8, 9, size=(size[1], size[0], 3))
+    return Image.fromarray(np.clip(np.asarray(image, dtype=np.int16) + noise, 0, 255).astype(np.uint8))
+
+
+def encode(image: Image.Image, image_format: str) -> bytes:
+    buffer = io.BytesIO()
+    image.save(buffer, image_format)
+    return buffer.getvalue()
+
+
+def random_entries(count: int, seed: int) -> list:
+    """Random binary registry entries (format version byte + the three 256 bit hashes)."""
+    from app.hash_codec import FORMAT_V1
+    rng = np.random.default_rng(seed)
+    bits = rng.integers(0, 256, size=(count, 96), dtype=np.uint8)
+    version = bytes([FORMAT_V1])
+    return [version + row.tobytes() for row in bits]
+
+
+def flip_bits(entry: bytes, nbits: int, seed: int) -> bytes:
+    """A near-duplicate of an entry: `nbits` random bits of the hashes flipped."""
+    rng = np.random.default_rng(seed)
+    data = bytearray(entry)
+    for bit in rng.choice(96 * 8, size=nbits, replace=False):
+        data[1 + bit // 8] ^= 1 << (bit % 8)
+    return bytes(data)
+
+
+# Run in a fresh interpreter: how long importing the app takes, and which heavy modules it loaded
+IMPORT_SCRIPT = """
+import json, sys, time
+start = time.perf_counter()
+import app.main
+print(json.dumps({"seconds": time.perf_counter() - start, "web3": "web3" in sys.modules}))
+"""
+
+
+def bench_startup(results: list, repeat: int):
+    """
+    Import time of app.main in a fresh interpreter, which every worker process pays before it
+    serves, with the in-memory and the on-chain registry. The chain client is built on first use
+    (see callSC.py), so importing the app must not load web3, which alone takes over a second to
+    import; the case fails if it does.
+    """
+    for backend in ('memory', 'chain'):
+        env = {**os.environ, 'REGISTRY_BACKEND': backend}
+        timings = []
+        # The first run warms the OS file cache, like the warm-up call of `measure()`
+        for _ in range(repeat + 1):
+            output = subprocess.run([sys.executable, '-c', IMPORT_SCRIPT], cwd=BACKEND_DIR, env=env,
+                                    capture_output=True, text=True, check=True).stdout
+            child = json.loads(output.splitlines()[-1])
+            if child["web3"]:
+                raise RuntimeError(f"Importing app.main with REGISTRY_BACKEND={backend} loaded web3")
+            timings.append(child["seconds"])
+        results.append({"name": f"startup/import-app.main-{backend}", "group": "startup",
+                        "params": {"registry_backend": backend}, **summarize(timings[1:])})
+
+
+def bench_hashing(results: list, repeat: int):
+    from app.main import calculate_image_hash
+
+    for path in sorted(glob.glob(os.path.join(EXPERIMENTS_DIR, 'test_image*.jpeg'))):
+        contents = open(path, 'rb').read()
+        width, height = Image.open(io.BytesIO(contents)).size
+        results.append({"name": f"hashing/{os.path.basename(path)}", "group": "hashing",
+                        "params": {"format": "JPEG", "size": [width, height], "bytes": len(contents)},
+                        **measure(lambda: calculate_image_hash(contents), repeat)})
+
+    for size in SYNTHETIC_SIZES:
+        image = synthetic_image(size)
+        for image_format in SYNTHETIC_FORMATS:
+            if image_format == 'WEBP' and max(size) > 16383:
+                continue
+            contents = encode(image, image_format)
+            results.append({"name": f"hashing/synthetic-{size[0]}x{size[1]}.{image_format.lower()}",
+                            "group": "hashing",
+                            "params": {"format": image_format, "size": list(size), "bytes": len(contents)},
+                            **measure(lambda: calculate_image_hash(contents), repeat)})
+
+
+def read_peak_rss(reset: bool = False) -> int:
+    """
+    The peak resident set size of this process, in bytes. With `reset`, the peak is first lowered to
+    the current RSS where the kernel allows it (Linux `clear_refs`), so the next read covers only
+    what runs in between; elsewhere it stays the peak since the process started.
+    """
+    try:
+        if reset:
+            with open('/proc/self/clear_refs', 'w') as clear_refs:
+                clear_refs.write('5')
+        with open('/proc/self/status') as status:
+            for line in status:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Kilobytes on Linux, bytes on macOS
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def upload_peak_rss(endpoint: str, contents: bytes, content_type: str) -> int:
+    """
+    Runs in a fresh process: the peak RSS one upload to `endpoint` adds on top of the app at rest,
+    in bytes. The CPU stages run in threads, so the decode counts towards this process. A small
+    upload is sent first, so the codecs and pools are loaded before the peak is reset.
+    """
+    os.environ['CPU_EXECUTOR'] = 'thread'
+    from fastapi.testclient import TestClient
+    from app.main import app
+
+    with TestClient(app) as client:
+        warm_up = encode(synthetic_image((64, 64)), 'PNG')
+        client.post(endpoint, files={'file': ('image.png', warm_up, 'image/png')}).raise_for_status()
+        before = read_peak_rss(reset=True)
+        response = client.post(endpoint, files={'file': ('image', contents, content_type)})
+        response.raise_for_status()
+        return read_peak_rss() - before
+
+
+def bench_memory(results: list):
+    """
+    Peak RSS of one verify per synthetic image, each in a fresh process so one upload's peak does
+    not hide the next. The byte and pixel budgets of ingest.py bound it; this shows by how much.
+    """
+    from app.ingest import max_image_pixels, max_upload_bytes
+
+    context = multiprocessing.get_context('spawn')
+    for size in SYNTHETIC_SIZES:
+        image = synthetic_image(size)
+        for image_format in SYNTHETIC_FORMATS:
+            contents = encode(image, image_format)
+            with context.Pool(1) as pool:
+                peak = pool.apply(upload_peak_rss, ('/api/verify', contents, f'image/{image_format.lower()}'))
+            results.append({"name": f"memory/verify-{size[0]}x{size[1]}.{image_format.lower()}", "group": "memory",
+                            "params": {"format": image_format, "size": list(size), "bytes": len(contents),
+                                       "max_image_pixels": max_image_pixels, "max_upload_bytes": max_upload_bytes},
+                            "peak_rss_bytes": peak})
+
+
+def bench_similarity(results: list, repeat: int):
+    from app.main import calculate_similaties
+    from app.hash_codec import to_hash_string
+
+    entries = [to_hash_string(entry) for entry in random_entries(1000, seed=1)]
+    pairs = list(zip(entries[::2], entries[1::2]))
+
+    def compare_all():
+        for hash_1, hash_2 in pairs:
+            calculate_similaties(hash_1, hash_2)
+
+    results.append({"name": "similarity/calculate_similaties-x500", "group": "similarity",
+                    "params": {"pairs": len(pairs)}, **measure(compare_all, repeat)})
+
+
+def bench_search(results: list, repeat: int, sizes: list):
+    from app.main import search_image, search_images, search_top_k, MATCH_THRESHOLD
+    from app.hash_index import hash_index
+    from app.registry import registry, LEGACY_SOURCE
+    from app.hash_codec import to_hash_string, encode_hash
+
+    seed = 100
+    for size in sorted(sizes):
+        # Grow the registry to `size` entries (default string format) and pull them into the index
+        missing = size - registry.count(LEGACY_SOURCE)
+        start = time.perf_counter()
+        for offset in range(0, missing, 100000):
+            entries = random_entries(min(100000, missing - offset), seed=seed)
+            registry.append_many([to_hash_string(entry) for entry in entries])
+            seed += 1
+        hash_index.sync()
+        load_time = time.perf_counter() - start
+
+        existing = next(registry.iter_since(size // 2, source=LEGACY_SOURCE))
+        near_duplicate = to_hash_string(flip_bits(encode_hash(existing), 60, seed=size))
+        unrelated = to_hash_string(random_entries(1, seed=size)[0])
+        batch = [to_hash_string(entry) for entry in random_entries(32, seed=size + 1)]
+
+        params = {"registry_size": size, "sync_seconds": load_time}
+        results.append({"name": f"search/search_image-miss-{size}", "group": "search", "params": params,
+                        **measure(lambda: search_image(unrelated), repeat)})
+        results.append({"name": f"search/search_image-hit-{size}", "group": "search", "params": params,
+                        **measure(lambda: search_image(near_duplicate), repeat)})
+        results.append({"name": f"search/search_top_k-10-{size}", "group": "search", "params": {**params, "k": 10},
+                        **measure(lambda: search_top_k(near_duplicate, 10, MATCH_THRESHOLD), repeat)})
+        results.append({"name": f"search/search_images-miss-x32-{size}", "group": "search",
+                        "params": {**params, "queries": len(batch)},
+                        **measure(lambda: search_images(batch), repeat)})
+
+
+def bench_endpoints(results: list, repeat: int, requests: int):
+    from fastapi.testclient import TestClient
+    from app.main import app
+
+    images = [encode(synthetic_image((1024, 768), seed=1000 + i), 'JPEG') for i in range(requests * (repeat + 1) * 2)]
+    cursor = iter(images)
+
+    def post_all(endpoint: str, files: list):
+        for contents in files:
+            response = client.post(endpoint, files={'file': ('image.jpeg', contents, 'image/jpeg')})
+            response.raise_for_status()
+
+    with TestClient(app) as client:
+        cases = (
+            ("endpoints/verify-unique", "/api/verify", lambda: [next(cursor) for _ in range(requests)]),
+            ("endpoints/verify-repeat", "/api/verify", lambda: [images[0]] * requests),
+            ("endpoints/publish-unique", "/api/publish", lambda: [next(cursor) for _ in range(requests)]),
+        )
+        for name, endpoint, make_files in cases:
+            timing = measure(lambda: post_all(endpoint, make_files()), repeat)
+            timing["requests_per_second"] = requests / timing["median"]
+            results.append({"name": name, "group": "endpoints", "params": {"requests": requests}, **timing})
+
+
+def metadata() -> dict:
+    import imagehash
+    import PIL
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=BACKEND_DIR, capture_output=True,
+                                text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        "timestamp": time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        "commit": commit,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "machine": platform.machine(),
+        "cpu_count": os.cpu_count(),
+        "numpy": np.__version__,
+        "pillow": PIL.__version__,
+        "imagehash": imagehash.__version__,
+    }
+
+
+def format_result(result: dict, key: str = None) -> str:
+    """The median of a timed case in ms, or the peak RSS of a memory case in MB."""
+    if "peak_rss_bytes" in result:
+        return f"{result['peak_rss_bytes'] / 2 ** 20:10.1f}MB"
+    return f"{result[key or 'median'] * 1000:10.2f}ms"
+
+
+def compare(results: list, baseline_path: str, max_regression: float) -> list:
+    """
+    Return the cases whose median got slower (or whose peak RSS grew) compared with the baseline by
+    more than `max_regression`.
+    """
+    with open(baseline_path) as baseline_file:
+        baseline = {result["name"]: result for result in json.load(baseline_file)["results"]}
+    regressions = []
+    for result in results:
+        previous = baseline.get(result["name"])
+        if previous is None:
+            continue
+        if "peak_rss_bytes" in result:
+            ratio = result["peak_rss_bytes"] / max(previous["peak_rss_bytes"], 1)
+            regressed = (ratio > 1 + max_regression
+                         and result["peak_rss_bytes"] - previous["peak_rss_bytes"] > MEMORY_NOISE_BYTES)
+        else:
+            ratio = result["median"] / previous["median"]
+            regressed = ratio > 1 + max_regression
+        flag = "REGRESSION" if regressed else ""
+        print(f"{result['name']:<55} {format_result(previous)} -> {format_result(result)} ({ratio:5.2f}x) {flag}")
+        if flag:
+            regressions.append(result["name"])
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run the backend benchmarks and store the results as JSON.")
+    parser.add_argument('--only', default=','.join(GROUPS), help=f"Comma separated groups among {', '.join(GROUPS)}")
+    parser.add_argument('--repeat', type=int, default=5, help="Timed runs per case")
+    parser.add_argument('--sizes', default='1000,100000,1000000', help="Registry sizes for the search group")
+    parser.add_argument('--requests', type=int, default=20, help="Requests per timed run of the endpoint group")
+    parser.add_argument('--output', help="Results file (default: benchmarks/results/<timestamp>.json)")
+    parser.add_argument('--compare', help="Earlier results file to check the medians against")
+    parser.add_argument('--max-regression', type=float, default=0.25,
+                        help="Allowed relative slowdown of a median before --compare fails")
+    args = parser.parse_args()
+
+    groups = [group for group in args.only.split(',') if group]
+    unknown = set(groups) - set(GROUPS)
+    if unknown:
+        parser.error(f"Unknown groups: {', '.join(sorted(unknown))}")
+
+    results = []
+    if 'startup' in groups:
+        bench_startup(results, args.repeat)
+    if 'hashing' in groups:
+        bench_hashing(results, args.repeat)
+    if 'memory' in groups:
+        bench_memory(results)
+    if 'similarity' in groups:
+        bench_similarity(results, args.repeat)
+    # Before search, which grows the registry the endpoints would then scan
+    if 'endpoints' in groups:
+        bench_endpoints(results, args.repeat, args.requests)
+    if 'search' in groups:
+        bench_search(results, args.repeat, [int(size) for size in args.sizes.split(',')])
+
+    for result in results:
+        if "peak_rss_bytes" in result:
+            print(f"{result['name']:<55} peak RSS {format_result(result)}")
+        else:
+            print(f"{result['name']:<55} median {format_result(result)}  min {format_result(result, 'min')}")
+
+    output = args.output or os.path.join(RESULTS_DIR, time.strftime('%Y%m%d-%H%M%S') + '.json')
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w') as output_file:
+        json.dump({"meta": metadata(), "results": results}, output_file, indent=2)
+    print(f"Results written to {output}")
+
+    if args.compare:
+        regressions = compare(results, args.compare, args.max_regression)
+        if regressions:
+            print(f"{len(regressions)} case(s) regressed by more than {args.max_regression:.0%}")
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,49 @@
+"""
+Shared test setup. The app modules read their settings when they are imported, so the settings are
+pinned here first: the in-memory registry, and none of the files a deployment keeps next to it.
+"""
+import os
+
+os.environ.update({
+    'REGISTRY_BACKEND': 'memory',
+    'HASH_INDEX_PATH': ':memory:',
+    'SHARED_MATRIX_PATH': '',
+    'RESULT_CACHE_PATH': '',
+    'THUMBNAIL_STORE_PATH': '',
+    'TILE_INDEX_PATH': '',
+    'FEATURE_VERIFIER': 'off',
+    'MERKLE_PATH': ':memory:',
+    'MERKLE_ANCHOR_INTERVAL': '0',
+    'PUBLISH_STATE_PATH': '',
+    'WEB_CONCURRENCY': '1',
+    'CPU_EXECUTOR': 'thread',
+})
+
+import numpy as np
+import pytest
+
+
+@pytest.fixture
+def rng():
+    return np.random.default_rng(1234)
+
+
+@pytest.fixture
+def random_hash(rng):
+    """Builds random "ahash#dhash#phash" strings of `nbits`-bit hashes."""
+    def build(nbits: int = 256) -> str:
+        return '#'.join(rng.integers(0, 256, nbits // 8, dtype=np.uint8).tobytes().hex() for _ in range(3))
+    return build
+
+
+@pytest.fixture
+def flip_bits(rng):
+    """Flips `count` distinct bits, spread over the three hashes, of a hash string."""
+    def flip(hash_string: str, count: int) -> str:
+        parts = [bytearray(bytes.fromhex(part)) for part in hash_string.split('#')]
+        nbits = len(parts[0]) * 8
+        for bit in rng.choice(3 * nbits, count, replace=False):
+            part, offset = divmod(int(bit), nbits)
+            parts[part][offset // 8] ^= 0x80 >> (offset % 8)
+        return '#'.join(part.hex() for part in parts)
+    return flip
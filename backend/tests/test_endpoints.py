@@ -0,0 +1,192 @@
+"""The HTTP endpoints end to end, against the in-memory registry (see conftest.py)."""
+import io
+import json
+import tarfile
+import time
+import zipfile
+
+import numpy as np
+import pytest
+from fastapi.testclient import TestClient
+from PIL import Image
+
+from app.main import app
+from app.merkle import verify_inclusion
+
+
+def photo(seed: int, quality: int = 90, size: tuple = (320, 240)) -> bytes:
+    """A smooth synthetic photo: a few random colour blocks, upscaled."""
+    blocks = np.random.default_rng(seed).integers(0, 256, (6, 8, 3), dtype=np.uint8)
+    buffer = io.BytesIO()
+    Image.fromarray(blocks).resize(size, Image.Resampling.BICUBIC).save(buffer, 'JPEG', quality=quality)
+    return buffer.getvalue()
+
+
+def animation(*frames: bytes) -> bytes:
+    """An animated GIF of the given images, one frame each."""
+    images = [Image.open(io.BytesIO(frame)).convert('RGB') for frame in frames]
+    buffer = io.BytesIO()
+    images[0].save(buffer, 'GIF', save_all=True, append_images=images[1:], duration=100, loop=0)
+    return buffer.getvalue()
+
+
+def upload(data: bytes, name: str = 'image.jpg', content_type: str = 'image/jpeg') -> dict:
+    return {'file': (name, data, content_type)}
+
+
+@pytest.fixture(scope='module')
+def client():
+    with TestClient(app) as client:
+        yield client
+
+
+def publish(client, data: bytes) -> dict:
+    """Publishes an image and waits for its job to be mined."""
+    response = client.post('/api/publish', files=upload(data))
+    assert response.status_code == 200
+    body = response.json()
+    if body['job_id'] is not None:
+        for _ in range(100):
+            status = client.get(f"/api/publish/{body['job_id']}").json()
+            if status['status'] in ('mined', 'failed'):
+                break
+            time.sleep(0.05)
+        assert status['status'] == 'mined'
+        assert status['hash'] == body['hash']
+    return body
+
+
+def test_health(client):
+    assert client.get('/health').json() == {'status': 'healthy'}
+    # Ready once the hash index has synced with the registry, which a search does when it is stale
+    client.post('/api/verify', files=upload(photo(0)))
+    assert client.get('/ready').status_code == 200
+
+
+def test_publish_then_verify(client):
+    published = publish(client, photo(1))
+    assert published['exists'] is False
+    assert published['job_id'] is not None
+
+    same = client.post('/api/verify', files=upload(photo(1))).json()
+    assert same['exists'] is True
+    assert same['hash'] == published['hash']
+    # Re-encoded at a lower quality: different bytes, same picture
+    assert client.post('/api/verify', files=upload(photo(1, quality=50))).json()['exists'] is True
+    assert client.post('/api/verify', files=upload(photo(2))).json()['exists'] is False
+
+
+def test_publishing_a_registered_image_queues_nothing(client):
+    publish(client, photo(3))
+    again = client.post('/api/publish', files=upload(photo(3, quality=60))).json()
+    assert again['exists'] is True
+    assert again['job_id'] is None
+
+
+def test_unregistered_animation(client):
+    data = animation(photo(40), photo(41), photo(42))
+    for endpoint in ('/api/verify', '/api/publish'):
+        response = client.post(endpoint, files=upload(data, 'a.gif', 'image/gif'))
+        assert response.status_code == 200
+        assert response.json()['exists'] is False
+
+
+def test_animation_registered_in_a_later_frame(client):
+    published = publish(client, photo(43))
+    data = animation(photo(44), photo(44), photo(45), photo(43))
+    assert client.post('/api/verify', files=upload(animation(photo(44)), 'a.gif', 'image/gif')).json()['exists'] is False
+    # The composite hash covers the first frame only; the registered scene is found frame by frame
+    verified = client.post('/api/verify', files=upload(data, 'a.gif', 'image/gif')).json()
+    assert verified['exists'] is True
+    assert verified['hash'] != published['hash']
+    again = client.post('/api/publish', files=upload(data, 'a.gif', 'image/gif')).json()
+    assert again['exists'] is True
+    assert again['job_id'] is None
+
+
+def test_unknown_job(client):
+    assert client.get('/api/publish/unknown').status_code == 404
+
+
+def test_search(client):
+    published = publish(client, photo(4))
+    body = client.post('/api/search', files=upload(photo(4)), params={'k': 3}).json()
+    assert body['exists'] is True
+    best = body['matches'][0]
+    assert best['hash'] == published['hash']
+    assert best['match'] is True
+    assert best['avg_similarity'] == 100.0
+    assert [match['avg_similarity'] for match in body['matches']] == sorted(
+        (match['avg_similarity'] for match in body['matches']), reverse=True)
+
+
+def test_batch_verify_and_publish(client):
+    files = [('files', (f'{seed}.jpg', photo(seed), 'image/jpeg')) for seed in (10, 11, 10)]
+    lines = [json.loads(line) for line in client.post('/api/publish/batch', files=files).text.splitlines()]
+    assert [line['index'] for line in lines] == [0, 1, 2]
+    assert lines[0]['job_id'] is not None and lines[1]['job_id'] is not None
+    # The third file repeats the first: a duplicate within the batch, or registered already
+    assert lines[2]['job_id'] is None
+    assert lines[2]['duplicate_of'] == 0 or lines[2]['exists'] is True
+    for line in lines:
+        if line['job_id'] is not None:
+            for _ in range(100):
+                if client.get(f"/api/publish/{line['job_id']}").json()['status'] == 'mined':
+                    break
+                time.sleep(0.05)
+
+    files = [('files', (f'{seed}.jpg', photo(seed), 'image/jpeg')) for seed in (10, 11, 12)]
+    lines = [json.loads(line) for line in client.post('/api/verify/batch', files=files).text.splitlines()]
+    assert {line['filename']: line['exists'] for line in lines} == {'10.jpg': True, '11.jpg': True, '12.jpg': False}
+
+
+@pytest.mark.parametrize('kind', ['zip', 'tar.gz'])
+def test_batch_verify_of_an_archive(client, kind):
+    publish(client, photo(13))
+    members = {f'{seed}.jpg': photo(seed) for seed in (13, 14, 15)}
+    buffer = io.BytesIO()
+    if kind == 'zip':
+        with zipfile.ZipFile(buffer, 'w', zipfile.ZIP_DEFLATED) as archive:
+            for name, data in members.items():
+                archive.writestr(name, data)
+    else:
+        with tarfile.open(fileobj=buffer, mode='w:gz') as archive:
+            for name, data in members.items():
+                info = tarfile.TarInfo(name)
+                info.size = len(data)
+                archive.addfile(info, io.BytesIO(data))
+    response = client.post('/api/verify/batch', files={'archive': (f'images.{kind}', buffer.getvalue())})
+    lines = [json.loads(line) for line in response.text.splitlines()]
+    assert {line['filename']: (line['exists'], line['error']) for line in lines} == {
+        '13.jpg': (True, None), '14.jpg': (False, None), '15.jpg': (False, None)}
+
+
+def test_inclusion_proof(client):
+    published = publish(client, photo(20))
+    proof = None
+    size = client.get('/api/proof/0').json()['size']
+    for index in range(size):
+        candidate = client.get(f'/api/proof/{index}').json()
+        if candidate['hash'] == published['hash']:
+            proof = candidate
+    assert proof is not None
+    assert verify_inclusion(proof['entry'], proof['index'], proof['size'],
+                            [bytes.fromhex(sibling) for sibling in proof['path']], bytes.fromhex(proof['root']))
+    assert client.get(f'/api/proof/{size}').status_code == 404
+
+
+def test_check(client):
+    body = client.post('/api/check', files=upload(photo(5, size=(123, 45)))).json()
+    assert body['validation'] == {'format': 'JPEG', 'size': [123, 45], 'mode': 'RGB', 'is_animated': False}
+
+
+def test_non_images_are_rejected(client):
+    for endpoint in ('/api/verify', '/api/publish', '/api/check', '/api/search'):
+        assert client.post(endpoint, files=upload(b'hello', 'a.txt', 'text/plain')).status_code == 400
+
+
+def test_metrics(client):
+    client.post('/api/verify', files=upload(photo(6)))
+    text = client.get('/metrics').text
+    assert 'pxlproof_stage_duration_seconds_count{stage="hash"}' in text
+    assert 'pxlproof_registry_entries{source="legacy"}' in text
@@ -0,0 +1,63 @@
+"""Round trips of the hash string and binary entry formats, for every hash version."""
+import numpy as np
+import pytest
+
+from app.hash_codec import (FORMAT_V1, FORMAT_V2, VERSIONS, decode_entry, encode_hash, format_hash_string,
+                            join_hashes, normalize_entry, split_hashes, split_version, to_hash_string, version_of)
+
+
+@pytest.mark.parametrize('version', list(VERSIONS))
+def test_string_binary_round_trip(version, random_hash):
+    descriptor = VERSIONS[version]
+    hash_string = format_hash_string(version, random_hash(descriptor.nbits).split('#'))
+    entry = encode_hash(hash_string)
+    assert len(entry) == 1 + 3 * descriptor.nbits // 8
+    assert entry[0] == version
+    assert version_of(hash_string) == version_of(entry) == version
+    assert to_hash_string(entry) == hash_string
+    assert np.array_equal(decode_entry(entry, descriptor.nbits), decode_entry(hash_string, descriptor.nbits))
+    assert normalize_entry(hash_string) == normalize_entry(entry) == entry
+
+
+def test_version_markers(random_hash):
+    v1 = random_hash(256)
+    v2 = format_hash_string(FORMAT_V2, random_hash(64).split('#'))
+    # Version 1 strings stay unmarked, like the entries already on-chain
+    assert format_hash_string(FORMAT_V1, v1.split('#')) == v1
+    assert v2.startswith('2:')
+    assert split_version(v1) == (None, v1)
+    assert split_version(v2) == (FORMAT_V2, v2[2:])
+    assert split_hashes(join_hashes({FORMAT_V1: v1, FORMAT_V2: v2})) == {FORMAT_V1: v1, FORMAT_V2: v2}
+
+
+def test_legacy_unmarked_strings(random_hash):
+    # Strings written before versions existed are recognized by their hash size
+    assert version_of(random_hash(256)) == FORMAT_V1
+    assert version_of(random_hash(64)) == FORMAT_V2
+    legacy = random_hash(64)
+    assert to_hash_string(encode_hash(legacy)) == format_hash_string(FORMAT_V2, legacy.split('#'))
+
+
+def test_bit_order_matches_hex(random_hash):
+    hash_string = random_hash()
+    bits = decode_entry(hash_string)
+    assert [row.tobytes().hex() for row in bits] == hash_string.split('#')
+
+
+@pytest.mark.parametrize('entry', [
+    'abc#def',
+    'zz' * 32 + '#' + '00' * 32 + '#' + '00' * 32,
+    '9:' + '#'.join(['00' * 32] * 3),
+    'x:' + '#'.join(['00' * 32] * 3),
+    '#'.join(['00' * 20] * 3),
+])
+def test_invalid_strings(entry):
+    with pytest.raises(ValueError):
+        encode_hash(entry)
+    assert normalize_entry(entry) == entry
+
+
+@pytest.mark.parametrize('entry', [b'', bytes([9]) + bytes(96), bytes([FORMAT_V1]) + bytes(95)])
+def test_invalid_entries(entry):
+    with pytest.raises(ValueError):
+        decode_entry(entry)
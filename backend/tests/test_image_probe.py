@@ -0,0 +1,84 @@
+"""The header-only probe against what Pillow reports after opening the same bytes."""
+import io
+
+import pytest
+from PIL import Image, features
+
+from app.image_probe import ProbeError, is_animated, probe_image
+
+
+def encode(image: Image.Image, fmt: str, **params) -> bytes:
+    buffer = io.BytesIO()
+    image.save(buffer, fmt, **params)
+    return buffer.getvalue()
+
+
+def frames(mode: str = 'RGB', count: int = 3) -> list:
+    return [Image.new(mode, (40, 30), color) for color in ('red', 'green', 'blue')[:count]]
+
+
+def pillow(data: bytes) -> dict:
+    image = Image.open(io.BytesIO(data))
+    return {
+        "format": image.format,
+        "size": image.size,
+        "mode": image.mode,
+        "is_animated": getattr(image, "is_animated", False),
+    }
+
+
+CASES = {
+    'jpeg-rgb': lambda: encode(Image.new('RGB', (97, 61), 'red'), 'JPEG'),
+    'jpeg-gray': lambda: encode(Image.new('L', (64, 48)), 'JPEG'),
+    'jpeg-cmyk': lambda: encode(Image.new('CMYK', (33, 17)), 'JPEG'),
+    'jpeg-progressive': lambda: encode(Image.new('RGB', (120, 80)), 'JPEG', progressive=True),
+    'jpeg-exif': lambda: encode(Image.new('RGB', (50, 40)), 'JPEG', exif=b'Exif\x00\x00' + bytes(4000)),
+    'png-rgb': lambda: encode(Image.new('RGB', (31, 7)), 'PNG'),
+    'png-rgba': lambda: encode(Image.new('RGBA', (31, 7)), 'PNG'),
+    'png-gray': lambda: encode(Image.new('L', (31, 7)), 'PNG'),
+    'png-gray-alpha': lambda: encode(Image.new('LA', (31, 7)), 'PNG'),
+    'png-16bit': lambda: encode(Image.new('I;16', (31, 7)), 'PNG'),
+    'png-bilevel': lambda: encode(Image.new('1', (31, 7)), 'PNG'),
+    'png-palette': lambda: encode(Image.new('P', (31, 7)), 'PNG'),
+    'apng': lambda: encode(frames()[0], 'PNG', save_all=True, append_images=frames()[1:]),
+    'apng-one-frame': lambda: encode(frames()[0], 'PNG', save_all=True),
+    'gif': lambda: encode(Image.new('P', (20, 10)), 'GIF'),
+    'gif-animated': lambda: encode(frames('P')[0], 'GIF', save_all=True, append_images=frames('P')[1:]),
+    'bmp': lambda: encode(Image.new('RGB', (13, 11)), 'BMP'),
+    'tiff': lambda: encode(Image.new('RGB', (13, 11)), 'TIFF'),
+}
+WEBP_CASES = {
+    'webp-lossy': lambda: encode(Image.new('RGB', (45, 23)), 'WEBP'),
+    'webp-lossless': lambda: encode(Image.new('RGB', (45, 23)), 'WEBP', lossless=True),
+    'webp-alpha': lambda: encode(Image.new('RGBA', (45, 23)), 'WEBP'),
+    'webp-animated': lambda: encode(frames()[0], 'WEBP', save_all=True, append_images=frames()[1:]),
+}
+if features.check('webp'):
+    CASES.update(WEBP_CASES)
+
+
+@pytest.mark.parametrize('name', list(CASES))
+def test_probe_matches_pillow(name):
+    data = CASES[name]()
+    assert probe_image(io.BytesIO(data)) == pillow(data)
+    assert is_animated(data) == pillow(data)["is_animated"]
+
+
+def test_probe_reads_from_any_stream_position():
+    data = CASES['png-rgb']()
+    stream = io.BytesIO(data)
+    stream.seek(len(data))
+    assert probe_image(stream) == pillow(data)
+
+
+def test_malformed_png_header():
+    data = bytearray(CASES['png-rgb']())
+    data[12:16] = b'XXXX'
+    with pytest.raises(ProbeError):
+        probe_image(io.BytesIO(bytes(data)))
+
+
+def test_unreadable_headers_are_not_animated():
+    assert not is_animated(b'')
+    assert not is_animated(b'GIF89a\x01')
+    assert not is_animated(b'\x89PNG\r\n\x1a\n' + bytes(30))
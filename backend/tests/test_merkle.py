@@ -0,0 +1,76 @@
+"""MerkleLog proofs and roots against a tree computed from the entries alone."""
+import pytest
+
+from app.merkle import EMPTY_ROOT, MerkleLog, leaf_hash, merkle_root, node_hash, verify_inclusion
+from app.registry import LEGACY_SOURCE, PACKED_SOURCE
+
+
+def entries(count: int, source: int = LEGACY_SOURCE) -> list:
+    if source == PACKED_SOURCE:
+        return [bytes([1]) + i.to_bytes(96, 'big') for i in range(count)]
+    return [f"{i:064x}#{i:064x}#{i:064x}" for i in range(count)]
+
+
+@pytest.fixture
+def log():
+    return MerkleLog(':memory:')
+
+
+def test_rfc6962_shape():
+    a, b, c = (leaf_hash(entry) for entry in 'abc')
+    assert merkle_root([]) == EMPTY_ROOT
+    assert merkle_root(['a']) == a
+    assert merkle_root(['a', 'b', 'c']) == node_hash(node_hash(a, b), c)
+
+
+@pytest.mark.parametrize('source', [LEGACY_SOURCE, PACKED_SOURCE])
+def test_proofs_across_tree_sizes(log, source):
+    items = entries(33, source)
+    log.extend(source, 0, items)
+    for size in range(1, len(items) + 1):
+        root = log.root(source, size)
+        assert root == merkle_root(items[:size])
+        for index in range(size):
+            path, proof_root = log.proof(source, index, size)
+            assert proof_root == root
+            assert verify_inclusion(items[index], index, size, path, root)
+
+
+def test_tampered_proofs_fail(log):
+    items = entries(13)
+    log.extend(LEGACY_SOURCE, 0, items)
+    path, root = log.proof(LEGACY_SOURCE, 5, 13)
+    assert verify_inclusion(items[5], 5, 13, path, root)
+    assert not verify_inclusion(items[6], 5, 13, path, root)
+    assert not verify_inclusion(items[5], 4, 13, path, root)
+    assert not verify_inclusion(items[5], 5, 13, path[:-1], root)
+    assert not verify_inclusion(items[5], 13, 13, path, root)
+    with pytest.raises(IndexError):
+        log.proof(LEGACY_SOURCE, 13, 13)
+
+
+def test_incremental_extend_matches_one_shot(log):
+    items = entries(40)
+    for start, stop in ((0, 1), (1, 7), (7, 8), (8, 31), (31, 40)):
+        log.extend(LEGACY_SOURCE, start, items[start:stop])
+        assert log.root(LEGACY_SOURCE) == merkle_root(items[:stop])
+    # Entries the tree already holds are skipped
+    log.extend(LEGACY_SOURCE, 30, items[30:40])
+    assert log.size(LEGACY_SOURCE) == 40
+
+
+def test_tree_of_another_registry_is_rebuilt(log):
+    items = entries(10)
+    log.extend(LEGACY_SOURCE, 0, items)
+    other = ['other'] + items[1:] + ['more']
+    # Same last overlapping leaf, different prefix: the whole mirror passed at load rebuilds it
+    log.extend(LEGACY_SOURCE, 0, other)
+    assert log.root(LEGACY_SOURCE) == merkle_root(other)
+    assert log.size(LEGACY_SOURCE) == len(other)
+
+
+def test_sources_are_separate_trees(log):
+    log.extend(LEGACY_SOURCE, 0, entries(5))
+    log.extend(PACKED_SOURCE, 0, entries(3, PACKED_SOURCE))
+    assert log.root(LEGACY_SOURCE) == merkle_root(entries(5))
+    assert log.root(PACKED_SOURCE) == merkle_root(entries(3, PACKED_SOURCE))
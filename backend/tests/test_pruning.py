@@ -0,0 +1,76 @@
+"""The two-stage cascade of HashMatrix against comparing every row on all three hashes."""
+from itertools import permutations
+
+import numpy as np
+import pytest
+
+from app.hash_codec import HASH_TYPES
+from app.similarity import HashMatrix
+
+THRESHOLD = 80.0
+
+
+@pytest.fixture
+def registry(random_hash, flip_bits):
+    entries = [random_hash() for _ in range(200)]
+    # Near copies, so some rows survive the first stage and are decided by the last hash
+    entries += [flip_bits(entries[i], count) for i, count in ((3, 100), (50, 150), (120, 160), (199, 200))]
+    return entries
+
+
+@pytest.fixture
+def queries(registry, random_hash, flip_bits):
+    return [random_hash() for _ in range(4)] + [flip_bits(registry[i], count)
+                                                 for i, count in ((3, 140), (50, 153), (120, 154), (7, 300))]
+
+
+def full_scan(matrix, query):
+    """The average similarity of every row, all three hashes compared."""
+    return matrix.similarities(query)['avg_similarity']
+
+
+@pytest.mark.parametrize('order', list(permutations(HASH_TYPES)))
+def test_pruned_decisions_match_full_scan(registry, queries, order):
+    matrix = HashMatrix(chunk_size=32, order=order)
+    matrix.append(registry)
+    for query in queries:
+        avg = full_scan(matrix, query)
+        assert matrix.exists(query, THRESHOLD) == bool(np.any(avg > THRESHOLD))
+        exists, candidates = matrix.gray_zone(query, 52.0, THRESHOLD, limit=len(registry))
+        if not exists:
+            expected = sorted((row for row in range(len(avg)) if avg[row] > 52.0), key=lambda row: (-avg[row], row))
+            assert [candidate['row'] for candidate in candidates] == expected
+
+
+def test_candidates_keep_every_row_above_the_bound(registry, queries):
+    matrix = HashMatrix(chunk_size=32)
+    matrix.append(registry)
+    for query in queries:
+        avg = full_scan(matrix, query)
+        for bound in (52.0, THRESHOLD):
+            rows, scores = [], []
+            for chunk_rows, chunk_avg in matrix._candidates(query, bound, [0, 0]):
+                rows.extend(chunk_rows.tolist())
+                scores.extend(chunk_avg.tolist())
+            assert set(np.flatnonzero(avg > bound).tolist()) <= set(rows)
+            # Rows that survive the first stage get the exact average
+            assert scores == avg[rows].tolist()
+
+
+def test_random_rows_are_ruled_out_by_the_first_stage(registry, random_hash):
+    matrix = HashMatrix()
+    matrix.append(registry)
+    assert not matrix.exists(random_hash(), THRESHOLD)
+    assert matrix.rejections[0] == len(registry)
+    assert matrix.pruned_comparisons == len(registry)
+
+
+def test_match_pairs_matches_full_scan(registry, queries):
+    matrix = HashMatrix()
+    matrix.append(registry)
+    query_bits = np.stack([matrix._query_bits(query) for query in queries])
+    found_queries, found_rows = matrix.match_pairs(query_bits, THRESHOLD)
+    expected = {(i, int(row)) for i, query in enumerate(queries)
+                for row in np.flatnonzero(full_scan(matrix, query) > THRESHOLD)}
+    assert set(zip(found_queries.tolist(), found_rows.tolist())) == expected
+    assert expected
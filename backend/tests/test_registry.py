@@ -0,0 +1,36 @@
+"""The registry backends: positions per source, reads bounded by a known count, incomplete backends."""
+import pytest
+
+from app.registry import LEGACY_SOURCE, PACKED_SOURCE, HashRegistry, MemoryRegistry, SQLiteRegistry
+
+
+@pytest.fixture(params=['memory', 'sqlite'])
+def registry(request, tmp_path):
+    return MemoryRegistry() if request.param == 'memory' else SQLiteRegistry(str(tmp_path / 'registry.db'))
+
+
+def test_entries_go_to_their_source(registry):
+    registry.append_many(['a', b'\x01b', 'c'])
+    registry.append_many([b'\x01d'])
+    assert registry.count(LEGACY_SOURCE) == 2
+    assert registry.count(PACKED_SOURCE) == 2
+    assert list(registry.iter_since(0, LEGACY_SOURCE)) == ['a', 'c']
+    assert [bytes(entry) for entry in registry.iter_since(1, PACKED_SOURCE)] == [b'\x01d']
+
+
+def test_iter_since_stops_at_the_known_count(registry):
+    registry.append_many(['a', 'b', 'c'])
+    total = registry.count()
+    registry.append_many(['d'])
+    assert list(registry.iter_since(1, total=total)) == ['b', 'c']
+    assert list(registry.iter_since(1)) == ['b', 'c', 'd']
+    assert list(registry.iter_since(4)) == []
+
+
+def test_incomplete_backend_cannot_be_created():
+    class CountOnly(HashRegistry):
+        def count(self, source=LEGACY_SOURCE):
+            return 0
+
+    with pytest.raises(TypeError):
+        CountOnly()
@@ -0,0 +1,93 @@
+"""HashMatrix against the string-by-string `calculate_similaties()` it replaced in `search_image()`."""
+import pytest
+
+from app.main import calculate_similaties
+from app.similarity import HashMatrix
+
+THRESHOLD = 80.0
+# Summed distance (over 3 x 256 bits) at which the average similarity crosses the threshold: 153.6
+JUST_ABOVE, JUST_BELOW = 153, 154
+
+
+@pytest.fixture
+def registry(random_hash):
+    return [random_hash() for _ in range(300)]
+
+
+@pytest.fixture
+def queries(registry, random_hash, flip_bits):
+    """Random hashes, and hashes a few bits either side of the threshold from a registered one."""
+    return ([random_hash() for _ in range(5)] +
+            [flip_bits(registry[i], JUST_ABOVE) for i in (0, 150, 299)] +
+            [flip_bits(registry[i], JUST_BELOW) for i in (0, 150, 299)] +
+            [registry[42]])
+
+
+@pytest.fixture
+def matrix(registry):
+    # Small chunks, so the scans cross chunk boundaries
+    matrix = HashMatrix(chunk_size=64)
+    matrix.append(registry)
+    return matrix
+
+
+def baseline(registry, query):
+    return [calculate_similaties(entry, query) for entry in registry]
+
+
+def test_similarities_match_calculate_similaties(matrix, registry, queries):
+    for query in queries:
+        expected = baseline(registry, query)
+        got = matrix.similarities(query)
+        for key in expected[0]:
+            assert got[key].tolist() == [row[key] for row in expected]
+
+
+def test_exists_matches_baseline(matrix, registry, queries):
+    for query in queries:
+        expected = any(row['avg_similarity'] > THRESHOLD for row in baseline(registry, query))
+        assert matrix.exists(query, THRESHOLD) == expected
+    assert matrix.exists_many(queries, THRESHOLD).tolist() == [
+        any(row['avg_similarity'] > THRESHOLD for row in baseline(registry, query)) for query in queries]
+
+
+def test_near_threshold_decisions(matrix, registry, flip_bits):
+    above = flip_bits(registry[7], JUST_ABOVE)
+    below = flip_bits(registry[7], JUST_BELOW)
+    assert calculate_similaties(registry[7], above)['avg_similarity'] > THRESHOLD
+    assert calculate_similaties(registry[7], below)['avg_similarity'] < THRESHOLD
+    assert matrix.exists(above, THRESHOLD)
+    assert not matrix.exists(below, THRESHOLD)
+
+
+def test_top_k_matches_baseline(matrix, registry, queries):
+    for query in queries:
+        expected = sorted((row['avg_similarity'] for row in baseline(registry, query)), reverse=True)[:5]
+        got = matrix.top_k(query, 5)
+        # Which of several rows tied at the k-th score is returned is not specified, only their order
+        assert [match['avg_similarity'] for match in got] == expected
+        assert got == sorted(got, key=lambda match: (-match['avg_similarity'], match['position']))
+        for match in got:
+            assert match['hash'] == registry[match['position']]
+            assert calculate_similaties(match['hash'], query)['avg_similarity'] == match['avg_similarity']
+
+
+def test_gray_zone_matches_baseline(matrix, registry, queries):
+    low = 52.0
+    for query in queries:
+        rows = baseline(registry, query)
+        exists, candidates = matrix.gray_zone(query, low, THRESHOLD, limit=4)
+        assert exists == any(row['avg_similarity'] > THRESHOLD for row in rows)
+        if exists:
+            assert candidates == []
+            continue
+        expected = sorted(((row['avg_similarity'], -position) for position, row in enumerate(rows)
+                           if row['avg_similarity'] > low), reverse=True)[:4]
+        assert [(candidate['avg_similarity'], -candidate['position']) for candidate in candidates] == expected
+
+
+def test_incompatible_entries_are_skipped(random_hash):
+    matrix = HashMatrix()
+    added = matrix.append([random_hash(), 'not#a#hash', random_hash(64), random_hash()])
+    assert added == 2
+    assert matrix.positions.tolist() == [0, 3]
@@ -0,0 +1,76 @@
+"""Tile votes: crops of a published image are found, unrelated images with plain backgrounds are not."""
+import io
+
+import numpy as np
+import pytest
+from PIL import Image, ImageDraw
+
+from app.tiles import TileIndex, tile_hashes
+
+
+def jpeg(image: Image.Image, quality: int = 90) -> bytes:
+    buffer = io.BytesIO()
+    image.save(buffer, 'JPEG', quality=quality)
+    return buffer.getvalue()
+
+
+def photo(seed: int) -> Image.Image:
+    """A synthetic photo with detail at every tile scale: random colour blocks, upscaled."""
+    blocks = np.random.default_rng(seed).integers(0, 256, (12, 16, 3), dtype=np.uint8)
+    return Image.fromarray(blocks).resize((640, 480), Image.Resampling.BICUBIC)
+
+
+def drawing(draw) -> bytes:
+    image = Image.new('RGB', (640, 480), 'white')
+    draw(ImageDraw.Draw(image))
+    return jpeg(image)
+
+
+def sky() -> bytes:
+    pixels = np.zeros((480, 640, 3), dtype=np.uint8)
+    pixels[..., 0], pixels[..., 1], pixels[..., 2] = 100, np.linspace(150, 200, 480)[:, None], 230
+    image = Image.fromarray(pixels)
+    ImageDraw.Draw(image).polygon([(0, 480), (200, 380), (400, 430), (640, 360), (640, 480)], fill=(40, 90, 30))
+    return jpeg(image)
+
+
+PLAIN = {
+    'box': lambda: drawing(lambda draw: draw.rectangle((250, 180, 390, 300), fill='red')),
+    'ellipse': lambda: drawing(lambda draw: draw.ellipse((100, 100, 300, 250), fill='blue')),
+    'text': lambda: drawing(lambda draw: [draw.text((40, 40 + 40 * i), f'The quick brown fox jumps {i}', fill='black')
+                                          for i in range(8)]),
+    'sky': sky,
+}
+
+
+def index_of(*images: bytes) -> TileIndex:
+    index = TileIndex(':memory:')
+    for i, data in enumerate(images):
+        index.put(bytes([i]), tile_hashes(data))
+    return index
+
+
+def test_crop_of_a_published_photo_is_found():
+    index = index_of(jpeg(photo(1)), jpeg(photo(2)))
+    entry, votes = index.vote(tile_hashes(jpeg(photo(1).crop((100, 80, 500, 400)), 80)))
+    assert entry == bytes([0])
+    assert votes >= index.min_votes
+    assert index.vote(tile_hashes(jpeg(photo(3))))[0] is None
+
+
+@pytest.mark.parametrize('published', list(PLAIN))
+def test_plain_backgrounds_do_not_vote_for_each_other(published):
+    index = index_of(PLAIN[published]())
+    for name, build in PLAIN.items():
+        if name != published:
+            entry, votes = index.vote(tile_hashes(build()))
+            assert entry is None
+            assert votes <= 1
+
+
+def test_flat_image_has_no_tiles():
+    white = jpeg(Image.new('RGB', (300, 200), 'white'))
+    assert tile_hashes(white).shape == (0, 3, 8)
+    index = index_of(white, jpeg(photo(1)))
+    assert len(index) == 2
+    assert index.vote(tile_hashes(white)) == (None, 0)
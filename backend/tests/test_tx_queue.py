@@ -0,0 +1,27 @@
+"""The publish queue against the in-memory registry."""
+import threading
+
+from app.registry import MemoryRegistry
+from app.tx_queue import FAILED, MINED, TransactionSubmitter
+
+
+def test_jobs_are_mined_only_after_on_mined(random_hash):
+    registry = MemoryRegistry()
+    seen, done = [], threading.Event()
+
+    def on_mined(jobs):
+        # Whatever on_mined does (syncing the hash index) is done before a client sees the job mined
+        seen.extend((job.status, registry.count()) for job in jobs)
+        done.set()
+
+    submitter = TransactionSubmitter(on_mined=on_mined, registry=registry)
+    submitter.start()
+    try:
+        job = submitter.submit(random_hash())
+        assert done.wait(5)
+    finally:
+        submitter.stop()
+    status, entries = seen[0]
+    assert status not in (MINED, FAILED)
+    assert entries == 1
+    assert submitter.get(job.id).status == MINED
@@ -12,6 +12,9 @@ contract HashStorage {
     
     // Array to store hash strings
     string[] public hashes;
+
+    // Array to store binary hashes: 1 version byte followed by the packed ahash, dhash and phash
+    bytes[] public packedHashes;
     
     // Modifier to check if sender is an owner
     modifier onlyOwner() {
@@ -35,7 +38,31 @@ contract HashStorage {
     function addHash(string memory _hashString) public onlyOwner {
         hashes.push(_hashString);
     }
+
+    // Function to add several hashes in one transaction
+    function addHashes(string[] memory _hashStrings) public onlyOwner {
+        for (uint256 i = 0; i < _hashStrings.length; i++) {
+            hashes.push(_hashStrings[i]);
+        }
+    }
     
+    // Function to add a binary hash
+    function addPackedHash(bytes memory _packedHash) public onlyOwner {
+        packedHashes.push(_packedHash);
+    }
+
+    // Function to add several binary hashes in one transaction
+    function addPackedHashes(bytes[] memory _packedHashes) public onlyOwner {
+        for (uint256 i = 0; i < _packedHashes.length; i++) {
+            packedHashes.push(_packedHashes[i]);
+        }
+    }
+
+    // Function to get the total number of binary hashes
+    function getTotalPackedHashes() public view returns (uint256) {
+        return packedHashes.length;
+    }
+
     // Function to get the total number of hashes
     function getTotalHashes() public view returns (uint256) {
         return hashes.length;